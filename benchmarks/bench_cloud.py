@@ -0,0 +1,29 @@
+"""
+Frames per second of DepthCloud construction from a depth image, and of changing the depth of a cloud.
+Run from the repository root: python benchmarks/bench_cloud.py
+"""
+import os
+import sys
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0,os.path.dirname(os.path.abspath(__file__)))
+
+import numpy as np
+from cloudmosh.components.cloud import DepthCloud,pointsFromDepthImage
+from common import RESOLUTIONS,syntheticDepth,measure,report
+
+def loopPoints(depth):
+	return np.array([ (row,column,depth[row][column][0]) for row in range(depth.shape[0]) for column in range(depth.shape[1])])
+
+def main(includeLoop=False):
+	for label,(rows,columns) in RESOLUTIONS.items():
+		depth = syntheticDepth(rows,columns)
+		report("DepthCloud {0}".format(label),measure(lambda: DepthCloud(depth)))
+		report("DepthCloud {0} (no grid cache)".format(label),measure(lambda: pointsFromDepthImage(depth,cache=False)))
+		cloud = DepthCloud(depth)
+		report("DepthCloud.setDepthByImage {0}".format(label),measure(lambda: cloud.setDepthByImage(depth)))
+		report("DepthCloud.updateDepthByImage {0}".format(label),measure(lambda: cloud.updateDepthByImage(depth)))
+		if includeLoop:
+			report("DepthCloud {0} (per-pixel loop)".format(label),measure(lambda: loopPoints(depth),repeat=1,warmup=0))
+
+if __name__ == "__main__":
+	main(includeLoop="--loop" in sys.argv)
@@ -0,0 +1,43 @@
+"""
+Save and load times, and file sizes, of a sequence of clouds in the cloud file format.
+Run from the repository root: python benchmarks/bench_cloudfile.py
+"""
+import os
+import sys
+import tempfile
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0,os.path.dirname(os.path.abspath(__file__)))
+
+import numpy as np
+import nutsflow
+from cloudmosh.components.cloud import DepthCloud
+from cloudmosh.components.cloudfile import CloudFile,SaveClouds,LoadClouds
+from common import RESOLUTIONS,syntheticDepth,syntheticColors,measure,report
+
+FRAMES = 10
+
+def main():
+	rows,columns = RESOLUTIONS["480p"]
+	clouds = []
+	for seed in range(FRAMES):
+		cloud = DepthCloud(syntheticDepth(rows,columns,seed=seed))
+		cloud.setColorsByImage(syntheticColors(rows,columns,seed=seed))
+		clouds.append(cloud)
+	depths = [syntheticDepth(rows,columns,seed=seed) for seed in range(FRAMES)]
+	report("Rebuild from depth images",measure(lambda: [DepthCloud(depth) for depth in depths],repeat=3),FRAMES)
+	with tempfile.TemporaryDirectory() as directory:
+		for options in ({},{'positionType':'float16'},{'compression':'zlib'},{'compression':'zstd'},{'compression':'lz4'}):
+			label = ",".join("{0}={1}".format(key,value) for key,value in options.items()) or "float32"
+			path = os.path.join(directory,"clouds.cmc")
+			try:
+				seconds = measure(lambda: clouds >> SaveClouds(path,**options),repeat=3)
+			except ImportError as error:
+				print("{0:<40} skipped: {1}".format(label,error))
+				continue
+			report("Save {0} ({1:.1f} MB)".format(label,os.path.getsize(path) / 1e6),seconds,FRAMES)
+			report("Load {0}".format(label),measure(lambda: LoadClouds(path) >> nutsflow.Consume(),repeat=3),FRAMES)
+			report("Load and read {0}".format(label),measure(lambda: [np.sum(cloud.getPoints()[:,2],dtype=np.float64) for cloud in LoadClouds(path)],repeat=3),FRAMES)
+			report("Random access {0}".format(label),measure(lambda: CloudFile(path)[FRAMES // 2],repeat=3))
+
+if __name__ == "__main__":
+	main()
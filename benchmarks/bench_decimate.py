@@ -0,0 +1,37 @@
+"""
+Time per frame of DecimateClouds, and of rendering a decimated cloud, per method.
+Run from the repository root: python benchmarks/bench_decimate.py
+"""
+import os
+import sys
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0,os.path.dirname(os.path.abspath(__file__)))
+
+from cloudmosh.components.cloud import DepthCloud
+from cloudmosh.components.effect import DecimateClouds
+from cloudmosh.components.render import SoftwareCloudRender
+from common import RESOLUTIONS,syntheticDepth,syntheticColors,measure,report
+
+def makeCloud(rows,columns):
+	cloud = DepthCloud(syntheticDepth(rows,columns))
+	cloud.setColorsByImage(syntheticColors(rows,columns))
+	return cloud
+
+def copyCloud(cloud):
+	#DecimateClouds replaces the arrays of a cloud rather than changing them, so they can be shared.
+	copy = DepthCloud(cloud.getPoints())
+	copy.setColors(cloud.getColors())
+	return copy
+
+def main():
+	render = SoftwareCloudRender(pointSize=3)
+	for label,(rows,columns) in RESOLUTIONS.items():
+		original = makeCloud(rows,columns)
+		report("Render {0} ({1} points)".format(label,len(original.getPoints())),measure(lambda: render.render(original.getPoints(),original.getColors()),repeat=3))
+		for name,decimate in (("stride=4",DecimateClouds(stride=4)),("random 1/16",DecimateClouds(method='random',fraction=1/16.0)),("voxel 8",DecimateClouds(method='voxel',voxelSize=8.0))):
+			report("DecimateClouds {0} {1}".format(label,name),measure(lambda: decimate(copyCloud(original)),repeat=3))
+			cloud = decimate(makeCloud(rows,columns))
+			report("Render {0} {1} ({2} points)".format(label,name,len(cloud.getPoints())),measure(lambda: render.render(cloud.getPoints(),cloud.getColors()),repeat=3))
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,46 @@
+"""
+Frames per second of InterpolateClouds between two 480p keyframes, per mode.
+Run from the repository root: python benchmarks/bench_interpolate.py
+"""
+import os
+import sys
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0,os.path.dirname(os.path.abspath(__file__)))
+
+import numpy as np
+import nutsflow
+from cloudmosh.components.cloud import DepthCloud,InterpolateClouds
+from common import RESOLUTIONS,syntheticDepth,syntheticColors,measure,report
+
+STEPS = 30
+
+def legacyLoop(clouds,stepFunction,tStepSize):
+	#The per-step loop that InterpolateClouds used to run.
+	tCurrent = 0.0
+	while tCurrent <= 1.0:
+		ft = stepFunction(tCurrent)
+		currentDepth = (1 - ft) * clouds[0].getPoints() + ft * clouds[1].getPoints()
+		currentColors = (1 - ft) * clouds[0].getColors() + ft * clouds[1].getColors()
+		np.hstack((clouds[0].getPoints()[:,[0,1]],currentDepth))
+		currentCloud = DepthCloud(currentDepth)
+		currentCloud.setColors(currentColors.astype(int))
+		tCurrent += tStepSize
+
+def main():
+	rows,columns = RESOLUTIONS["480p"]
+	clouds = []
+	for seed in range(2):
+		cloud = DepthCloud(syntheticDepth(rows,columns,seed=seed))
+		cloud.setColorsByImage(syntheticColors(rows,columns,seed=seed))
+		clouds.append(cloud)
+	stepFunction = lambda t: t * t * (3 - 2 * t)
+	tStepSize = 1.0 / (STEPS - 1)
+	frames = len(InterpolateClouds(stepFunction,0.0,1.0,tStepSize)._timeSteps())
+	report("Legacy loop",measure(lambda: legacyLoop(clouds,stepFunction,tStepSize),repeat=3),frames)
+	for options in ({},{'zOnly':True},{'reuseBuffers':True},{'reuseBuffers':True,'zOnly':True},{'batched':True},{'batched':True,'zOnly':True}):
+		interpolate = InterpolateClouds(stepFunction,0.0,1.0,tStepSize,**options)
+		label = "InterpolateClouds " + (",".join(options) if options else "(default)")
+		report(label,measure(lambda: clouds >> interpolate >> nutsflow.Consume(),repeat=3),frames)
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,32 @@
+"""
+Compares the PosterizeDepth quantization methods on clouds of 300k to 2M points.
+Run from the repository root: python benchmarks/bench_posterize.py
+"""
+import os
+import sys
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0,os.path.dirname(os.path.abspath(__file__)))
+
+from cloudmosh.components.cloud import DepthCloud
+from cloudmosh.components.effect import PosterizeDepth
+from common import syntheticDepth,measure,report
+
+#(rows,columns) of roughly 300k, 1M and 2M points.
+SHAPES = [(480,640),(720,1440),(1080,1920)]
+
+def main(levels=5):
+	for rows,columns in SHAPES:
+		depth = syntheticDepth(rows,columns)
+		for method in PosterizeDepth.METHODS:
+			posterize = PosterizeDepth(levels=levels,method=method)
+			repeat = 1 if method == 'kmeans' else 5
+			seconds = measure(lambda: posterize(DepthCloud(depth)),repeat=repeat)
+			report("{0} points, {1}".format(rows*columns,method),seconds)
+			if method in PosterizeDepth.WARM_START_METHODS and method != 'kmeans':
+				#Warm-started: every timed frame after the first reuses the previous frame's levels.
+				posterize = PosterizeDepth(levels=levels,method=method,warmStart=True)
+				seconds = measure(lambda: posterize(DepthCloud(depth)))
+				report("{0} points, {1} (warm start)".format(rows*columns,method),seconds)
+
+if __name__ == "__main__":
+	main()
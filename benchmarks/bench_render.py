@@ -0,0 +1,52 @@
+"""
+Frames per second of rendering clouds to 640x480 images with SoftwareCloudRender and, if an OpenGL
+context can be created, OffscreenCloudRender, each in one process and spread over ParallelCloudRender's
+worker processes (one per CPU).
+Run from the repository root: python benchmarks/bench_render.py
+(Set PYOPENGL_PLATFORM=egl or osmesa to render with OpenGL on a headless machine.)
+"""
+import os
+import sys
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0,os.path.dirname(os.path.abspath(__file__)))
+
+import nutsflow
+from cloudmosh.components.cloud import DepthCloud
+from cloudmosh.components.render import OffscreenCloudRender,SoftwareCloudRender,ParallelCloudRender
+from common import RESOLUTIONS,syntheticDepth,syntheticColors,measure,report
+
+FRAMES = 10
+
+def makeClouds(rows,columns):
+	clouds = []
+	for seed in range(FRAMES):
+		cloud = DepthCloud(syntheticDepth(rows,columns,seed=seed))
+		cloud.setColorsByImage(syntheticColors(rows,columns,seed=seed))
+		clouds.append(cloud)
+	return clouds
+
+def canRenderOpenGL():
+	try:
+		import pyrender
+		pyrender.OffscreenRenderer(8,8).delete()
+		return True
+	except Exception:
+		return False
+
+def main():
+	openGL = canRenderOpenGL()
+	for label,(rows,columns) in RESOLUTIONS.items():
+		clouds = makeClouds(rows,columns)
+		for pointSize in (1,3,9):
+			render = SoftwareCloudRender(pointSize=pointSize)
+			report("Software {0} pointSize={1}".format(label,pointSize),measure(lambda: clouds >> render >> nutsflow.Consume(),repeat=3),FRAMES)
+			render = ParallelCloudRender(backend='software',pointSize=pointSize)
+			report("Software {0} pointSize={1} ({2} processes)".format(label,pointSize,os.cpu_count()),measure(lambda: clouds >> render >> nutsflow.Consume(),repeat=3),FRAMES)
+			if openGL:
+				render = OffscreenCloudRender(pointSize=pointSize)
+				report("OpenGL {0} pointSize={1}".format(label,pointSize),measure(lambda: clouds >> render >> nutsflow.Consume(),repeat=3),FRAMES)
+				render = ParallelCloudRender(pointSize=pointSize)
+				report("OpenGL {0} pointSize={1} ({2} processes)".format(label,pointSize,os.cpu_count()),measure(lambda: clouds >> render >> nutsflow.Consume(),repeat=3),FRAMES)
+
+if __name__ == "__main__":
+	main()
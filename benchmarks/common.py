@@ -0,0 +1,60 @@
+import time
+import tracemalloc
+import numpy as np
+
+#Frame shapes (rows,columns) used across the benchmarks.
+RESOLUTIONS = {
+	"480p": (480,640),
+	"720p": (720,1280),
+	"1080p": (1080,1920),
+}
+
+def syntheticDepth(rows,columns,seed=0):
+	"""
+	Returns a smooth (rows,columns,1) float32 depth image with a little noise on top.
+	"""
+	random = np.random.RandomState(seed)
+	y,x = np.mgrid[0:rows,0:columns]
+	depth = 10 + 990 * (0.5 + 0.25*np.sin(x/50.0) + 0.25*np.cos(y/70.0))
+	depth += random.rand(rows,columns)
+	return depth.astype(np.float32).reshape((rows,columns,1))
+
+def syntheticColors(rows,columns,seed=0):
+	"""
+	Returns a random (rows,columns,3) uint8 image.
+	"""
+	random = np.random.RandomState(seed)
+	return random.randint(0,256,size=(rows,columns,3),dtype=np.uint8)
+
+def measure(function,repeat=5,warmup=1):
+	"""
+	Calls function() warmup+repeat times and returns the best time of the timed calls, in seconds.
+	"""
+	for _ in range(warmup):
+		function()
+	best = float("inf")
+	for _ in range(repeat):
+		start = time.perf_counter()
+		function()
+		best = min(best,time.perf_counter() - start)
+	return best
+
+def report(name,seconds,frames=1):
+	print("{0:<40} {1:>10.2f} ms {2:>10.1f} frames/s".format(name,1000*seconds,frames/seconds))
+
+def measurePeakMemory(function):
+	"""
+	Calls function() once and returns the most memory it had allocated at any one time, in bytes, as seen
+	by tracemalloc (NumPy reports its array buffers to tracemalloc).
+	"""
+	tracing = tracemalloc.is_tracing()
+	if not tracing:
+		tracemalloc.start()
+	tracemalloc.reset_peak()
+	start = tracemalloc.get_traced_memory()[0]
+	try:
+		function()
+		return max(0,tracemalloc.get_traced_memory()[1] - start)
+	finally:
+		if not tracing:
+			tracemalloc.stop()
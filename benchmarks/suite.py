@@ -0,0 +1,226 @@
+"""
+Runs the benchmarks of the depth-to-render pipeline as one suite, reporting frames/s and peak memory for
+each case, and saves or compares the results as JSON baselines so throughput can be tracked across commits.
+Run from the repository root:
+	python benchmarks/suite.py                              Run every case and print the results.
+	python benchmarks/suite.py --quick                      Only the 480p cases, with fewer repeats.
+	python benchmarks/suite.py --only Posterize Interpolate Only the cases whose names contain one of these.
+	python benchmarks/suite.py --save                       Also save benchmarks/baselines/<commit>.json.
+	python benchmarks/suite.py --compare benchmarks/baselines/abc1234.json
+	                                                        Also compare against a saved baseline; the exit
+	                                                        status is 1 if any case regressed.
+Timings are only comparable between baselines saved on the same machine.
+(Set PYOPENGL_PLATFORM=egl or osmesa to include OpenGL rendering on a headless machine.)
+"""
+import os
+import sys
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0,os.path.dirname(os.path.abspath(__file__)))
+
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+import numpy as np
+import nutsflow
+from cloudmosh.components.cloud import DepthCloud,DepthToClouds,PaintClouds,InterpolateClouds
+from cloudmosh.components.effect import PosterizeDepth
+from cloudmosh.components.io import ReadImage,ReadVideoOrGIF,SaveImage,SaveGIF,SaveVideo
+from cloudmosh.components.cloudfile import SaveClouds,LoadClouds
+from cloudmosh.components.render import OffscreenCloudRender
+from common import RESOLUTIONS,syntheticDepth,syntheticColors,measure,measurePeakMemory,report
+from bench_render import canRenderOpenGL
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TESTDATA = os.path.join(REPOSITORY,"test","testdata")
+BASELINES = os.path.join(REPOSITORY,"benchmarks","baselines")
+
+#How many frames the multi-frame cases push through a stage.
+FRAMES = 8
+
+def makeDepths(rows,columns):
+	return [syntheticDepth(rows,columns,seed=seed).reshape((1,rows,columns,1)) for seed in range(FRAMES)]
+
+def makeImages(rows,columns):
+	return [syntheticColors(rows,columns,seed=seed).reshape((1,rows,columns,3)) for seed in range(FRAMES)]
+
+def makeClouds(rows,columns):
+	clouds = []
+	for depth,image in zip(makeDepths(rows,columns),makeImages(rows,columns)):
+		cloud = DepthCloud(depth[0])
+		cloud.setColorsByImage(image[0])
+		clouds.append(cloud)
+	return clouds
+
+def readFrames(path):
+	"""
+	Decodes every frame of a video or GIF one at a time, and returns how many there were.
+	"""
+	return sum(1 for frames in ReadVideoOrGIF(path,stream=True) for frame in frames)
+
+#Each case function yields (name,function,frames) for every case it covers at the given resolutions.
+#function() runs the case once and frames is how many frames that run processes.
+
+def cloudCases(resolutions,directory):
+	for label,(rows,columns) in resolutions:
+		depths = makeDepths(rows,columns)
+		yield "DepthCloud {0}".format(label),lambda depths=depths: depths >> DepthToClouds() >> nutsflow.Consume(),FRAMES
+
+def paintCases(resolutions,directory):
+	for label,(rows,columns) in resolutions:
+		depths,images = makeDepths(rows,columns),makeImages(rows,columns)
+		yield "PaintClouds {0}".format(label),lambda depths=depths,images=images: depths >> DepthToClouds() >> PaintClouds(images) >> nutsflow.Consume(),FRAMES
+
+def posterizeCases(resolutions,directory):
+	for label,(rows,columns) in resolutions:
+		depths = makeDepths(rows,columns)
+		for method in PosterizeDepth.METHODS:
+			if method == 'kmeans':
+				continue #Seconds per frame; bench_posterize.py covers it.
+			posterize = PosterizeDepth(levels=5,method=method)
+			yield "PosterizeDepth {0} {1}".format(label,method),lambda depths=depths,posterize=posterize: depths >> DepthToClouds() >> posterize >> nutsflow.Consume(),FRAMES
+
+def interpolateCases(resolutions,directory):
+	stepFunction = lambda t: t * t * (3 - 2 * t)
+	for label,(rows,columns) in resolutions:
+		keyframes = makeClouds(rows,columns)[:2]
+		frames = len(InterpolateClouds(stepFunction,0.0,1.0,1.0 / FRAMES)._timeSteps())
+		for name,options in (("",{}),(" zOnly",{'zOnly':True}),(" batched",{'batched':True})):
+			interpolate = InterpolateClouds(stepFunction,0.0,1.0,1.0 / FRAMES,**options)
+			yield "InterpolateClouds {0}{1}".format(label,name),lambda keyframes=keyframes,interpolate=interpolate: keyframes >> interpolate >> nutsflow.Consume(),frames
+
+def readerCases(resolutions,directory):
+	image = os.path.join(TESTDATA,"colorbars.png")
+	yield "ReadImage colorbars.png",lambda: ReadImage(*[image] * FRAMES) >> nutsflow.Consume(),FRAMES
+	for name in ("video.mp4","shore.gif"):
+		path = os.path.join(TESTDATA,name)
+		yield "ReadVideoOrGIF {0}".format(name),lambda path=path: readFrames(path),readFrames(path)
+
+def writerCases(resolutions,directory):
+	for label,(rows,columns) in resolutions:
+		images = makeImages(rows,columns)
+		clouds = makeClouds(rows,columns)
+		template = os.path.join(directory,"image_{0}_{{:03d}}.png".format(label))
+		yield "SaveImage {0} PNG".format(label),lambda images=images,template=template: images >> SaveImage(template,template=True),FRAMES
+		path = os.path.join(directory,"sequence_{0}.gif".format(label))
+		yield "SaveGIF {0}".format(label),lambda images=images,path=path: images >> SaveGIF(path,singleSequence=True),FRAMES
+		path = os.path.join(directory,"sequence_{0}.mp4".format(label))
+		yield "SaveVideo {0}".format(label),lambda images=images,path=path: images >> SaveVideo(path,singleSequence=True,macro_block_size=1),FRAMES
+		path = os.path.join(directory,"clouds_{0}.cmc".format(label))
+		yield "SaveClouds {0}".format(label),lambda clouds=clouds,path=path: clouds >> SaveClouds(path),FRAMES
+		clouds >> SaveClouds(path)
+		yield "LoadClouds {0} (mapped)".format(label),lambda path=path: LoadClouds(path) >> nutsflow.Consume(),FRAMES
+
+def renderCases(resolutions,directory):
+	backends = ['software'] + (['opengl'] if canRenderOpenGL() else [])
+	for label,(rows,columns) in resolutions:
+		clouds = makeClouds(rows,columns)
+		for backend in backends:
+			render = OffscreenCloudRender(pointSize=3,backend=backend)
+			yield "OffscreenCloudRender {0} {1}".format(label,backend),lambda clouds=clouds,render=render: clouds >> render >> nutsflow.Consume(),FRAMES
+
+CASES = (cloudCases,paintCases,posterizeCases,interpolateCases,readerCases,writerCases,renderCases)
+
+def runSuite(resolutions,only=None,repeat=3):
+	"""
+	Runs every case (or only those whose names contain one of the strings in only) and returns a dictionary
+	mapping case names to {seconds, framesPerSecond, peakBytes}, printing each result as it is measured.
+	"""
+	results = {}
+	directory = tempfile.mkdtemp(prefix="cloudmosh-benchmarks-")
+	try:
+		for cases in CASES:
+			for name,function,frames in cases(resolutions,directory):
+				if only and not any(part in name for part in only):
+					continue
+				seconds = measure(function,repeat=repeat)
+				peakBytes = measurePeakMemory(function)
+				report(name,seconds,frames)
+				results[name] = {'seconds': seconds, 'framesPerSecond': frames / seconds, 'peakBytes': peakBytes}
+	finally:
+		shutil.rmtree(directory,ignore_errors=True)
+	return results
+
+def gitCommit():
+	"""
+	Returns the short hash of the checked-out commit, with '-dirty' appended if the tree has changes.
+	"""
+	try:
+		commit = subprocess.check_output(["git","rev-parse","--short","HEAD"],cwd=REPOSITORY,stderr=subprocess.DEVNULL).decode().strip()
+		dirty = subprocess.call(["git","diff","--quiet","HEAD"],cwd=REPOSITORY,stderr=subprocess.DEVNULL) != 0
+		return commit + ("-dirty" if dirty else "")
+	except (OSError,subprocess.CalledProcessError):
+		return "unknown"
+
+def makeBaseline(results,quick):
+	return {
+		'commit': gitCommit(),
+		'date': time.strftime("%Y-%m-%dT%H:%M:%S"),
+		'machine': platform.node(),
+		'platform': platform.platform(),
+		'python': platform.python_version(),
+		'numpy': np.__version__,
+		'cpus': os.cpu_count(),
+		'quick': quick,
+		'results': results,
+	}
+
+def compare(baseline,results,threshold):
+	"""
+	Prints the change of every case against a baseline and returns the names of the cases whose frames/s
+	dropped, or whose peak memory grew, by more than threshold (a fraction).
+	"""
+	print("\nCompared with {0} ({1}):".format(baseline['commit'],baseline['date']))
+	if baseline.get('machine') != platform.node():
+		print("(The baseline was saved on another machine, {0}.)".format(baseline.get('machine')))
+	regressions = []
+	for name,result in results.items():
+		if name not in baseline['results']:
+			print("{0:<40} {1:>10}".format(name,"new"))
+			continue
+		old = baseline['results'][name]
+		speed = result['framesPerSecond'] / old['framesPerSecond'] - 1
+		memory = (result['peakBytes'] - old['peakBytes']) / max(old['peakBytes'],1)
+		regressed = speed < -threshold or memory > threshold
+		print("{0:<40} {1:>+9.1f}% frames/s {2:>+9.1f}% peak memory{3}".format(name,100*speed,100*memory,"  REGRESSION" if regressed else ""))
+		if regressed:
+			regressions.append(name)
+	return regressions
+
+def main(arguments=None):
+	parser = argparse.ArgumentParser(description="Benchmarks of the cloudmosh depth-to-render pipeline.")
+	parser.add_argument("--quick",action="store_true",help="Only run the 480p cases, timing each once.")
+	parser.add_argument("--only",nargs="+",metavar="NAME",help="Only run the cases whose names contain one of these strings.")
+	parser.add_argument("--repeat",type=int,default=None,help="How many timed runs to take the best of (default 3, or 1 with --quick).")
+	parser.add_argument("--save",nargs="?",const="",metavar="PATH",help="Save the results as a baseline (default benchmarks/baselines/<commit>.json).")
+	parser.add_argument("--compare",metavar="PATH",help="Compare the results against a saved baseline.")
+	parser.add_argument("--threshold",type=float,default=0.1,help="The fraction by which a case may get slower or use more memory before it counts as a regression (default 0.1).")
+	arguments = parser.parse_args(arguments)
+
+	resolutions = list(RESOLUTIONS.items())[:1] if arguments.quick else list(RESOLUTIONS.items())
+	repeat = arguments.repeat if arguments.repeat is not None else (1 if arguments.quick else 3)
+	print("{0:<40} {1:>13} {2:>17}".format("Case","Time","Throughput"))
+	results = runSuite(resolutions,arguments.only,repeat)
+	for name,result in results.items():
+		print("{0:<40} {1:>10.1f} MB peak".format(name,result['peakBytes'] / 1e6))
+
+	baseline = makeBaseline(results,arguments.quick)
+	if arguments.save is not None:
+		path = arguments.save or os.path.join(BASELINES,"{0}.json".format(baseline['commit']))
+		os.makedirs(os.path.dirname(os.path.abspath(path)),exist_ok=True)
+		with open(path,'w') as f:
+			json.dump(baseline,f,indent=2,sort_keys=True)
+		print("\nSaved the baseline to {0}".format(path))
+	if arguments.compare is not None:
+		with open(arguments.compare) as f:
+			regressions = compare(json.load(f),results,arguments.threshold)
+		if len(regressions) > 0:
+			print("\n{0} case(s) regressed by more than {1:.0%}.".format(len(regressions),arguments.threshold))
+			return 1
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main())
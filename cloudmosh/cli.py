@@ -0,0 +1,295 @@
+"""
+Runs the standard cloudmosh pipeline (read -> depth -> cloud -> paint -> effects -> render -> save) over a batch
+of images, GIFs and videos. Each input becomes one output of the same kind in the output directory.
+An input found in a directory or by a glob keeps its path below that directory (or below the part of the pattern
+before its first wildcard), and nothing is processed if two inputs would be written to the same output.
+Outputs that already exist are skipped, so an interrupted run can simply be started again; finished inputs are
+also recorded in a checkpoint file, which --resume reads to skip them without looking at their outputs.
+Later runs add to the checkpoint file instead of replacing it, unless --restart is given.
+Run from the repository root, e.g.:
+	python -m cloudmosh.cli --model data/nyu.h5 --output renders --workers 4 --cache-dir cache photos/ "clips/**/*.mp4"
+"""
+import os
+import sys
+import glob
+import time
+import logging
+import argparse
+import itertools
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import imageio
+import numpy as np
+import nutsflow
+from cloudmosh.components.io import ReadImage,ReadVideoOrGIF,SaveImage,SaveGIF,SaveVideo
+from cloudmosh.components.depth import AWDepthEstimator
+from cloudmosh.components.cloud import DepthToClouds,PaintClouds
+from cloudmosh.components.effect import PosterizeDepth,DecimateClouds
+from cloudmosh.components.render import OffscreenCloudRender
+
+logger = logging.getLogger("cloudmosh.cli")
+
+IMAGE_EXTENSIONS = ('.jpg','.jpeg','.png','.bmp')
+SEQUENCE_EXTENSIONS = ('.gif','.mp4','.mov','.avi','.mkv','.webm')
+
+DEFAULT_CHECKPOINT = ".cloudmosh-checkpoint"
+
+def findInputs(patterns,recursive=False):
+	"""
+	Returns a sorted list of (path,relativePath) for every supported file named by patterns, which may be files,
+	directories or glob patterns (** matches any number of directories). relativePath is where the output goes
+	in the output directory: the path below the directory for files found in a directory, the path below the
+	part of the pattern before its first wildcard for files found by a glob, or the file name.
+	recursive (optional): Also look in the subdirectories of directories. Default False.
+	"""
+	inputs = {}
+	for pattern in patterns:
+		if os.path.isdir(pattern):
+			if recursive:
+				paths = [os.path.join(directory,name) for directory,_,names in os.walk(pattern) for name in names]
+			else:
+				paths = [os.path.join(pattern,name) for name in os.listdir(pattern)]
+			for path in paths:
+				inputs.setdefault(os.path.abspath(path),os.path.relpath(path,pattern))
+		else:
+			root = _globRoot(pattern)
+			for path in glob.glob(pattern,recursive=True) or [pattern]:
+				inputs.setdefault(os.path.abspath(path),os.path.relpath(path,root))
+	return sorted((path,relativePath) for path,relativePath in inputs.items() if _isSupported(path) and os.path.isfile(path))
+
+def _globRoot(pattern):
+	"""
+	Returns the directory made of the components of pattern before the first one with a wildcard in it.
+	"""
+	parts = os.path.normpath(pattern).split(os.sep)
+	root = []
+	for part in parts[:-1]:
+		if any(character in part for character in '*?['):
+			break
+		root.append(part)
+	return os.sep.join(root) if len(root) > 0 else os.curdir
+
+def _isSupported(path):
+	return os.path.splitext(path)[1].lower() in IMAGE_EXTENSIONS + SEQUENCE_EXTENSIONS
+
+def _isImage(path):
+	return os.path.splitext(path)[1].lower() in IMAGE_EXTENSIONS
+
+def outputPathOf(relativePath,outputDirectory):
+	"""
+	Returns the output path of an input: images become PNGs, GIFs stay GIFs and other videos become MP4s.
+	"""
+	stem,extension = os.path.splitext(relativePath)
+	extension = extension.lower()
+	if extension in IMAGE_EXTENSIONS:
+		extension = '.png'
+	elif extension != '.gif':
+		extension = '.mp4'
+	return os.path.join(outputDirectory,stem + extension)
+
+class Checkpoint:
+	"""
+	A file listing the inputs that have been processed, one absolute path per line. Each line is flushed as
+	soon as it is added, so the list survives the run being killed. New lines are added after those of
+	earlier runs, so a run that does not resume still keeps what they recorded.
+	"""
+	def __init__(self,path,resume=False,restart=False):
+		"""
+		path: The checkpoint file.
+		resume (optional): Treat the inputs already listed in the file as processed. Default False.
+		restart (optional): Empty the file first, forgetting every input listed in it. Default False.
+		"""
+		self._path = path
+		self._done = set()
+		if resume and not restart and os.path.exists(path):
+			with open(path) as f:
+				self._done = set(line.rstrip('\n') for line in f if line.strip())
+		os.makedirs(os.path.dirname(os.path.abspath(path)),exist_ok=True)
+		self._file = open(path,'w' if restart else 'a')
+
+	def isDone(self,path):
+		return path in self._done
+
+	def add(self,path):
+		self._done.add(path)
+		self._file.write(path + '\n')
+		self._file.flush()
+
+	def close(self):
+		self._file.close()
+
+def _asRGB(frames):
+	"""
+	Yields (N,width,height,3) arrays, dropping alpha channels and repeating gray ones.
+	"""
+	for images in frames:
+		if images.shape[-1] == 1:
+			images = np.repeat(images,3,axis=-1)
+		yield images[...,:3]
+
+def _splitFrames(frames):
+	"""
+	Yields every (1,width,height,3) frame of a stream of (N,width,height,3) arrays.
+	"""
+	for images in frames:
+		for i in range(images.shape[0]):
+			yield images[i:i + 1]
+
+def _countFrames(frames,counter):
+	for frame in frames:
+		counter[0] += 1
+		yield frame
+
+def _inputFPS(path,default=24):
+	try:
+		with imageio.get_reader(path) as reader:
+			return reader.get_meta_data().get('fps',default) or default
+	except Exception:
+		return default
+
+def _partialPath(outputPath):
+	"""
+	Returns where an output is written until it is complete. It keeps the extension so imageio picks the same format.
+	"""
+	directory,name = os.path.split(outputPath)
+	stem,extension = os.path.splitext(name)
+	return os.path.join(directory,".{0}.partial{1}".format(stem,extension))
+
+def processFile(inputPath,outputPath,settings):
+	"""
+	Runs the pipeline over one input and writes its output. Returns the number of rendered frames.
+	outputPath is used as it is, so file names containing braces are not taken for templates.
+	settings: The parsed command-line arguments.
+	"""
+	if _isImage(inputPath):
+		images = ReadImage(inputPath)
+	else:
+		images = next(iter(ReadVideoOrGIF(inputPath,stream=True,batchSize=settings.batch_size)))
+	depthImages,colorImages = itertools.tee(_asRGB(images))
+	estimator = AWDepthEstimator(settings.model,minDepth=settings.min_depth,maxDepth=settings.max_depth,batchSize=settings.batch_size,resizeBackend='numpy',cache=settings.cache_dir)
+	clouds = depthImages >> estimator >> DepthToClouds() >> PaintClouds(_splitFrames(colorImages))
+	if settings.decimate is not None:
+		clouds = clouds >> DecimateClouds(method=settings.decimate)
+	if settings.posterize is not None:
+		clouds = clouds >> PosterizeDepth(levels=settings.posterize,method='kmeans1d',warmStart=not _isImage(inputPath))
+	counter = [0]
+	renders = _countFrames(clouds >> OffscreenCloudRender(settings.width,settings.height,settings.point_size,backend=settings.backend),counter)
+
+	os.makedirs(os.path.dirname(os.path.abspath(outputPath)),exist_ok=True)
+	partialPath = _partialPath(outputPath)
+	try:
+		if _isImage(inputPath):
+			renders >> SaveImage(partialPath)
+		elif outputPath.endswith('.gif'):
+			renders >> SaveGIF(partialPath,singleSequence=True)
+		else:
+			renders >> SaveVideo(partialPath,fps=settings.fps or _inputFPS(inputPath),singleSequence=True,macro_block_size=1)
+		os.replace(partialPath,outputPath)
+	finally:
+		if os.path.exists(partialPath):
+			os.remove(partialPath)
+	return counter[0]
+
+def _timedProcessFile(inputPath,outputPath,settings):
+	start = time.perf_counter()
+	frames = processFile(inputPath,outputPath,settings)
+	return frames,time.perf_counter() - start
+
+def buildParser():
+	parser = argparse.ArgumentParser(prog="python -m cloudmosh.cli",description="Render depth-estimated point clouds of a batch of images, GIFs and videos.")
+	parser.add_argument("inputs",nargs="+",help="Input files, directories or glob patterns (quote them so the shell does not expand them).")
+	parser.add_argument("-o","--output",required=True,help="The directory to write the outputs to.")
+	parser.add_argument("-m","--model",required=True,help="The depth model file (e.g. data/nyu.h5).")
+	parser.add_argument("-r","--recursive",action="store_true",help="Also look for inputs in the subdirectories of input directories.")
+	parser.add_argument("-w","--workers",type=int,default=0,help="Process this many inputs at once in worker processes (default 0: one at a time, in this process).")
+	parser.add_argument("-b","--batch-size",type=int,default=2,help="How many frames the depth model processes at once (default 2).")
+	parser.add_argument("--cache-dir",default=None,help="Keep depth predictions in this directory and reuse them for frames seen before.")
+	parser.add_argument("--checkpoint",default=None,help="The file that finished inputs are recorded in (default OUTPUT/{0}).".format(DEFAULT_CHECKPOINT))
+	checkpoint = parser.add_mutually_exclusive_group()
+	checkpoint.add_argument("--resume",action="store_true",help="Skip the inputs recorded in the checkpoint file by an earlier run.")
+	checkpoint.add_argument("--restart",action="store_true",help="Empty the checkpoint file before starting, forgetting the inputs recorded in it.")
+	parser.add_argument("--overwrite",action="store_true",help="Process inputs whose outputs already exist instead of skipping them.")
+	parser.add_argument("--min-depth",type=float,default=10,help="The minimum depth the model may assign a pixel (default 10).")
+	parser.add_argument("--max-depth",type=float,default=1000,help="The maximum depth the model may assign a pixel (default 1000).")
+	parser.add_argument("--decimate",choices=DecimateClouds.METHODS,default=None,help="Reduce the number of points with this method before rendering.")
+	parser.add_argument("--posterize",type=int,default=None,metavar="LEVELS",help="Posterize the depth of each cloud into this many levels.")
+	parser.add_argument("--width",type=int,default=640,help="The width of the rendered frames (default 640).")
+	parser.add_argument("--height",type=int,default=480,help="The height of the rendered frames (default 480).")
+	parser.add_argument("--point-size",type=float,default=9.0,help="The size of each point in pixels (default 9).")
+	parser.add_argument("--backend",choices=OffscreenCloudRender.BACKENDS,default='opengl',help="How clouds are rendered (default opengl).")
+	parser.add_argument("--fps",type=float,default=None,help="The frame rate of video outputs (default: that of the input, or 24).")
+	parser.add_argument("-q","--quiet",action="store_true",help="Only report errors.")
+	return parser
+
+def _sameOutputs(inputs,outputDirectory):
+	"""
+	Returns {outputPath: inputPaths} for every output path that more than one of the inputs would be written to.
+	"""
+	outputs = {}
+	for inputPath,relativePath in inputs:
+		outputs.setdefault(os.path.normpath(outputPathOf(relativePath,outputDirectory)),[]).append(inputPath)
+	return {outputPath: inputPaths for outputPath,inputPaths in outputs.items() if len(inputPaths) > 1}
+
+def main(arguments=None):
+	settings = buildParser().parse_args(arguments)
+	logging.basicConfig(level=logging.WARNING if settings.quiet else logging.INFO,format="%(message)s")
+
+	inputs = findInputs(settings.inputs,settings.recursive)
+	sameOutputs = _sameOutputs(inputs,settings.output)
+	if len(sameOutputs) > 0:
+		for outputPath,inputPaths in sorted(sameOutputs.items()):
+			logger.error("%s would be written by more than one input: %s",outputPath,", ".join(inputPaths))
+		logger.error("Nothing was processed: rename these inputs, or process them in separate runs.")
+		return 1
+	checkpoint = Checkpoint(settings.checkpoint or os.path.join(settings.output,DEFAULT_CHECKPOINT),resume=settings.resume,restart=settings.restart)
+	jobs = []
+	skipped = 0
+	for inputPath,relativePath in inputs:
+		outputPath = outputPathOf(relativePath,settings.output)
+		if checkpoint.isDone(inputPath) or (not settings.overwrite and os.path.exists(outputPath)):
+			skipped += 1
+			continue
+		jobs.append((inputPath,outputPath))
+	logger.info("%d inputs: %d to process, %d skipped.",len(inputs),len(jobs),skipped)
+
+	start = time.perf_counter()
+	totalFrames = 0
+	failed = 0
+	def finished(index,inputPath,outputPath,frames,seconds):
+		checkpoint.add(inputPath)
+		elapsed = time.perf_counter() - start
+		remaining = elapsed / index * (len(jobs) - index)
+		logger.info("[%d/%d] %s -> %s: %d frames in %.1f s (%.1f frames/s), %.0f s left",index,len(jobs),inputPath,outputPath,frames,seconds,frames / max(seconds,1e-9),remaining)
+
+	try:
+		if settings.workers > 0:
+			with ProcessPoolExecutor(max_workers=settings.workers) as executor:
+				futures = {executor.submit(_timedProcessFile,inputPath,outputPath,settings): (inputPath,outputPath) for inputPath,outputPath in jobs}
+				for index,future in enumerate(as_completed(futures),1):
+					inputPath,outputPath = futures[future]
+					try:
+						frames,seconds = future.result()
+					except Exception:
+						failed += 1
+						logger.exception("[%d/%d] %s failed.",index,len(jobs),inputPath)
+						continue
+					totalFrames += frames
+					finished(index,inputPath,outputPath,frames,seconds)
+		else:
+			for index,(inputPath,outputPath) in enumerate(jobs,1):
+				try:
+					frames,seconds = _timedProcessFile(inputPath,outputPath,settings)
+				except Exception:
+					failed += 1
+					logger.exception("[%d/%d] %s failed.",index,len(jobs),inputPath)
+					continue
+				totalFrames += frames
+				finished(index,inputPath,outputPath,frames,seconds)
+	finally:
+		checkpoint.close()
+
+	elapsed = time.perf_counter() - start
+	logger.info("Processed %d inputs (%d frames) in %.1f s, %.1f frames/s. %d skipped, %d failed.",len(jobs) - failed,totalFrames,elapsed,totalFrames / max(elapsed,1e-9),skipped,failed)
+	return 1 if failed > 0 else 0
+
+if __name__ == "__main__":
+	sys.exit(main())
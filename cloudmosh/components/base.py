@@ -1,24 +1,287 @@
 from abc import ABC,abstractmethod
+import json
+import time
+import threading
+import functools
+import contextlib
+import tracemalloc
 
 from nutsflow.base import Nut, NutSink, NutSource, NutFunction
 
+#Instrumentation. Every CloudMoshNut, CloudMoshSink, CloudMoshSource, CloudMoshFunction and CloudMoshComponent
+#has its __rrshift__ (and, for sources, __iter__) wrapped when its class is defined. While profiling is
+#off, the wrapper only checks a global once each time a stage is connected, and the stage runs unchanged.
+#While it is on, the input and output of the stage are wrapped in iterators that time every item.
+
+_profile = None
+
+class StageStatistics:
+	"""
+	What one stage of a pipeline did while profiling was on. Times are in seconds.
+	"""
+	def __init__(self,name):
+		self.name = name
+		self.runs = 0 #How many times the stage was connected to an input.
+		self.wallTime = 0.0 #Time spent in the stage's own code, not waiting for its input.
+		self.inputWait = 0.0 #Time spent waiting for the stages before it to produce the next item.
+		self.itemsIn = 0
+		self.itemsOut = 0
+		self.bytesAllocated = 0 #Net bytes allocated by the stage's own code (only with traceMemory=True).
+
+	def toDict(self):
+		return {
+			'name': self.name,
+			'runs': self.runs,
+			'wallTime': self.wallTime,
+			'inputWait': self.inputWait,
+			'itemsIn': self.itemsIn,
+			'itemsOut': self.itemsOut,
+			'bytesAllocated': self.bytesAllocated,
+		}
+
+class Profile:
+	"""
+	The statistics of every stage that ran while profiling was on, in the order the stages were first seen.
+	Stages of the same class are told apart by a '#2', '#3'... suffix.
+	"""
+	def __init__(self,traceMemory=False):
+		self._traceMemory = traceMemory
+		self._startedTracing = False
+		self._stages = {}
+		self._names = {}
+		self._lock = threading.Lock()
+
+	def isTracingMemory(self):
+		return self._traceMemory
+
+	def _statistics(self,stage):
+		with self._lock:
+			key = id(stage)
+			if key not in self._stages:
+				name = type(stage).__name__
+				self._names[name] = self._names.get(name,0) + 1
+				if self._names[name] > 1:
+					name = "{0}#{1}".format(name,self._names[name])
+				#The stage is kept so that its id cannot be reused by another stage.
+				self._stages[key] = (stage,StageStatistics(name))
+			return self._stages[key][1]
+
+	def getStages(self):
+		"""
+		Returns a list of StageStatistics, one per stage.
+		"""
+		with self._lock:
+			return [statistics for _,statistics in self._stages.values()]
+
+	def toDict(self):
+		return {'stages': [statistics.toDict() for statistics in self.getStages()]}
+
+	def toJSON(self,indent=2):
+		return json.dumps(self.toDict(),indent=indent)
+
+	def saveJSON(self,path):
+		with open(path,'w') as f:
+			f.write(self.toJSON())
+
+	def summary(self):
+		"""
+		Returns the statistics as a text table, one row per stage.
+		"""
+		columns = ("Stage","Runs","Time (s)","Input wait (s)","Items in","Items out","ms/item","MB allocated")
+		rows = []
+		for statistics in self.getStages():
+			items = max(statistics.itemsOut,statistics.itemsIn)
+			rows.append((
+				statistics.name,
+				str(statistics.runs),
+				"{0:.3f}".format(statistics.wallTime),
+				"{0:.3f}".format(statistics.inputWait),
+				str(statistics.itemsIn),
+				str(statistics.itemsOut),
+				"{0:.2f}".format(1000 * statistics.wallTime / items) if items > 0 else "-",
+				"{0:.1f}".format(statistics.bytesAllocated / 1e6) if self._traceMemory else "-",
+			))
+		widths = [max(len(row[i]) for row in rows + [columns]) for i in range(len(columns))]
+		lines = ["  ".join(value.ljust(width) if i == 0 else value.rjust(width) for i,(value,width) in enumerate(zip(row,widths))) for row in [columns] + rows]
+		lines.insert(1,"-" * len(lines[0]))
+		return "\n".join(lines)
+
+def enableProfiling(traceMemory=False):
+	"""
+	Starts recording the statistics of every CloudMosh stage that is connected from now on, and returns
+	the Profile they are recorded in.
+	traceMemory (optional): Also record the bytes each stage allocates, with tracemalloc. This makes
+	everything else slower. Default False.
+	"""
+	global _profile
+	disableProfiling()
+	profile = Profile(traceMemory)
+	if traceMemory and not tracemalloc.is_tracing():
+		tracemalloc.start()
+		profile._startedTracing = True
+	_profile = profile
+	return profile
+
+def disableProfiling():
+	"""
+	Stops recording and returns the Profile that was being recorded (or None).
+	"""
+	global _profile
+	profile = _profile
+	_profile = None
+	if profile is not None and profile._startedTracing:
+		tracemalloc.stop()
+	return profile
+
+def getProfile():
+	"""
+	Returns the Profile being recorded, or None if profiling is off.
+	"""
+	return _profile
+
+@contextlib.contextmanager
+def profiling(traceMemory=False):
+	"""
+	Records a Profile of the stages that run inside the with block:
+	with profiling() as profile:
+		ReadImage(...) >> ... >> SaveImage(...)
+	print(profile.summary())
+	"""
+	profile = enableProfiling(traceMemory)
+	try:
+		yield profile
+	finally:
+		if _profile is profile:
+			disableProfiling()
+
+def _tracedMemory(profile):
+	return tracemalloc.get_traced_memory()[0] if profile.isTracingMemory() else 0
+
+class _InstrumentedInput:
+	"""
+	Wraps the input of a stage and records how long the stage waits for each item.
+	"""
+	def __init__(self,iterable,statistics,profile):
+		self._iterable = iterable
+		self._iterator = None
+		self._statistics = statistics
+		self._profile = profile
+		self.wait = 0.0
+		self.memory = 0
+
+	def __iter__(self):
+		return self
+
+	def __next__(self):
+		start = time.perf_counter()
+		memory = _tracedMemory(self._profile)
+		try:
+			if self._iterator is None:
+				self._iterator = iter(self._iterable)
+			item = next(self._iterator)
+			self._statistics.itemsIn += 1
+			return item
+		finally:
+			elapsed = time.perf_counter() - start
+			self.wait += elapsed
+			self.memory += _tracedMemory(self._profile) - memory
+			self._statistics.inputWait += elapsed
+
+class _InstrumentedOutput:
+	"""
+	Wraps the output of a stage and records the time it spends producing each item, minus the time it
+	spends waiting for its input.
+	"""
+	def __init__(self,iterator,statistics,profile,instrumentedInput=None):
+		self._iterator = iterator
+		self._statistics = statistics
+		self._profile = profile
+		self._input = instrumentedInput
+
+	def __iter__(self):
+		return self
+
+	def __next__(self):
+		start = time.perf_counter()
+		memory = _tracedMemory(self._profile)
+		wait = self._input.wait if self._input is not None else 0.0
+		inputMemory = self._input.memory if self._input is not None else 0
+		try:
+			item = next(self._iterator)
+			self._statistics.itemsOut += 1
+			return item
+		finally:
+			elapsed = time.perf_counter() - start
+			if self._input is not None:
+				elapsed -= self._input.wait - wait
+			self._statistics.wallTime += elapsed
+			if self._profile.isTracingMemory():
+				allocated = _tracedMemory(self._profile) - memory
+				if self._input is not None:
+					allocated -= self._input.memory - inputMemory
+				self._statistics.bytesAllocated += allocated
+
+def _instrumentRRShift(method):
+	@functools.wraps(method)
+	def instrumented(self,iterable):
+		profile = _profile
+		#When a subclass calls an instrumented super().__rrshift__, only the subclass's call is recorded.
+		if profile is None or type(self).__rrshift__ is not instrumented:
+			return method(self,iterable)
+		statistics = profile._statistics(self)
+		statistics.runs += 1
+		instrumentedInput = _InstrumentedInput(iterable,statistics,profile)
+		start = time.perf_counter()
+		memory = _tracedMemory(profile)
+		result = method(self,instrumentedInput)
+		#The time it took to connect the stage; for sinks, which consume their input right away, this is
+		#all of the time they take.
+		statistics.wallTime += time.perf_counter() - start - instrumentedInput.wait
+		if profile.isTracingMemory():
+			statistics.bytesAllocated += _tracedMemory(profile) - memory - instrumentedInput.memory
+		if hasattr(result,'__next__'):
+			return _InstrumentedOutput(result,statistics,profile,instrumentedInput)
+		return result
+	instrumented._instrumented = True
+	return instrumented
+
+def _instrumentIter(method):
+	@functools.wraps(method)
+	def instrumented(self):
+		profile = _profile
+		if profile is None or type(self).__iter__ is not instrumented:
+			return method(self)
+		statistics = profile._statistics(self)
+		statistics.runs += 1
+		return _InstrumentedOutput(method(self),statistics,profile)
+	instrumented._instrumented = True
+	return instrumented
+
+def _instrumentClass(cls,source=False):
+	if not getattr(cls.__rrshift__,'_instrumented',False):
+		cls.__rrshift__ = _instrumentRRShift(cls.__rrshift__)
+	if source and not getattr(cls.__iter__,'_instrumented',False):
+		cls.__iter__ = _instrumentIter(cls.__iter__)
+
 class CloudMoshMixIn:
-	pass
-	
+	def __init_subclass__(cls,**kwargs):
+		super().__init_subclass__(**kwargs)
+		_instrumentClass(cls,source=issubclass(cls,NutSource))
+
 class CloudMoshNut(Nut,CloudMoshMixIn):
 	pass
 
 class CloudMoshSink(NutSink,CloudMoshMixIn):
 	pass
-	
+
 class CloudMoshSource(NutSource,CloudMoshMixIn):
 	pass
-	
+
 class CloudMoshFunction(NutFunction,CloudMoshMixIn):
 	pass
 
 
-	
+
 
 class CloudMoshComponent(ABC):
 	def __init__(self):
@@ -27,7 +290,12 @@ class CloudMoshComponent(ABC):
 		#the parameters of a component.
 		#"""
 		super().__init__()
-	
+
+	def __init_subclass__(cls,**kwargs):
+		super().__init_subclass__(**kwargs)
+		if '__rrshift__' in cls.__dict__:
+			_instrumentClass(cls)
+
 	@abstractmethod
 	def __rrshift__(self,data):
 		"""
@@ -39,4 +307,4 @@ class CloudMoshComponent(ABC):
 		which is equivalent to writing:
 		componentC.__rshift__(componentB.__rshift__(componentA.__rshift__(originalInput)))
 		"""
-		pass
\ No newline at end of file
+		pass
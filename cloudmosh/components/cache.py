@@ -0,0 +1,161 @@
+import os
+import hashlib
+import threading
+import numpy as np
+
+#Maps (path,size,mtime) of a file to the SHA-1 of its contents, so each model file is only hashed once per process.
+_fileDigests = {}
+
+def fileDigest(path):
+	"""
+	Returns the SHA-1 hex digest of a file's contents. The result is remembered until the file changes.
+	"""
+	stat = os.stat(path)
+	key = (os.path.abspath(path),stat.st_size,stat.st_mtime_ns)
+	if key not in _fileDigests:
+		digest = hashlib.sha1()
+		with open(path,'rb') as f:
+			for chunk in iter(lambda: f.read(1 << 20),b''):
+				digest.update(chunk)
+		_fileDigests[key] = digest.hexdigest()
+	return _fileDigests[key]
+
+def arrayDigest(array,*parameters):
+	"""
+	Returns a hex digest of an array's shape, dtype and contents, plus any extra parameters (by repr).
+	"""
+	array = np.ascontiguousarray(array)
+	digest = hashlib.sha1()
+	digest.update(repr((array.shape,array.dtype.str,parameters)).encode('utf-8'))
+	digest.update(memoryview(array).cast('B'))
+	return digest.hexdigest()
+
+class PredictionCache:
+	"""
+	A content-addressed, on-disk cache of arrays (e.g. depth predictions). Each entry is one .npy file
+	(or one compressed .npz file) named after its key. When the directory grows past maxBytes, the least
+	recently used entries are deleted. Reads and writes are safe to share between threads.
+	"""
+	def __init__(self,directory,maxBytes=None,compress=False,mmap=True):
+		"""
+		directory: Where the entries are stored. It is created if it does not exist.
+		maxBytes (optional): The most bytes the entries may take up on disk. Default None (no limit).
+		compress (optional): Store entries as compressed .npz files. Default False.
+		mmap (optional): Memory-map uncompressed entries instead of reading them into memory. The arrays are
+		copy-on-write, so changing them does not change the cache. Default True.
+		"""
+		self._directory = directory
+		self._maxBytes = maxBytes
+		self._compress = compress
+		self._mmap = mmap
+		self._extension = '.npz' if compress else '.npy'
+		self._hits = 0
+		self._misses = 0
+		self._lock = threading.Lock()
+		os.makedirs(directory,exist_ok=True)
+		self._sizeOnDisk = sum(size for _,_,size in self._entries())
+
+	def __getstate__(self):
+		state = self.__dict__.copy()
+		del state['_lock']
+		return state
+
+	def __setstate__(self,state):
+		self.__dict__.update(state)
+		self._lock = threading.Lock()
+
+	def _entries(self):
+		"""
+		Returns (path,lastUsed,size) for every entry in the directory.
+		"""
+		entries = []
+		for name in os.listdir(self._directory):
+			if not (name.endswith('.npy') or name.endswith('.npz')):
+				continue
+			path = os.path.join(self._directory,name)
+			try:
+				stat = os.stat(path)
+			except FileNotFoundError:
+				continue #Evicted by another process.
+			entries.append((path,stat.st_mtime,stat.st_size))
+		return entries
+
+	def _path(self,key):
+		return os.path.join(self._directory,key + self._extension)
+
+	def getHits(self):
+		return self._hits
+
+	def getMisses(self):
+		return self._misses
+
+	def getSizeOnDisk(self):
+		return self._sizeOnDisk
+
+	def get(self,key):
+		"""
+		Returns the array stored under key, or None if there is none.
+		"""
+		path = self._path(key)
+		try:
+			if self._compress:
+				with np.load(path) as archive:
+					array = archive['array']
+			else:
+				array = np.load(path,mmap_mode='c' if self._mmap else None)
+			#The modification time doubles as the time of last use.
+			os.utime(path)
+		except FileNotFoundError:
+			with self._lock:
+				self._misses += 1
+			return None
+		with self._lock:
+			self._hits += 1
+		return array
+
+	def put(self,key,array):
+		"""
+		Stores array under key, then evicts the least recently used entries if the cache is too large.
+		"""
+		path = self._path(key)
+		temporaryPath = "{0}.{1}.{2}.tmp".format(path,os.getpid(),threading.get_ident())
+		with open(temporaryPath,'wb') as f:
+			if self._compress:
+				np.savez_compressed(f,array=array)
+			else:
+				np.save(f,array)
+		size = os.path.getsize(temporaryPath)
+		previousSize = os.path.getsize(path) if os.path.exists(path) else 0
+		os.replace(temporaryPath,path)
+		with self._lock:
+			self._sizeOnDisk += size - previousSize
+			if self._maxBytes is not None and self._sizeOnDisk > self._maxBytes:
+				self._evict(keep=path)
+
+	def _evict(self,keep):
+		entries = sorted(self._entries(),key=lambda entry: entry[1])
+		self._sizeOnDisk = sum(size for _,_,size in entries)
+		for path,_,size in entries:
+			if self._sizeOnDisk <= self._maxBytes:
+				break
+			if path == keep:
+				continue
+			try:
+				os.remove(path)
+			except FileNotFoundError:
+				pass
+			self._sizeOnDisk -= size
+
+	def clear(self):
+		"""
+		Deletes every entry and resets the hit and miss counters.
+		"""
+		with self._lock:
+			for path,_,_ in self._entries():
+				try:
+					os.remove(path)
+				except FileNotFoundError:
+					pass
+			self._sizeOnDisk = 0
+			self._hits = 0
+			self._misses = 0
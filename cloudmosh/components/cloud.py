@@ -1,8 +1,76 @@
-from cloudmosh.components.base import CloudMoshComponent
+from cloudmosh.components.base import CloudMoshComponent,CloudMoshNut
+import itertools
 import numpy as np
 from nutsflow.base import Nut
 import nutsflow
 
+#Maps a frame shape (width,height) to a cached, read-only (width*height,2) array of [row,column] indices.
+_indexGridCache = {}
+
+def getIndexGrid(width,height,cache=True):
+	"""
+	Returns the (row,column) coordinates of every pixel in a frame, in row-major order, as
+	an array of shape (width*height,2). This is the same ordering that a nested loop over
+	rows and then columns would produce.
+	width: The size of the first axis of the frame.
+	height: The size of the second axis of the frame.
+	cache (optional): If True, the grid is kept and reused for every frame of the same shape. Default True.
+	"""
+	key = (width,height)
+	grid = _indexGridCache.get(key) if cache else None
+	if grid is None:
+		rows,columns = np.indices((width,height))
+		grid = np.stack((rows.reshape(-1),columns.reshape(-1)),axis=1)
+		if cache:
+			grid.setflags(write=False)
+			_indexGridCache[key] = grid
+	return grid
+
+def clearIndexGridCache():
+	"""
+	Drops every cached index grid (see getIndexGrid).
+	"""
+	_indexGridCache.clear()
+
+def pointsFromDepthImage(depthImage,cache=True):
+	"""
+	Converts a depth image into an array of points without looping over the pixels in Python.
+	depthImage: a numpy array of shape (width,height,1).
+	cache (optional): Whether to reuse a cached index grid for this frame shape. Default True.
+	Returns an array of shape (width*height,[x,y,z]) where x and y are the row and column of
+	the pixel and z is its depth.
+	"""
+	width,height = depthImage.shape[0],depthImage.shape[1]
+	grid = getIndexGrid(width,height,cache=cache)
+	points = np.empty((width*height,3),dtype=np.result_type(np.int64,depthImage.dtype))
+	points[:,:2] = grid
+	points[:,2] = depthImage[:,:,0].reshape(-1)
+	return points
+
+def pointsFromDepthImages(depthData,cache=True):
+	"""
+	The batched form of pointsFromDepthImage.
+	depthData: a numpy array of shape (N,width,height,1).
+	cache (optional): Whether to reuse a cached index grid for this frame shape. Default True.
+	Returns an array of shape (N,width*height,[x,y,z]).
+	"""
+	frames,width,height = depthData.shape[0],depthData.shape[1],depthData.shape[2]
+	grid = getIndexGrid(width,height,cache=cache)
+	points = np.empty((frames,width*height,3),dtype=np.result_type(np.int64,depthData.dtype))
+	points[:,:,:2] = grid
+	points[:,:,2] = depthData[:,:,:,0].reshape((frames,width*height))
+	return points
+
+def _updateDepth(points,zValues):
+	"""
+	Writes zValues into points[...,2] and returns the points. They are only copied if their dtype
+	cannot hold the new values.
+	"""
+	if not np.can_cast(zValues.dtype,points.dtype,casting='same_kind'):
+		points = points.astype(np.result_type(points.dtype,zValues.dtype))
+	np.copyto(points[...,2],zValues,casting='same_kind')
+	return points
+
 class DepthCloud:
 	def __init__(self,depth):
 		"""
@@ -11,16 +79,27 @@ class DepthCloud:
 		
 		#(width,height,1) --> (width*height,[x,y,z])
 		if len(depth.shape) == 3:
-			points = np.array([ (row,column,depth[row][column][0]) for row in range(depth.shape[0]) for column in range(depth.shape[1])])
-			self._points = points
+			self._points = pointsFromDepthImage(depth)
+			self._frameShape = (depth.shape[0],depth.shape[1])
 		else:
 			#Already in point form.
 			self._points = depth
+			self._frameShape = None
 		self._colors = None
 		
 	def getPoints(self):
 		return self._points
 		
+	def getFrameShape(self):
+		"""
+		Returns the (width,height) of the depth image that the points are the pixels of, or None if the
+		points are not (or no longer) one per pixel in row-major order.
+		"""
+		return self._frameShape
+		
+	def setFrameShape(self,frameShape):
+		self._frameShape = None if frameShape is None else tuple(frameShape)
+		
 	def setPoints(self,points):
 		self._points = points
 		
@@ -28,126 +107,396 @@ class DepthCloud:
 		return self._colors
 		
 	def hasColors(self):
-		return self._colors != None
+		return self._colors is not None
 		
 	def setColors(self,colors):
 		self._colors = colors
 
 	def setDepthByImage(self,depthImage):
-		points = np.array([ (row,column,depthImage[row][column][0]) for row in range(depthImage.shape[0]) for column in range(depthImage.shape[1])])
-		self._points = points
+		self._points = pointsFromDepthImage(depthImage)
+		self._frameShape = (depthImage.shape[0],depthImage.shape[1])
+		
+	def updateDepthByImage(self,depthImage):
+		"""
+		depthImage: A numpy array of (width,height,1) on the same pixel grid as the cloud.
+		Writes the depths into the z-column of the existing points, leaving x and y as they are, instead of
+		building a new array of points. The points are only reallocated if their dtype cannot hold the
+		depths (e.g. integer points and float depths), after which they can be updated in place again.
+		"""
+		self._points = _updateDepth(self._points,depthImage.reshape(self._points.shape[:-1]))
 		
 	def setColorsByImage(self,colorImage):
 		"""
 		colorImage: A numpy array of (width,height,3) that we will reshape as (width*height,[r,g,b]).
+		The colors keep the dtype of the image and, when the image is contiguous in memory, are a view
+		of its buffer rather than a copy. An alpha channel, if present, is dropped.
+		"""
+		if colorImage.shape[-1] > 3:
+			colorImage = colorImage[:,:,:3]
+		self._colors = colorImage.reshape((colorImage.shape[0]*colorImage.shape[1],3))
+
+
+class CloudBatch:
+	"""
+	N point clouds of the same size, stored as contiguous (N,P,3) position and color arrays
+	so that a stage can process every frame of a batch with a single NumPy operation.
+	Indexing or iterating over a batch gives per-frame DepthCloud objects that share its buffers.
+	"""
+	def __init__(self,depth):
+		"""
+		depth: a numpy array of shape (N,width,height,1) that we want to represent as N point clouds,
+		or an array of shape (N,P,3) that is already in point form.
+		"""
+		if len(depth.shape) == 4:
+			#(N,width,height,1) --> (N,width*height,[x,y,z])
+			self._points = pointsFromDepthImages(depth)
+			self._frameShape = (depth.shape[1],depth.shape[2])
+		else:
+			#Already in point form.
+			self._points = depth
+			self._frameShape = None
+		self._colors = None
+	
+	@classmethod
+	def fromClouds(cls,clouds):
 		"""
-		colors = np.array([ (colorImage[row][column][0],colorImage[row][column][1],colorImage[row][column][2]) for row in range(colorImage.shape[0]) for column in range(colorImage.shape[1])])
+		Stacks a sequence of equally-sized DepthCloud objects into a single batch.
+		"""
+		clouds = list(clouds)
+		batch = cls(np.stack([cloud.getPoints() for cloud in clouds]))
+		if all(cloud.hasColors() for cloud in clouds):
+			batch.setColors(np.stack([cloud.getColors() for cloud in clouds]))
+		if len(set(cloud.getFrameShape() for cloud in clouds)) == 1:
+			batch.setFrameShape(clouds[0].getFrameShape())
+		return batch
+		
+	def __len__(self):
+		return self._points.shape[0]
+		
+	def __getitem__(self,index):
+		cloud = DepthCloud(self._points[index])
+		cloud.setFrameShape(self._frameShape)
+		if self.hasColors():
+			cloud.setColors(self._colors[index])
+		return cloud
+		
+	def __iter__(self):
+		for i in range(len(self)):
+			yield self[i]
+		
+	def getPoints(self):
+		return self._points
+		
+	def setPoints(self,points):
+		self._points = points
+		
+	def getFrameShape(self):
+		"""
+		Returns the (width,height) shared by the frames, as in DepthCloud.getFrameShape.
+		"""
+		return self._frameShape
+		
+	def setFrameShape(self,frameShape):
+		self._frameShape = None if frameShape is None else tuple(frameShape)
+		
+	def getColors(self):
+		return self._colors
+		
+	def hasColors(self):
+		return self._colors is not None
+		
+	def setColors(self,colors):
 		self._colors = colors
 		
+	def setDepthByImages(self,depthData):
+		self._points = pointsFromDepthImages(depthData)
+		self._frameShape = (depthData.shape[1],depthData.shape[2])
+		
+	def updateDepthByImages(self,depthData):
+		"""
+		depthData: A numpy array of (N,width,height,1). The batched form of DepthCloud.updateDepthByImage.
+		"""
+		self._points = _updateDepth(self._points,depthData.reshape(self._points.shape[:-1]))
+		
+	def setColorsByImages(self,colorImages):
+		"""
+		colorImages: A numpy array of (N,width,height,3) that we will reshape as (N,width*height,[r,g,b]).
+		As with DepthCloud.setColorsByImage, the colors are a view of the images whenever possible.
+		"""
+		if colorImages.shape[-1] > 3:
+			colorImages = colorImages[:,:,:,:3]
+		shape = colorImages.shape
+		self._colors = colorImages.reshape((shape[0],shape[1]*shape[2],3))
 		
-class DepthToClouds(Nut):
-	def __init__(self):
+
+def iterateFrames(iterable):
+	"""
+	Yields the individual DepthCloud frames of a stream that may mix DepthCloud and CloudBatch objects.
+	"""
+	for element in iterable:
+		if isinstance(element,CloudBatch):
+			yield from element
+		else:
+			yield element
+
+
+class DepthToClouds(CloudMoshNut):
+	def __init__(self,batched=False):
+		"""
+		batched (optional): If True, each (N,width,height,1) input becomes one CloudBatch instead of
+		N separate DepthCloud objects. Default False.
+		"""
 		super().__init__()
+		self._batched = batched
 		
 	def __rrshift__(self,iterable):
 		"""
 		depthData.shape: (N,width,height,1)
 		"""
 		for depthData in iterable:
+			if self._batched:
+				yield CloudBatch(depthData)
+				continue
 			for i in range(depthData.shape[0]):
 				depthImage = depthData[i]
-				cloud = DepthCloud(depthImage)
-				print("DepthToClouds:",cloud)
-				yield cloud
+				yield DepthCloud(depthImage)
 				
-class PaintClouds(Nut):
+class PaintClouds(CloudMoshNut):
 	def __init__(self,images):
 		"""
 		images: An iterable of image objects where each image is of shape (1,width,height,3).
+		When painting CloudBatch objects, each image is of shape (N,width,height,3) instead.
 		"""
 		super().__init__()
 		self._images = images
 	
 	def __rrshift__(self,iterable):
 		"""
-		Expected arguments: an iterable of DepthCloud objects
-		"""
-		
-		#(cloud_0,image_0), ... (cloud_n,image_n)
-		#iterable = iterable >> nutsflow.Zip(self._images)
-		
-		clouds = iterable >> nutsflow.Collect()
-		images = self._images >> nutsflow.Collect()
+		Expected arguments: an iterable of DepthCloud or CloudBatch objects
 		
-		iterable = clouds >> nutsflow.Zip(images)
-		
-		print("PAINT CLOUDS: hello!")
-		for cloud,image in iterable:
-			image = image[0]
-			print("PAINT CLOUDS: cloud.points.shape == ",cloud.getPoints().shape)
-			print("PAINT CLOUDS: image.shape == ",image.shape)
+		Clouds and images are paired up lazily, (cloud_0,image_0), ... (cloud_n,image_n), so
+		only one of each is held at a time no matter how long the stream is.
+		"""
+		for cloud,image in zip(iterable,self._images):
+			if isinstance(cloud,CloudBatch):
+				cloud.setColorsByImages(image)
+				yield cloud
+				continue
+			if len(image.shape) == 4:
+				#(1,width,height,3) -> (width,height,3)
+				image = image[0]
 			cloud.setColorsByImage(image)
 			yield cloud
 
 
-class ChangeDepthOfClouds(Nut):
-	def __init__(self):
-		super().__init__()	
+class ChangeDepthOfClouds(CloudMoshNut):
+	def __init__(self,depths=None):
+		"""
+		depths (optional): An iterable of depth maps where each is of shape (1,width,height,1), or
+		(N,width,height,1) when changing the depth of CloudBatch objects. Default None, in which case the
+		input is expected to be [ clouds, depthData ] instead (see __rrshift__).
+		"""
+		super().__init__()
+		self._depths = depths
+	
+	def _changeDepth(self,cloud,depth):
+		if isinstance(cloud,CloudBatch):
+			cloud.updateDepthByImages(depth)
+		else:
+			if len(depth.shape) == 4:
+				#(1,width,height,1) -> (width,height,1)
+				depth = depth[0]
+			cloud.updateDepthByImage(depth)
+		return cloud
 	
 	def __rrshift__(self,iterable):
 		"""
-		Expected arguments: [ clouds, depthData ]
-		depthData.shape == (N,width,height,1)
-		len(clouds) == N
-		"""
-		clouds = iterable[0]
-		depthData = iterable[1]
+		Expected arguments: an iterable of DepthCloud or CloudBatch objects, which are paired up lazily
+		with the depth maps like PaintClouds pairs clouds with images. Without depths, the expected
+		arguments are [ clouds, depthData ] where depthData.shape == (N,width,height,1) and len(clouds) == N.
 		
-		for i in range(len(clouds)):
-			cloud = clouds[i]
-			depthImage = depthData[i]
-			cloud.setDepthByImage(depthImage)
+		Only the z-values of the points are written, in place, so the clouds must be on the same pixel grid
+		as the depth maps. Each cloud is yielded after its depth has changed.
+		"""
+		if self._depths is None:
+			clouds,depthData = iterable
+			pairs = zip(clouds,depthData)
+		else:
+			pairs = zip(iterable,self._depths)
+		for cloud,depth in pairs:
+			yield self._changeDepth(cloud,depth)
 
 
-			
 class InterpolateClouds(CloudMoshComponent):
-	def __init__(self,stepFunction,tStart,tStop,tStepSize):
+	def __init__(self,stepFunction,tStart,tStop,tStepSize,batched=False,reuseBuffers=False,zOnly=False):
 		"""
-		stepFunction: A real-valued function f(t) -> [0,1].
+		stepFunction: A real-valued function f(t) -> [0,1]. If it also accepts an array of t values (e.g. a
+		NumPy expression), it is called once on every t at the same time; otherwise it is called once per t.
 		tStart: The initial value of t.
 		tStop: The final value of t.
 		tStepSize: How much we should increment t at each time step.
+		batched (optional): Yield one CloudBatch holding all of the in-between frames of each pair of clouds,
+		computed with a single (T,P,3) operation, instead of one DepthCloud per frame. The colors keep the
+		dtype of the first cloud of the pair. This is always the case when the input contains CloudBatch
+		objects. Default False.
+		reuseBuffers (optional): Write every in-between frame into the same two point and color arrays, which
+		are allocated once, instead of allocating new ones. Each DepthCloud is then only valid until the next
+		one is produced, so the stage after this one must not hold on to it (rendering or saving is fine,
+		nutsflow.Collect is not). The colors keep the dtype of the first cloud of the pair. Default False.
+		zOnly (optional): Only interpolate the depth (z) of the points, and take their x and y from the
+		first cloud of each pair. This is correct for clouds made from depth images of the same size, whose
+		x and y never change. Combined with reuseBuffers, x and y are written once per pair of clouds and
+		only the depths for each frame. Default False.
 		"""
 		super().__init__()
 		self._stepFunction = stepFunction
 		self._tStart = tStart
 		self._tStop = tStop
 		self._tStepSize = tStepSize
+		self._batched = batched
+		self._reuseBuffers = reuseBuffers
+		self._zOnly = zOnly
 		
-	def __rrshift__(self,iterable):
+	def _timeSteps(self):
+		"""
+		Returns every value of t, from tStart up to and including tStop, that the interpolation visits.
+		"""
+		steps = []
+		tCurrent = self._tStart
+		while tCurrent <= self._tStop:
+			steps.append(tCurrent)
+			tCurrent += self._tStepSize
+		return steps
+		
+	def _stepValues(self):
+		"""
+		Returns f(t) for every time step as a float64 array.
+		"""
+		steps = self._timeSteps()
+		try:
+			values = np.asarray(self._stepFunction(np.array(steps,dtype=np.float64)),dtype=np.float64)
+			if values.shape == (len(steps),):
+				return values
+		except Exception:
+			pass #Not vectorized, e.g. it uses math functions or branches on t.
+		return np.array([self._stepFunction(t) for t in steps],dtype=np.float64)
+		
+	def _frameShape(self,cloudAtZero,cloudAtOne):
+		#The in-between points are only still one per pixel if both clouds were.
+		return cloudAtZero.getFrameShape() if cloudAtZero.getFrameShape() == cloudAtOne.getFrameShape() else None
+		
+	def _differences(self,cloudAtZero,cloudAtOne):
 		"""
-		Expected arguments: [cloud0,cloud1...cloudN]
+		Returns the start and the change (end - start) of the interpolated part of the points, and of the
+		colors (None when either cloud has no colors).
 		"""
-		for i in range(len(iterable)-1):
-			cloudAtZero = iterable[i]
-			cloudAtOne = iterable[i+1]
+		pointsStart = cloudAtZero.getPoints()
+		pointsEnd = cloudAtOne.getPoints()
+		if self._zOnly:
+			pointsStart = pointsStart[:,2]
+			pointsEnd = pointsEnd[:,2]
+		pointsChange = np.subtract(pointsEnd,pointsStart,dtype=np.result_type(pointsStart,pointsEnd,np.float64))
+		if not (cloudAtZero.hasColors() and cloudAtOne.hasColors()):
+			return pointsStart,pointsChange,None,None
+		colorsStart = cloudAtZero.getColors()
+		#8- and 16-bit colors are blended in float32, which holds them exactly and is faster.
+		smallIntegers = np.issubdtype(colorsStart.dtype,np.integer) and colorsStart.dtype.itemsize <= 2
+		colorsChange = np.subtract(cloudAtOne.getColors(),colorsStart,dtype=np.float32 if smallIntegers else np.float64)
+		return pointsStart,pointsChange,colorsStart,colorsChange
 		
-			tCurrent = self._tStart
-			coordinates = cloudAtZero.getPoints()[:,[0,1]] #The x and y positions of the points should stay the same.
+	def _keyframePairs(self,keyframes):
+		"""
+		Yields each pair of consecutive keyframes as soon as its second keyframe arrives, holding on to no
+		more than the last keyframe.
+		"""
+		cloudAtZero = None
+		for cloudAtOne in keyframes:
+			if cloudAtZero is not None:
+				yield cloudAtZero,cloudAtOne
+			cloudAtZero = cloudAtOne
 		
-			while tCurrent <= self._tStop:
-				ft = self._stepFunction(tCurrent)
+	def _interpolateBatches(self,keyframes):
+		"""
+		Treats the keyframes as consecutive and yields, for each pair of keyframes, one CloudBatch that
+		holds all of the in-between frames.
+		"""
+		ft = self._stepValues()
+		for cloudAtZero,cloudAtOne in self._keyframePairs(keyframes):
+			pointsStart,pointsChange,colorsStart,colorsChange = self._differences(cloudAtZero,cloudAtOne)
 			
-				currentDepth = (1 - ft) * cloudAtZero.getPoints() + ft * cloudAtOne.getPoints()
-				currentColors = (1 - ft) * cloudAtZero.getColors() + ft * cloudAtOne.getColors()
+			points = np.empty((len(ft),) + cloudAtZero.getPoints().shape,dtype=pointsChange.dtype)
+			if self._zOnly:
+				points[...] = cloudAtZero.getPoints() #A contiguous copy is faster than copying only x and y.
+				np.multiply(ft[:,None],pointsChange,out=points[:,:,2])
+				points[:,:,2] += pointsStart
+			else:
+				np.multiply(ft[:,None,None],pointsChange,out=points)
+				points += pointsStart
+			batch = CloudBatch(points)
+			batch.setFrameShape(self._frameShape(cloudAtZero,cloudAtOne))
 			
-				currentPoints = np.hstack((coordinates, currentDepth))
-				currentCloud = DepthCloud(currentDepth)
-				currentCloud.setColors(currentColors.astype(int))
-	
-				tCurrent += self._tStepSize
-				yield currentCloud
-				
+			if colorsChange is not None:
+				colors = ft.astype(colorsChange.dtype)[:,None,None] * colorsChange
+				colors += colorsStart
+				batch.setColors(colors.astype(colorsStart.dtype))
+			yield batch
+			
+	def _interpolateFrames(self,keyframes):
+		"""
+		Treats the keyframes as consecutive and yields every in-between frame as a DepthCloud.
+		"""
+		ft = self._stepValues()
+		pointsBuffer = colorsBuffer = colorsScratch = None
+		for cloudAtZero,cloudAtOne in self._keyframePairs(keyframes):
+			pointsStart,pointsChange,colorsStart,colorsChange = self._differences(cloudAtZero,cloudAtOne)
+			shape = cloudAtZero.getPoints().shape
+			frameShape = self._frameShape(cloudAtZero,cloudAtOne)
+			if self._reuseBuffers and (pointsBuffer is None or pointsBuffer.shape != shape or pointsBuffer.dtype != pointsChange.dtype):
+				pointsBuffer = np.empty(shape,dtype=pointsChange.dtype)
+			if self._reuseBuffers and colorsChange is not None and (colorsBuffer is None or colorsBuffer.shape != colorsStart.shape or colorsBuffer.dtype != colorsStart.dtype):
+				colorsBuffer = np.empty(colorsStart.shape,dtype=colorsStart.dtype)
+				colorsScratch = np.empty(colorsStart.shape,dtype=colorsChange.dtype)
 			
+			if self._reuseBuffers and self._zOnly:
+				pointsBuffer[...] = cloudAtZero.getPoints() #The x and y positions of the points stay the same.
+			for f in ft:
+				points = pointsBuffer if self._reuseBuffers else np.empty(shape,dtype=pointsChange.dtype)
+				if self._zOnly:
+					if not self._reuseBuffers:
+						points[...] = cloudAtZero.getPoints() #A contiguous copy is faster than copying only x and y.
+					np.multiply(pointsChange,f,out=points[:,2])
+					points[:,2] += pointsStart
+				else:
+					np.multiply(pointsChange,f,out=points)
+					points += pointsStart
+				currentCloud = DepthCloud(points)
+				currentCloud.setFrameShape(frameShape)
+				
+				if colorsChange is not None:
+					colors = colorsScratch if self._reuseBuffers else np.empty(colorsStart.shape,dtype=colorsChange.dtype)
+					np.multiply(colorsChange,colorsChange.dtype.type(f),out=colors)
+					colors += colorsStart
+					if self._reuseBuffers:
+						np.copyto(colorsBuffer,colors,casting='unsafe')
+						currentCloud.setColors(colorsBuffer)
+					else:
+						currentCloud.setColors(colors.astype(int))
+				yield currentCloud
 		
-		
\ No newline at end of file
+	def __rrshift__(self,iterable):
+		"""
+		Expected arguments: any iterable of clouds, cloud0,cloud1...cloudN, which may be an unbounded stream.
+		The in-between frames of cloud_i and cloud_i+1 are produced as soon as cloud_i+1 arrives, and only
+		the last cloud is kept, so memory use does not grow with the length of the stream.
+		The clouds may also be CloudBatch objects. If the stream starts with one, the output is one CloudBatch
+		of in-between frames for each pair of consecutive frames.
+		"""
+		iterator = iter(iterable)
+		first = next(iterator,None)
+		if first is None:
+			return
+		keyframes = iterateFrames(itertools.chain([first],iterator))
+		if self._batched or isinstance(first,CloudBatch):
+			yield from self._interpolateBatches(keyframes)
+		else:
+			yield from self._interpolateFrames(keyframes)
@@ -0,0 +1,380 @@
+import os
+import json
+import mmap
+import struct
+import zlib
+import numpy as np
+from cloudmosh.components.base import CloudMoshSink,CloudMoshSource
+from cloudmosh.components.cloud import DepthCloud,iterateFrames
+from cloudmosh.components.io import _OutputPaths
+
+#A cloud file holds a sequence of point clouds. It starts with a preamble (magic, version) and ends with a
+#JSON index of the frames followed by a trailer (the offset and length of the index, then the magic again),
+#so frames can be appended one at a time and any frame can be found without reading the others.
+#Each frame is stored as two columns: an (N,3) block of positions (float32 or float16) and, if the cloud has
+#colors, an (N,3) block of uint8 colors. Uncompressed blocks start on 64-byte boundaries so that they can be
+#memory-mapped as arrays; compressed blocks are zstd, lz4 or zlib streams.
+_MAGIC = b'CMCLOUD\0'
+_VERSION = 1
+_PREAMBLE = struct.Struct('<8sI4x')
+_TRAILER = struct.Struct('<QQ8s')
+_ALIGNMENT = 64
+
+POSITION_TYPES = ('float32','float16')
+COMPRESSIONS = (None,'zstd','lz4','zlib')
+
+def _codec(compression,level=None):
+	"""
+	Returns (compress,decompress) functions for a compression method. zstd and lz4 are optional
+	dependencies and are only imported when they are used.
+	"""
+	if compression == 'zlib':
+		return (lambda data: zlib.compress(data,6 if level is None else level)),zlib.decompress
+	if compression == 'zstd':
+		try:
+			import zstandard
+		except ImportError:
+			raise ImportError("Cloud files compressed with 'zstd' need the zstandard package (pip install zstandard).")
+		compressor = zstandard.ZstdCompressor(level=3 if level is None else level)
+		decompressor = zstandard.ZstdDecompressor()
+		return compressor.compress,decompressor.decompress
+	if compression == 'lz4':
+		try:
+			import lz4.frame
+		except ImportError:
+			raise ImportError("Cloud files compressed with 'lz4' need the lz4 package (pip install lz4).")
+		return (lambda data: lz4.frame.compress(data,compression_level=0 if level is None else level)),lz4.frame.decompress
+	raise ValueError("Cloud files do not support the compression '{0}' (expected one of {1}).".format(compression,", ".join(str(c) for c in COMPRESSIONS)))
+
+def _colorsAsBytes(colors):
+	"""
+	Returns RGB colors as uint8. The scale is chosen by dtype, as pyrender does: float colors go from 0 to 1
+	and integer colors from 0 to 255, whatever values a particular frame happens to hold.
+	"""
+	colors = np.asarray(colors)[:,:3]
+	if colors.dtype == np.uint8:
+		return colors
+	if np.issubdtype(colors.dtype,np.floating):
+		colors = np.clip(colors,0.0,1.0) * 255.0
+	return np.clip(np.rint(colors),0,255).astype(np.uint8)
+
+class CloudFileWriter:
+	"""
+	Writes point clouds to a cloud file one at a time. The file is written under a temporary name and only
+	appears under its own name when close() is called, so a file that exists is always complete.
+	"""
+	def __init__(self,path,positionType='float32',compression=None,level=None):
+		"""
+		path: The path of the file to write.
+		positionType (optional): 'float32' or 'float16'. float16 halves the size of the positions, but only
+		holds integers exactly up to 2048 and keeps about three significant digits. Default 'float32'.
+		compression (optional): None, 'zstd', 'lz4' or 'zlib'. Compressed frames are decompressed when they are
+		loaded instead of being memory-mapped. Default None.
+		level (optional): The compression level. Default None (the library's default).
+		"""
+		if positionType not in POSITION_TYPES:
+			raise ValueError("Cloud files do not support the position type '{0}' (expected one of {1}).".format(positionType,", ".join(POSITION_TYPES)))
+		self._compress = _codec(compression,level)[0] if compression is not None else None
+		self._compression = compression
+		self._positionType = np.dtype(positionType).newbyteorder('<')
+		self._path = path
+		self._temporaryPath = "{0}.{1}.tmp".format(path,os.getpid())
+		self._file = open(self._temporaryPath,'wb')
+		self._file.write(_PREAMBLE.pack(_MAGIC,_VERSION))
+		self._frames = []
+
+	def _writeBlock(self,array):
+		data = memoryview(np.ascontiguousarray(array)).cast('B')
+		if self._compress is not None:
+			data = self._compress(data)
+		else:
+			self._file.write(b'\0' * (-self._file.tell() % _ALIGNMENT))
+		offset = self._file.tell()
+		self._file.write(data)
+		return {'offset': offset, 'length': len(data)}
+
+	def write(self,cloud):
+		"""
+		Appends a DepthCloud to the file.
+		"""
+		points = cloud.getPoints()
+		frame = {'count': len(points), 'frameShape': cloud.getFrameShape()}
+		frame['positions'] = self._writeBlock(points.astype(self._positionType,copy=False))
+		if cloud.hasColors():
+			frame['colors'] = self._writeBlock(_colorsAsBytes(cloud.getColors()))
+		self._frames.append(frame)
+
+	def close(self):
+		"""
+		Writes the index and moves the file to its path.
+		"""
+		if self._file is None:
+			return
+		index = json.dumps({
+			'version': _VERSION,
+			'positionType': self._positionType.str,
+			'compression': self._compression,
+			'frames': self._frames,
+		}).encode('utf-8')
+		offset = self._file.tell()
+		self._file.write(index)
+		self._file.write(_TRAILER.pack(offset,len(index),_MAGIC))
+		self._file.close()
+		self._file = None
+		os.replace(self._temporaryPath,self._path)
+
+	def abort(self):
+		"""
+		Deletes the partly written file.
+		"""
+		if self._file is not None:
+			self._file.close()
+			self._file = None
+			os.remove(self._temporaryPath)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self,excType,excValue,traceback):
+		if excType is None:
+			self.close()
+		else:
+			self.abort()
+
+class CloudFile:
+	"""
+	Random access to the frames of a cloud file. Uncompressed frames are memory-mapped, so loading one
+	costs nothing until its points are read, and the arrays are copy-on-write: changing them does not
+	change the file.
+	"""
+	def __init__(self,path):
+		"""
+		path: The path of a file written by CloudFileWriter or SaveClouds.
+		"""
+		self._path = path
+		with open(path,'rb') as f:
+			self._mmap = mmap.mmap(f.fileno(),0,access=mmap.ACCESS_COPY)
+		magic,version = _PREAMBLE.unpack_from(self._mmap,0)
+		if magic != _MAGIC or len(self._mmap) < _PREAMBLE.size + _TRAILER.size:
+			raise IOError("{0} is not a cloud file.".format(path))
+		offset,length,magic = _TRAILER.unpack_from(self._mmap,len(self._mmap) - _TRAILER.size)
+		if magic != _MAGIC:
+			raise IOError("{0} is not a complete cloud file.".format(path))
+		if version > _VERSION:
+			raise IOError("{0} is a version {1} cloud file, which is newer than this version of cloudmosh supports.".format(path,version))
+		index = json.loads(bytes(self._mmap[offset:offset+length]).decode('utf-8'))
+		self._frames = index['frames']
+		self._positionType = np.dtype(index['positionType'])
+		self._compression = index['compression']
+		self._decompress = _codec(self._compression)[1] if self._compression is not None else None
+
+	def __len__(self):
+		return len(self._frames)
+
+	def getFrameShape(self,index):
+		frameShape = self._frames[index]['frameShape']
+		return None if frameShape is None else tuple(frameShape)
+
+	def _readBlock(self,block,dtype,count):
+		if self._decompress is None:
+			return np.frombuffer(self._mmap,dtype=dtype,count=count*3,offset=block['offset']).reshape((count,3))
+		data = self._decompress(self._mmap[block['offset']:block['offset']+block['length']])
+		return np.frombuffer(bytearray(data),dtype=dtype).reshape((count,3))
+
+	def __getitem__(self,index):
+		"""
+		Returns frame index as a DepthCloud. Negative indices count from the end.
+		"""
+		frame = self._frames[index]
+		cloud = DepthCloud(self._readBlock(frame['positions'],self._positionType,frame['count']))
+		cloud.setFrameShape(frame['frameShape'])
+		if 'colors' in frame:
+			cloud.setColors(self._readBlock(frame['colors'],np.uint8,frame['count']))
+		return cloud
+
+	def __iter__(self):
+		for i in range(len(self)):
+			yield self[i]
+
+	def close(self):
+		"""
+		Lets go of the file. Clouds that were already loaded stay valid.
+		"""
+		#The mapping cannot be closed while arrays still use it, so it is closed when the last of them is gone.
+		self._mmap = None
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self,excType,excValue,traceback):
+		self.close()
+
+class SaveClouds(CloudMoshSink):
+	"""
+	Saves a stream of point clouds to a single cloud file (see CloudFile).
+	"""
+	def __init__(self,path,positionType='float32',compression=None,level=None):
+		"""
+		path: The path of the file to write.
+		positionType (optional): 'float32' or 'float16'. Default 'float32'.
+		compression (optional): None, 'zstd', 'lz4' or 'zlib'. Default None.
+		level (optional): The compression level. Default None (the library's default).
+		See CloudFileWriter for details.
+		"""
+		self._path = path
+		self._options = {'positionType': positionType, 'compression': compression, 'level': level}
+
+	def __iter__(self):
+		"""
+		Like the base implementation of NutSink, SaveClouds will raise an exception
+		if the user tries to read output from it. We're overriding this method so that the exception
+		is generated within the cloudmosh codebase and not the dependency (nutsflow).
+		"""
+		raise SyntaxError("SaveClouds is a data sink and does not produce outputs to iterate over.")
+
+	def __rrshift__(self,iterable):
+		"""
+		Expected arguments: an iterable of DepthCloud or CloudBatch objects. Each frame is written as soon as
+		it arrives.
+		"""
+		with CloudFileWriter(self._path,**self._options) as writer:
+			for cloud in iterateFrames(iterable):
+				writer.write(cloud)
+
+class LoadClouds(CloudMoshSource):
+	"""
+	Reads the point clouds of one or more cloud files as DepthCloud objects.
+	"""
+	def __init__(self,*paths,frames=None):
+		"""
+		paths: One or more paths to files written by SaveClouds.
+		frames (optional): A slice or a list of frame indices to read from each file. Default None (every frame).
+		"""
+		self._paths = paths
+		self._frames = frames
+
+	def __rrshift__(self,iterable):
+		"""
+		Like the base implementation of NutSource, LoadClouds will raise an exception
+		if the user tries to right-shift input into it. We're overriding this method so that the exception
+		is generated within the cloudmosh codebase and not the dependency (nutsflow).
+		"""
+		raise SyntaxError("LoadClouds is a data source, '__ >> source' is an invalid operation.")
+
+	def __iter__(self):
+		for path in self._paths:
+			cloudFile = CloudFile(path)
+			if self._frames is None:
+				indices = range(len(cloudFile))
+			elif isinstance(self._frames,slice):
+				indices = range(len(cloudFile))[self._frames]
+			else:
+				indices = self._frames
+			for index in indices:
+				yield cloudFile[index]
+			cloudFile.close()
+
+def _pointRecords(cloud,fields):
+	"""
+	Packs the points (and colors) of a cloud into one record per point, as PLY and PCD store them.
+	"""
+	points = cloud.getPoints()
+	records = np.empty(len(points),dtype=fields)
+	records['x'] = points[:,0]
+	records['y'] = points[:,1]
+	records['z'] = points[:,2]
+	return records
+
+def writePLY(path,cloud):
+	"""
+	Writes a cloud as a binary little-endian PLY file, with uchar red, green and blue properties if the
+	cloud has colors.
+	"""
+	fields = [('x','<f4'),('y','<f4'),('z','<f4')]
+	properties = ["property float x","property float y","property float z"]
+	if cloud.hasColors():
+		fields += [('red','u1'),('green','u1'),('blue','u1')]
+		properties += ["property uchar red","property uchar green","property uchar blue"]
+	records = _pointRecords(cloud,fields)
+	if cloud.hasColors():
+		colors = _colorsAsBytes(cloud.getColors())
+		records['red'],records['green'],records['blue'] = colors[:,0],colors[:,1],colors[:,2]
+	header = "\n".join(["ply","format binary_little_endian 1.0","element vertex {0}".format(len(records))] + properties + ["end_header"]) + "\n"
+	with open(path,'wb') as f:
+		f.write(header.encode('ascii'))
+		f.write(records.tobytes())
+
+def writePCD(path,cloud):
+	"""
+	Writes a cloud as a binary PCD (Point Cloud Library) file. Colors are packed into the usual float
+	'rgb' field. A cloud with a frame shape is written as an organized cloud of that shape.
+	"""
+	fields = [('x','<f4'),('y','<f4'),('z','<f4')]
+	if cloud.hasColors():
+		fields += [('rgb','<u4')]
+	records = _pointRecords(cloud,fields)
+	if cloud.hasColors():
+		colors = _colorsAsBytes(cloud.getColors()).astype(np.uint32)
+		records['rgb'] = (colors[:,0] << 16) | (colors[:,1] << 8) | colors[:,2]
+	frameShape = cloud.getFrameShape()
+	#The points go row by row, so PCD's height is the first axis of the frame and its width the second.
+	height,width = frameShape if frameShape is not None else (1,len(records))
+	names = " ".join(name for name,_ in fields)
+	header = "\n".join([
+		"# .PCD v0.7 - Point Cloud Data file format",
+		"VERSION 0.7",
+		"FIELDS {0}".format(names),
+		"SIZE {0}".format(" ".join("4" for _ in fields)),
+		"TYPE {0}".format(" ".join("F" for _ in fields)),
+		"COUNT {0}".format(" ".join("1" for _ in fields)),
+		"WIDTH {0}".format(width),
+		"HEIGHT {0}".format(height),
+		"VIEWPOINT 0 0 0 1 0 0 0",
+		"POINTS {0}".format(len(records)),
+		"DATA binary",
+	]) + "\n"
+	with open(path,'wb') as f:
+		f.write(header.encode('ascii'))
+		f.write(records.tobytes())
+
+class _ExportClouds(CloudMoshSink):
+	"""
+	The shared implementation of SavePLY and SavePCD: one file per cloud.
+	"""
+	_name = None
+	_write = None
+
+	def __init__(self,*paths,template=False):
+		"""
+		paths: One path per cloud, or a single template like 'cloud_{:05d}.ply' that is formatted with the
+		index of each cloud (see template).
+		template (optional): Treat the path as a template for str.format. Otherwise every path is used as it
+		is, braces included. Default False.
+		"""
+		self._paths = paths
+		self._template = template
+
+	def __iter__(self):
+		raise SyntaxError("{0} is a data sink and does not produce outputs to iterate over.".format(self._name))
+
+	def __rrshift__(self,iterable):
+		paths = _OutputPaths(self._name,"clouds",self._paths,self._template)
+		count = 0
+		for cloud in iterateFrames(iterable):
+			type(self)._write(paths[count],cloud)
+			count += 1
+		paths.checkCount(count)
+
+class SavePLY(_ExportClouds):
+	"""
+	Saves each point cloud as a binary PLY file, for use in other point cloud tools.
+	"""
+	_name = "SavePLY"
+	_write = writePLY
+
+class SavePCD(_ExportClouds):
+	"""
+	Saves each point cloud as a binary PCD file, for use with the Point Cloud Library and similar tools.
+	"""
+	_name = "SavePCD"
+	_write = writePCD
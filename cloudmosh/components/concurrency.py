@@ -0,0 +1,248 @@
+import queue
+import pickle
+import threading
+import multiprocessing
+from nutsflow.base import NutSink, NutSource
+from cloudmosh.components.base import CloudMoshNut
+
+#The messages passed between the threads (or processes) of a Concurrent stage are (kind,value) pairs.
+_ITEM = 0 #value is the next item.
+_END = 1 #There are no more items.
+_ERROR = 2 #value is an exception to raise on the other side.
+_RESULT = 3 #value is what a sink returned.
+
+#How often, in seconds, a thread blocked on a full or empty queue checks whether it should stop.
+_POLL_INTERVAL = 0.1
+
+class _Cancelled(Exception):
+	"""
+	Raised inside a stage's input when the Concurrent stage is shut down before its input has ended.
+	"""
+	pass
+
+def _portableError(error):
+	"""
+	Returns error if it can be sent to another process, or a RuntimeError describing it if it cannot.
+	"""
+	try:
+		pickle.loads(pickle.dumps(error))
+		return error
+	except Exception:
+		return RuntimeError("{0}: {1}".format(type(error).__name__,error))
+
+class _Channel:
+	"""
+	A bounded queue of messages between two threads, or two processes. Blocking calls give up once stop is set,
+	so neither side can hang after the other has gone away. Between processes, messages are pickled by put
+	itself, so an item that cannot be sent raises there instead of being lost in the queue's feeder thread.
+	"""
+	def __init__(self,size,context=None):
+		self._processes = context is not None
+		self._queue = context.Queue(size) if self._processes else queue.Queue(size)
+
+	def put(self,message,stop):
+		"""
+		Returns False if stop was set before the message could be queued.
+		"""
+		if self._processes:
+			message = pickle.dumps(message,protocol=pickle.HIGHEST_PROTOCOL)
+		while not stop.is_set():
+			try:
+				self._queue.put(message,timeout=_POLL_INTERVAL)
+				return True
+			except queue.Full:
+				continue
+		return False
+
+	def get(self,stop,worker=None):
+		"""
+		Returns the next message, or None if stop was set first.
+		worker (optional): The thread or process that puts messages into the channel. If it exits without
+		sending _END or _ERROR (e.g. a process killed by the OS), an error message is returned. Default None.
+		"""
+		while not stop.is_set():
+			try:
+				message = self._queue.get(timeout=_POLL_INTERVAL)
+			except queue.Empty:
+				if worker is None or worker.is_alive():
+					continue
+				#The worker may have queued its last message just before exiting.
+				try:
+					message = self._queue.get(timeout=_POLL_INTERVAL)
+				except queue.Empty:
+					exitCode = getattr(worker,'exitcode',None)
+					return (_ERROR,RuntimeError("Concurrent stage worker exited unexpectedly (exit code {0}).".format(exitCode)))
+			return pickle.loads(message) if self._processes else message
+		return None
+
+	def abandon(self):
+		"""
+		Lets this process exit without waiting for messages nobody will read to be flushed into the queue.
+		"""
+		if self._processes:
+			self._queue.cancel_join_thread()
+
+class _ChannelInput:
+	"""
+	The input of a stage running in a worker: the items read from a channel until _END.
+	"""
+	def __init__(self,channel,stop):
+		self._channel = channel
+		self._stop = stop
+		self._ended = False
+
+	def __iter__(self):
+		return self
+
+	def __next__(self):
+		if self._ended:
+			raise StopIteration
+		message = self._channel.get(self._stop)
+		if message is None:
+			raise _Cancelled()
+		kind,value = message
+		if kind == _ITEM:
+			return value
+		self._ended = True
+		if kind == _ERROR:
+			raise value
+		raise StopIteration
+
+def _runStage(stage,kind,inputs,outputs,stop):
+	"""
+	Runs a stage in a worker thread or process, reading its input from inputs and sending what it produces
+	to outputs.
+	"""
+	results = None
+	try:
+		if kind == 'source':
+			results = iter(stage)
+		else:
+			results = _ChannelInput(inputs,stop) >> stage
+		if kind == 'sink':
+			outputs.put((_RESULT,results),stop)
+		else:
+			for item in results:
+				if not outputs.put((_ITEM,item),stop):
+					break
+		outputs.put((_END,None),stop)
+	except BaseException as error:
+		outputs.put((_ERROR,_portableError(error)),stop)
+	finally:
+		if stop.is_set():
+			if hasattr(results,'close'):
+				results.close()
+			outputs.abandon()
+
+def _feed(iterable,inputs,stop,portable):
+	"""
+	Sends the items of iterable to a stage's input channel, on a thread of the calling process.
+	"""
+	iterator = None
+	try:
+		iterator = iter(iterable)
+		for item in iterator:
+			if not inputs.put((_ITEM,item),stop):
+				break
+		else:
+			inputs.put((_END,None),stop)
+	except BaseException as error:
+		inputs.put((_ERROR,_portableError(error) if portable else error),stop)
+	finally:
+		#Stop the stages before this one (e.g. close their files) when the input is abandoned.
+		if hasattr(iterator,'close'):
+			iterator.close()
+
+class Concurrent(CloudMoshNut):
+	"""
+	Runs a stage on its own thread (or process), linked to the stages before and after it by bounded queues,
+	so that it works at the same time as they do. The stages before it run on a feeding thread, and the
+	stages after it on the calling thread. For example, decoding overlaps with inference in
+	Concurrent(ReadVideoOrGIF(path)) >> AWDepthEstimator(modelPath) >> ...
+	or, to also overlap inference with everything after it,
+	ReadVideoOrGIF(path) >> Concurrent(AWDepthEstimator(modelPath)) >> DepthToClouds() >> ...
+
+	When a stage gets ahead, it blocks once queueSize items are waiting for the next stage. An error in any
+	of the threads or processes is raised on the calling thread, and everything is shut down when the
+	output ends, when an error is raised, or when the output is abandoned (e.g. closed after a few items).
+	"""
+	def __init__(self,stage,processes=False,queueSize=4):
+		"""
+		stage: The stage to run. Any Nut, NutSink or NutSource (including CloudMosh components) works.
+		A source is iterated in the worker, and a sink's result is returned once its input has ended.
+		processes (optional): Run the stage in a worker process instead of a thread, e.g. for stages that
+		hold on to the GIL. The stage, its input and its output are pickled to send them between processes.
+		Default False.
+		queueSize (optional): How many items may wait in each queue. Default 4.
+		"""
+		super().__init__()
+		if isinstance(stage,NutSource):
+			self._kind = 'source'
+		elif isinstance(stage,NutSink):
+			self._kind = 'sink'
+		else:
+			self._kind = 'stage'
+		self._stage = stage
+		self._processes = processes
+		self._queueSize = queueSize
+
+	def getStage(self):
+		return self._stage
+
+	def __iter__(self):
+		if self._kind != 'source':
+			raise SyntaxError("Concurrent is only a data source when it runs one ({0} is not).".format(type(self._stage).__name__))
+		return self._run(None)
+
+	def __rshift__(self,stage):
+		#Python does not try the right operand's __rrshift__ when both operands are of the same type, so
+		#Concurrent(source) >> Concurrent(stage) has to be passed on from here.
+		if not isinstance(stage,Concurrent):
+			return NotImplemented
+		return stage.__rrshift__(self)
+
+	def __rrshift__(self,iterable):
+		if self._kind == 'source':
+			raise SyntaxError("Concurrent is running a data source, '__ >> source' is an invalid operation.")
+		if self._kind == 'sink':
+			result = None
+			for result in self._run(iterable):
+				pass
+			return result
+		return self._run(iterable)
+
+	def _run(self,iterable):
+		"""
+		Starts the worker (and, unless the stage is a source, the feeding thread) and yields the items (or the
+		sink's result) that the worker sends back until it ends.
+		"""
+		context = multiprocessing.get_context() if self._processes else None
+		stop = context.Event() if self._processes else threading.Event()
+		inputs = _Channel(self._queueSize,context) if self._kind != 'source' else None
+		outputs = _Channel(self._queueSize,context)
+		if self._processes:
+			worker = context.Process(target=_runStage,args=(self._stage,self._kind,inputs,outputs,stop),daemon=True)
+		else:
+			worker = threading.Thread(target=_runStage,args=(self._stage,self._kind,inputs,outputs,stop),daemon=True)
+		worker.start()
+		feeder = None
+		if inputs is not None:
+			feeder = threading.Thread(target=_feed,args=(iterable,inputs,stop,self._processes),daemon=True)
+			feeder.start()
+		try:
+			while True:
+				kind,value = outputs.get(stop,worker)
+				if kind == _END:
+					return
+				if kind == _ERROR:
+					raise value
+				yield value
+		finally:
+			stop.set()
+			if feeder is not None:
+				feeder.join()
+				inputs.abandon()
+			worker.join(timeout=None if not self._processes else 5)
+			if self._processes and worker.is_alive():
+				worker.terminate()
+				worker.join()
@@ -1,61 +1,118 @@
-from cloudmosh.components.base import CloudMoshComponent
+from cloudmosh.components.base import CloudMoshComponent,CloudMoshNut
 import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 # Keras / TensorFlow
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '5'
-from keras.models import load_model
-import skimage.io
-from skimage.transform import resize
-from keras.engine.topology import Layer, InputSpec
-import keras.utils.conv_utils as conv_utils
-import tensorflow as tf
-import keras.backend as K
 
 from nutsflow.base import Nut,NutSink, NutSource, NutFunction
+from cloudmosh.components.resize import Resizer
+from cloudmosh.components.cache import PredictionCache,arrayDigest,fileDigest
 
-class AWBilinearUpSampling2D(Layer):
-    """
-    This is a custom-defined layer needed by the Alhashim-Wonka network.
-    """
-    def __init__(self, size=(2, 2), data_format=None, **kwargs):
-        super(AWBilinearUpSampling2D, self).__init__(**kwargs)
-        self.data_format = K.normalize_data_format(data_format)
-        self.size = conv_utils.normalize_tuple(size, 2, 'size')
-        self.input_spec = InputSpec(ndim=4)
-
-    def compute_output_shape(self, input_shape):
-        if self.data_format == 'channels_first':
-            height = self.size[0] * input_shape[2] if input_shape[2] is not None else None
-            width = self.size[1] * input_shape[3] if input_shape[3] is not None else None
-            return (input_shape[0],
-                    input_shape[1],
-                    height,
-                    width)
-        elif self.data_format == 'channels_last':
-            height = self.size[0] * input_shape[1] if input_shape[1] is not None else None
-            width = self.size[1] * input_shape[2] if input_shape[2] is not None else None
-            return (input_shape[0],
-                    height,
-                    width,
-                    input_shape[3])
-
-    def call(self, inputs):
-        input_shape = K.shape(inputs)
-        if self.data_format == 'channels_first':
-            height = self.size[0] * input_shape[2] if input_shape[2] is not None else None
-            width = self.size[1] * input_shape[3] if input_shape[3] is not None else None
-        elif self.data_format == 'channels_last':
-            height = self.size[0] * input_shape[1] if input_shape[1] is not None else None
-            width = self.size[1] * input_shape[2] if input_shape[2] is not None else None
+#Keras, TensorFlow and skimage take seconds to import, so they are only imported when a model is first
+#loaded or an image is first resized with skimage. Importing this module is cheap.
+
+def _defineBilinearUpSampling2D():
+    from keras.engine.topology import Layer, InputSpec
+    import keras.utils.conv_utils as conv_utils
+    import tensorflow as tf
+    import keras.backend as K
+
+    class AWBilinearUpSampling2D(Layer):
+        """
+        This is a custom-defined layer needed by the Alhashim-Wonka network.
+        """
+        def __init__(self, size=(2, 2), data_format=None, **kwargs):
+            super(AWBilinearUpSampling2D, self).__init__(**kwargs)
+            self.data_format = K.normalize_data_format(data_format)
+            self.size = conv_utils.normalize_tuple(size, 2, 'size')
+            self.input_spec = InputSpec(ndim=4)
+
+        def compute_output_shape(self, input_shape):
+            if self.data_format == 'channels_first':
+                height = self.size[0] * input_shape[2] if input_shape[2] is not None else None
+                width = self.size[1] * input_shape[3] if input_shape[3] is not None else None
+                return (input_shape[0],
+                        input_shape[1],
+                        height,
+                        width)
+            elif self.data_format == 'channels_last':
+                height = self.size[0] * input_shape[1] if input_shape[1] is not None else None
+                width = self.size[1] * input_shape[2] if input_shape[2] is not None else None
+                return (input_shape[0],
+                        height,
+                        width,
+                        input_shape[3])
+
+        def call(self, inputs):
+            input_shape = K.shape(inputs)
+            if self.data_format == 'channels_first':
+                height = self.size[0] * input_shape[2] if input_shape[2] is not None else None
+                width = self.size[1] * input_shape[3] if input_shape[3] is not None else None
+            elif self.data_format == 'channels_last':
+                height = self.size[0] * input_shape[1] if input_shape[1] is not None else None
+                width = self.size[1] * input_shape[2] if input_shape[2] is not None else None
         
-        return tf.image.resize_images(inputs, [height, width], method=tf.image.ResizeMethod.BILINEAR, align_corners=True)
+            return tf.image.resize_images(inputs, [height, width], method=tf.image.ResizeMethod.BILINEAR, align_corners=True)
+
+        def get_config(self):
+            config = {'size': self.size, 'data_format': self.data_format}
+            base_config = super(AWBilinearUpSampling2D, self).get_config()
+            return dict(list(base_config.items()) + list(config.items()))
+
+    return AWBilinearUpSampling2D
+
+_bilinearUpSampling2D = None
 
-    def get_config(self):
-        config = {'size': self.size, 'data_format': self.data_format}
-        base_config = super(AWBilinearUpSampling2D, self).get_config()
-        return dict(list(base_config.items()) + list(config.items()))
+def __getattr__(name):
+	"""
+	Defines AWBilinearUpSampling2D (a Keras layer) the first time it is accessed.
+	"""
+	global _bilinearUpSampling2D
+	if name == 'AWBilinearUpSampling2D':
+		if _bilinearUpSampling2D is None:
+			_bilinearUpSampling2D = _defineBilinearUpSampling2D()
+		return _bilinearUpSampling2D
+	raise AttributeError("module {0!r} has no attribute {1!r}".format(__name__,name))
 
-class AWDepthEstimator(Nut):
+#Maps the absolute path of a model file to (model,graph), so that every estimator using the same file shares one loaded model.
+_modelRegistry = {}
+_modelRegistryLock = threading.Lock()
+
+def registerModel(modelPath,model,graph=None):
+	"""
+	Adds an already-loaded model to the registry, so estimators that use modelPath will use it instead of loading the file.
+	graph (optional): The TensorFlow graph the model belongs to, if predictions have to run inside it.
+	"""
+	with _modelRegistryLock:
+		_modelRegistry[os.path.abspath(modelPath)] = (model,graph)
+
+def getModel(modelPath):
+	"""
+	Returns (model,graph) for the model file at modelPath, loading it the first time it is asked for.
+	"""
+	key = os.path.abspath(modelPath)
+	with _modelRegistryLock:
+		if key not in _modelRegistry:
+			from keras.models import load_model
+			import tensorflow as tf
+			#Custom object needed for inference and training
+			custom_objects = {'BilinearUpSampling2D': __getattr__('AWBilinearUpSampling2D'), 'depth_loss_function': None}
+			model = load_model(modelPath, custom_objects=custom_objects, compile=False)
+			#Predictions made from other threads have to run against the graph the model was loaded into.
+			_modelRegistry[key] = (model,tf.get_default_graph())
+		return _modelRegistry[key]
+
+def clearModelRegistry():
+	"""
+	Drops every registered model. Estimators that have already loaded a model keep it.
+	"""
+	with _modelRegistryLock:
+		_modelRegistry.clear()
+
+class AWDepthEstimator(CloudMoshNut):
 	"""
 	Contains the code for the depth detection step, adapted
 	from https://github.com/ialhashim/DenseDepth, the repository
@@ -67,12 +124,23 @@ class AWDepthEstimator(Nut):
 	EXPECTED_IMAGE_WIDTH = 640
 	EXPECTED_IMAGE_HEIGHT = 480
 	
-	def __init__(self,modelPath,minDepth=10,maxDepth=1000,batchSize=2):
+	def __init__(self,modelPath,minDepth=10,maxDepth=1000,batchSize=2,pipelined=False,resizeBackend='skimage',interpolation='bilinear',cache=None):
 		"""
 		modelPath: The path to the model file that contains the trained network (e.g. 'data/nyu.h5').
 		minDepth (optional): The minimum depth that the network is allowed to assign a pixel. Default 10.
 		maxDepth (optional): The maximum depth that the network is allowed to assign a pixel. Default 1000.
 		batchSize (optional): How many images the network should process at once. Default 2.
+		pipelined (optional): If True, frames from consecutive inputs are gathered into full batches of batchSize
+		images, and each batch is predicted on a background thread while the next one is being preprocessed.
+		The predictions are split back up so that there is still one output per input. Default False.
+		resizeBackend (optional): How images are resized before and after inference. Default 'skimage'.
+			'skimage': skimage.transform.resize in float64 (the original behavior).
+			'numpy': a float32 NumPy resizer (see cloudmosh.components.resize) that reuses its buffers.
+		interpolation (optional): 'bilinear' or 'area', used by the 'numpy' backend. Default 'bilinear'.
+		Whatever the backend, images that already have the expected size are not resized.
+		cache (optional): A PredictionCache, or the path of a directory to keep one in. Predictions are stored under
+		a hash of the input pixels, the model file, minDepth, maxDepth, the network's input size and the resize
+		settings, and inputs that have been seen before skip inference entirely. Default None (no caching).
 		"""
 		super().__init__()
 		
@@ -80,11 +148,25 @@ class AWDepthEstimator(Nut):
 		self._minDepth = minDepth
 		self._maxDepth = maxDepth
 		self._batchSize = batchSize
+		self._pipelined = pipelined
+		self._resizeBackend = resizeBackend
+		self._interpolation = interpolation
+		if resizeBackend == 'skimage':
+			self._resizer = None
+		elif resizeBackend == 'numpy':
+			self._resizer = Resizer(interpolation)
+		else:
+			raise ValueError("AWDepthEstimator does not support the resize backend '{0}' (expected 'skimage' or 'numpy').".format(resizeBackend))
+		if isinstance(cache,str):
+			cache = PredictionCache(cache)
+		self._cache = cache
+		self._modelDigest = None
+		#Network inputs are written into these (one per input shape) when they don't have to outlive the next input.
+		self._inputBuffers = {}
 		
-		#Custom object needed for inference and training
-		custom_objects = {'BilinearUpSampling2D': AWBilinearUpSampling2D, 'depth_loss_function': None}
-		
-		self._model = load_model(self._depthModelPath, custom_objects=custom_objects, compile=False)
+		#The model is loaded (or taken from the registry) the first time it is needed. See getModel.
+		self._model = None
+		self._graph = None
 		
 		
 	def setMinDepth(self,minDepth):
@@ -96,53 +178,207 @@ class AWDepthEstimator(Nut):
 	def setBatchSize(self,batchSize):
 		self._batchSize = batchSize
 		
+	def setPipelined(self,pipelined):
+		self._pipelined = pipelined
+		
+	def getModel(self):
+		"""
+		Returns the network, loading it if this is the first time it has been needed.
+		"""
+		if self._model is None:
+			self._model,self._graph = getModel(self._depthModelPath)
+		return self._model
+		
+	def getCache(self):
+		return self._cache
+		
+	def __getstate__(self):
+		"""
+		Estimators are pickled without their model and buffers (e.g. to run one in a Concurrent worker process),
+		and load the model again the first time it is needed.
+		"""
+		state = self.__dict__.copy()
+		state['_model'] = None
+		state['_graph'] = None
+		state['_inputBuffers'] = {}
+		return state
+		
+	def __cacheKey(self,data):
+		"""
+		Returns the key under which the predictions for data are cached, or None if there is no cache.
+		"""
+		if self._cache is None:
+			return None
+		if self._modelDigest is None:
+			self._modelDigest = fileDigest(self._depthModelPath)
+		expectedSize = (AWDepthEstimator.EXPECTED_IMAGE_WIDTH,AWDepthEstimator.EXPECTED_IMAGE_HEIGHT)
+		return arrayDigest(data,self._modelDigest,self._minDepth,self._maxDepth,expectedSize,self._resizeBackend,self._interpolation)
+		
 	def __resize(self,images,width,height):
 		"""
 		width: The desired width of the resulting image(s).
 		height: The desired height of the resulting image(s).
 		"""
 		shape = (images.shape[0],width,height,images.shape[3])
-		return resize(images, shape, preserve_range=True, mode='reflect')
+		if images.shape == shape:
+			return images
+		if self._resizer is None:
+			from skimage.transform import resize
+			return resize(images, shape, preserve_range=True, mode='reflect')
+		return self._resizer(images,(width,height))
 		
 	def __depthNorm(self,x):
 		return self._maxDepth / x
 		
-	def __rrshift__(self,iterable):
-		for data in iterable:
-			if len(data.shape) == 3:
-				#(width,height,color)
-				originalWidth = data.shape[0]
-				originalHeight = data.shape[1]
-			else:
-				#(index,width,height,color)
-				originalWidth = data.shape[1]
-				originalHeight = data.shape[2]
+	def __getInputBuffer(self,shape):
+		if shape not in self._inputBuffers:
+			self._inputBuffers[shape] = np.empty(shape,dtype=np.float32)
+		return self._inputBuffers[shape]
 		
-			data = np.clip(data / 255, 0, 1)
-			
-			# Support multiple RGBs, one RGB image, even grayscale
-			if len(data.shape) < 3:
-				#If the image(s) are grayscale, we convert them to an RGB equivalent (v -> <v,v,v>).
-				data = np.stack((data,data,data), axis=2)
-			if len(data.shape) < 4:
-				data = data.reshape((1, data.shape[0], data.shape[1], data.shape[2]))
-			
-			if data.shape[-1] == 4:
-				#Drop the alpha component from RGBA. The network only cares about RGB.
-				#e.g. (1,640,480,4) -> (1,640,480,3)
-				data = data[:,:,:,:3]
+	def __preprocess(self,data,reuseBuffer=False):
+		"""
+		Converts one input (a single image or a stack of images) into the network's input format.
+		reuseBuffer (optional): With the 'numpy' resize backend, write the result into a buffer that is
+		overwritten by the next call. Only safe if the result is consumed before then. Default False.
+		Returns (images,originalWidth,originalHeight) where images has shape (N,640,480,3).
+		"""
+		if len(data.shape) == 3:
+			#(width,height,color)
+			originalWidth = data.shape[0]
+			originalHeight = data.shape[1]
+		else:
+			#(index,width,height,color)
+			originalWidth = data.shape[1]
+			originalHeight = data.shape[2]
+		
+		# Support multiple RGBs, one RGB image, even grayscale
+		if len(data.shape) < 3:
+			#If the image(s) are grayscale, we convert them to an RGB equivalent (v -> <v,v,v>).
+			data = np.stack((data,data,data), axis=2)
+		if len(data.shape) < 4:
+			data = data.reshape((1, data.shape[0], data.shape[1], data.shape[2]))
+		
+		if data.shape[-1] == 4:
+			#Drop the alpha component from RGBA. The network only cares about RGB.
+			#e.g. (1,640,480,4) -> (1,640,480,3)
+			data = data[:,:,:,:3]
 
+		#The network used by the Depth Detector expects images to be of size 640x480
+		expectedSize = (AWDepthEstimator.EXPECTED_IMAGE_WIDTH,AWDepthEstimator.EXPECTED_IMAGE_HEIGHT)
+		if self._resizer is None:
+			data = np.clip(data / 255, 0, 1)
+			data = self.__resize(data,width=expectedSize[0],height=expectedSize[1])
+		else:
+			#Resize the raw pixels straight into a float32 buffer, then normalize them in place.
+			shape = (data.shape[0],expectedSize[0],expectedSize[1],data.shape[3])
+			out = self.__getInputBuffer(shape) if reuseBuffer else np.empty(shape,dtype=np.float32)
+			data = self._resizer(data,expectedSize,out=out)
+			data *= np.float32(1 / 255)
+			np.clip(data, 0, 1, out=data)
+		return data,originalWidth,originalHeight
 		
-			#The network used by the Depth Detector expects images to be of size 640x480
-			data = self.__resize(data,width=AWDepthEstimator.EXPECTED_IMAGE_WIDTH,height=AWDepthEstimator.EXPECTED_IMAGE_HEIGHT)
+	def __predict(self,images):
+		"""
+		Runs the network on a stack of preprocessed images, inside the graph the model was loaded into (if any).
+		Both modes predict through here, whichever thread they predict on.
+		"""
+		model = self.getModel()
+		if self._graph is None:
+			return model.predict(images, batch_size=self._batchSize)
+		with self._graph.as_default():
+			return model.predict(images, batch_size=self._batchSize)
 		
-			# Compute predictions
-			predictions = self._model.predict(data, batch_size=self._batchSize)
-			# Put in expected range
-			predictions = np.clip(self.__depthNorm(predictions), self._minDepth, self._maxDepth)
-			#Resize to original width and height.
+	def __postprocess(self,predictions,originalWidth,originalHeight):
+		# Put in expected range
+		predictions = self.__depthNorm(predictions)
+		np.clip(predictions, self._minDepth, self._maxDepth, out=predictions)
+		#Resize to original width and height.
+		return self.__resize(predictions,width=originalWidth,height=originalHeight)
+		
+	def __pipelinedRRShift(self,iterable):
+		"""
+		The pipelined counterpart of __rrshift__ (see the pipelined constructor argument).
+		"""
+		#Inputs whose predictions have not all come back yet, in input order. Each record is
+		#[originalWidth, originalHeight, number of frames, number of frames predicted so far, list of prediction slices,
+		#cache key, finished predictions (only set up front for cache hits)].
+		records = deque()
+		#Batches submitted to the worker, as (future,segments) where segments lists the (record,count) each batch covers.
+		inFlight = deque()
+		pendingFrames = []
+		pendingSegments = []
+		pendingCount = 0
+		
+		def distribute(future,segments):
+			predictions = future.result()
+			offset = 0
+			for record,count in segments:
+				record[4].append(predictions[offset:offset+count])
+				record[3] += count
+				offset += count
+				
+		def completed():
+			while len(records) > 0 and records[0][3] == records[0][2]:
+				originalWidth,originalHeight,_,_,parts,key,predictions = records.popleft()
+				if predictions is None:
+					predictions = self.__postprocess(np.concatenate(parts),originalWidth,originalHeight)
+					if key is not None:
+						self._cache.put(key,predictions)
+				yield predictions
 		
-			predictions = self.__resize(predictions,width=originalWidth,height=originalHeight)
+		executor = ThreadPoolExecutor(max_workers=1)
+		try:
+			for data in iterable:
+				key = self.__cacheKey(data)
+				cached = self._cache.get(key) if key is not None else None
+				if cached is not None:
+					records.append([None,None,0,0,[],key,cached])
+					yield from completed()
+					continue
+				images,originalWidth,originalHeight = self.__preprocess(data)
+				record = [originalWidth,originalHeight,images.shape[0],0,[],key,None]
+				records.append(record)
+				offset = 0
+				while offset < images.shape[0]:
+					count = min(self._batchSize - pendingCount,images.shape[0] - offset)
+					pendingFrames.append(images[offset:offset+count])
+					pendingSegments.append((record,count))
+					pendingCount += count
+					offset += count
+					if pendingCount == self._batchSize:
+						inFlight.append((executor.submit(self.__predict,np.concatenate(pendingFrames)),pendingSegments))
+						pendingFrames,pendingSegments,pendingCount = [],[],0
+						#Keep a single batch running on the worker while we go back to preprocessing.
+						while len(inFlight) > 1:
+							distribute(*inFlight.popleft())
+							yield from completed()
+			if pendingCount > 0:
+				inFlight.append((executor.submit(self.__predict,np.concatenate(pendingFrames)),pendingSegments))
+			while len(inFlight) > 0:
+				distribute(*inFlight.popleft())
+				yield from completed()
+		finally:
+			executor.shutdown(wait=True)
 		
+	def __rrshift__(self,iterable):
+		if self._pipelined:
+			yield from self.__pipelinedRRShift(iterable)
+			return
+		for data in iterable:
+			key = self.__cacheKey(data)
+			if key is not None:
+				predictions = self._cache.get(key)
+				if predictions is not None:
+					yield predictions
+					continue
+			
+			#The model is done with the input before we preprocess the next one, so its buffer can be reused.
+			data,originalWidth,originalHeight = self.__preprocess(data,reuseBuffer=True)
+		
+			# Compute predictions
+			predictions = self.__predict(data)
+			
+			predictions = self.__postprocess(predictions,originalWidth,originalHeight)
+			if key is not None:
+				self._cache.put(key,predictions)
 			yield predictions
-		
\ No newline at end of file
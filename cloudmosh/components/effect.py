@@ -1,37 +1,397 @@
 from nutsflow.base import Nut,NutSink, NutSource, NutFunction
 from scipy.cluster.vq import vq, kmeans, whiten
 import numpy as np
+from cloudmosh.components.base import CloudMoshFunction
+from cloudmosh.components.cloud import CloudBatch,_updateDepth
 
-class PosterizeDepth(NutFunction):
+#Each quantizer takes a 1-D array of z-values and a number of levels and returns (boundaries,centroids),
+#where centroids is a sorted array of length <= levels and boundaries is a sorted array of length
+#len(centroids)-1. A value z is assigned to centroids[np.searchsorted(boundaries,z)].
+
+def _midpoints(centroids):
+	return (centroids[1:] + centroids[:-1]) / 2
+
+def _binMeans(zValues,levelIndices,levels,fallback):
+	"""
+	Returns the mean of the values assigned to each level. Empty levels get their fallback value.
+	"""
+	counts = np.bincount(levelIndices,minlength=levels)
+	sums = np.bincount(levelIndices,weights=zValues,minlength=levels)
+	means = np.array(fallback,dtype=np.float64)
+	nonEmpty = counts > 0
+	means[nonEmpty] = sums[nonEmpty] / counts[nonEmpty]
+	return means
+
+def _optimalPartition(values,weights,levels):
+	"""
+	Splits the sorted, weighted values into at most `levels` contiguous groups so that the total
+	weighted squared distance of each value to the mean of its group is as small as possible.
+	This is the exact solution to 1-D k-means (and to Jenks natural breaks), found by dynamic
+	programming over prefix sums. It takes O(levels * len(values)^2) time, so values should be
+	a histogram or a sample rather than a full point cloud.
+	Returns the index at which each group starts.
+	"""
+	n = len(values)
+	levels = min(levels,n)
+	W = np.concatenate(([0.0],np.cumsum(weights)))
+	S1 = np.concatenate(([0.0],np.cumsum(weights * values)))
+	S2 = np.concatenate(([0.0],np.cumsum(weights * values * values)))
+	#cost[i,j] is the squared error of the group values[i:j].
+	with np.errstate(divide='ignore',invalid='ignore'):
+		cost = (S2[None,:] - S2[:,None]) - (S1[None,:] - S1[:,None])**2 / (W[None,:] - W[:,None])
+	cost[np.tril_indices(n+1)] = np.inf
+	best = cost[0].copy() #best[j]: the error of values[:j] split into k groups, starting with k = 1
+	choices = []
+	for _ in range(1,levels):
+		candidates = best[:,None] + cost
+		choice = np.argmin(candidates,axis=0)
+		best = candidates[choice,np.arange(n+1)]
+		choices.append(choice)
+	starts = []
+	end = n
+	for choice in reversed(choices):
+		end = choice[end]
+		starts.append(end)
+	return np.array([0] + starts[::-1],dtype=np.intp)
+
+def _quantizeScipyKmeans(zValues,levels,**options):
+	"""
+	k-means on the whitened z-values using scipy. Randomly initialized and comparatively slow.
+	"""
+	whitenedValues = whiten(zValues)
+	centroids,distortion = kmeans(whitenedValues,levels)
+	centroids = np.sort(centroids) * np.std(zValues) #unwhiten the centroids
+	return _midpoints(centroids),centroids
+
+def _histogram(zValues,bins):
+	"""
+	Summarizes the z-values as the mean and the number of the values in each non-empty bin
+	of an equal-width histogram.
+	"""
+	low,high = zValues.min(),zValues.max()
+	width = (high - low) / bins if high > low else 1.0
+	binIndices = np.minimum(((zValues - low) / width).astype(np.intp),bins-1)
+	counts = np.bincount(binIndices,minlength=bins)
+	binCenters = low + width * (np.arange(bins) + 0.5)
+	binValues = _binMeans(zValues,binIndices,bins,binCenters)
+	nonEmpty = counts > 0
+	return binValues[nonEmpty],counts[nonEmpty].astype(np.float64)
+
+def _quantizeKmeans1D(zValues,levels,bins=256,**options):
+	"""
+	Optimal 1-D k-means, solved exactly on a histogram of the z-values.
+	"""
+	binValues,counts = _histogram(zValues,bins)
+	starts = _optimalPartition(binValues,counts,levels)
+	groupWeights = np.add.reduceat(counts,starts)
+	centroids = np.add.reduceat(counts * binValues,starts) / groupWeights
+	return _midpoints(centroids),centroids
+
+def _quantizeJenks(zValues,levels,sampleSize=1000,**options):
+	"""
+	Jenks natural breaks, computed exactly on an evenly spaced sample of the sorted z-values.
+	Unlike k-means, each boundary is the break between two classes (halfway between the last
+	sample of one class and the first sample of the next) rather than the midpoint between centroids.
+	"""
+	sortedValues = np.sort(zValues)
+	sampleIndices = np.unique(np.linspace(0,len(sortedValues)-1,min(sampleSize,len(sortedValues))).astype(np.intp))
+	sample = sortedValues[sampleIndices]
+	starts = _optimalPartition(sample,np.ones(len(sample)),levels)
+	boundaries = (sample[starts[1:] - 1] + sample[starts[1:]]) / 2
+	levelIndices = np.searchsorted(boundaries,zValues)
+	fallback = np.append(boundaries,sortedValues[-1])
+	return boundaries,_binMeans(zValues,levelIndices,len(starts),fallback)
+
+def _quantizeUniform(zValues,levels,**options):
+	"""
+	Equal-width bins between the smallest and largest z-value.
+	"""
+	edges = np.linspace(zValues.min(),zValues.max(),levels+1)
+	boundaries = edges[1:-1]
+	levelIndices = np.searchsorted(boundaries,zValues)
+	return boundaries,_binMeans(zValues,levelIndices,levels,_midpoints(edges))
+
+def _quantizeQuantile(zValues,levels,**options):
+	"""
+	Bins that each hold (roughly) the same number of points.
+	"""
+	edges = np.quantile(zValues,np.linspace(0,1,levels+1))
+	boundaries = edges[1:-1]
+	levelIndices = np.searchsorted(boundaries,zValues)
+	return boundaries,_binMeans(zValues,levelIndices,levels,_midpoints(edges))
+
+def _lloyd(binValues,counts,centroids,maxIterations):
+	"""
+	Refines sorted 1-D k-means centroids with at most maxIterations Lloyd iterations over a
+	histogram (see _histogram). Centroids that lose all of their points keep their previous value.
+	"""
+	for _ in range(maxIterations):
+		levelIndices = np.searchsorted(_midpoints(centroids),binValues)
+		levelCounts = np.bincount(levelIndices,weights=counts,minlength=len(centroids))
+		levelSums = np.bincount(levelIndices,weights=counts * binValues,minlength=len(centroids))
+		updated = centroids.copy()
+		nonEmpty = levelCounts > 0
+		updated[nonEmpty] = levelSums[nonEmpty] / levelCounts[nonEmpty]
+		updated.sort()
+		converged = np.array_equal(updated,centroids)
+		centroids = updated
+		if converged:
+			break
+	return centroids
+
+def _distortion(binValues,counts,boundaries,centroids):
+	"""
+	The mean squared distance of each value of a histogram to the centroid of its level.
+	"""
+	errors = binValues - centroids[np.searchsorted(boundaries,binValues)]
+	return np.sum(counts * errors * errors) / np.sum(counts)
+
+_QUANTIZERS = {
+	'kmeans': _quantizeScipyKmeans,
+	'kmeans1d': _quantizeKmeans1D,
+	'jenks': _quantizeJenks,
+	'uniform': _quantizeUniform,
+	'quantile': _quantizeQuantile,
+}
+
+class PosterizeDepth(CloudMoshFunction):
 	"""
 	Reduces the number of depth levels (distinct Z values) in a point cloud. This is analogous to
 	posterizing colors in 2D images.
+	
+	With warmStart=True the stage is stateful and meant for video: each frame's levels start from the
+	previous frame's and are refined with a few Lloyd iterations, which is cheaper than a full fit and
+	keeps the depth layers from flickering. A full fit is only done again when the distortion drifts
+	too far from that of the last full fit. Call reset() between unrelated clips.
 	"""
-	def __init__(self,levels=5,zPadding=None):
+	METHODS = tuple(_QUANTIZERS)
+	#The methods whose levels are k-means centroids, which the Lloyd iterations of a warm start refine.
+	WARM_START_METHODS = ('kmeans','kmeans1d')
+
+	def __init__(self,levels=5,zPadding=None,method='kmeans',bins=256,sampleSize=1000,warmStart=False,maxIterations=3,driftThreshold=0.25):
 		"""
 		levels: The number of intervals of z-values.
 		zPadding: Add this much distance in between each Z layer.
+		method (optional): How the levels are chosen. Default 'kmeans'.
+			'kmeans': k-means on the whitened z-values using scipy (the original behavior).
+			'kmeans1d': exact 1-D k-means on a histogram of the z-values. Much faster than 'kmeans'.
+			'jenks': Jenks natural breaks on a sample of the sorted z-values.
+			'uniform': equal-width intervals.
+			'quantile': intervals that each hold the same number of points.
+		bins (optional): The number of histogram bins used by 'kmeans1d' and by warm-started frames. Default 256.
+		sampleSize (optional): The number of z-values sampled by 'jenks'. Default 1000.
+		warmStart (optional): Seed each frame's levels with the previous frame's. Only 'kmeans' and 'kmeans1d'
+			support this, since a warm start refines the levels with k-means iterations. Default False.
+		maxIterations (optional): The most Lloyd iterations a warm-started frame gets. Default 3.
+		driftThreshold (optional): A warm-started frame is fit from scratch if its distortion exceeds that of the
+			last full fit by more than this fraction. Default 0.25.
 		"""
+		if method not in _QUANTIZERS:
+			raise ValueError("PosterizeDepth does not support the method '{0}' (expected one of {1}).".format(method,", ".join(PosterizeDepth.METHODS)))
+		if warmStart and method not in PosterizeDepth.WARM_START_METHODS:
+			raise ValueError("PosterizeDepth does not support warm starts with the method '{0}' (expected one of {1}).".format(method,", ".join(PosterizeDepth.WARM_START_METHODS)))
 		self._levels = levels
 		self._zPadding = zPadding
+		self._method = method
+		self._options = {'bins': bins, 'sampleSize': sampleSize}
+		self._warmStart = warmStart
+		self._maxIterations = maxIterations
+		self._driftThreshold = driftThreshold
+		self.reset()
+		
+	def reset(self):
+		"""
+		Forgets the levels carried over from previous frames, so the next frame gets a full fit.
+		"""
+		self._previousCentroids = None
+		self._referenceDistortion = None
+		self._fullFitCount = 0
+		
+	def getFullFitCount(self):
+		"""
+		Returns how many frames have been fit from scratch since the last reset().
+		"""
+		return self._fullFitCount
+		
+	def _fitFromScratch(self,zValues):
+		self._fullFitCount += 1
+		return _QUANTIZERS[self._method](zValues,self._levels,**self._options)
 		
+	def _fitWarm(self,zValues):
+		"""
+		Warm-started fit for one frame of a stream. See the class docstring.
+		"""
+		#The refinement and the distortion are both computed on a histogram, so a warm-started
+		#frame costs about as much as binning its values once.
+		binValues,counts = _histogram(zValues,self._options['bins'])
+		if self._previousCentroids is not None:
+			centroids = _lloyd(binValues,counts,self._previousCentroids,self._maxIterations)
+			boundaries = _midpoints(centroids)
+			if _distortion(binValues,counts,boundaries,centroids) <= self._referenceDistortion * (1 + self._driftThreshold):
+				self._previousCentroids = centroids
+				return boundaries,centroids
+		boundaries,centroids = self._fitFromScratch(zValues)
+		self._previousCentroids = centroids
+		self._referenceDistortion = _distortion(binValues,counts,boundaries,centroids)
+		return boundaries,centroids
+
+	def _fit(self,zValues):
+		"""
+		Returns (boundaries,centroids) for the z-values of one frame, padded out to exactly self._levels centroids.
+		"""
+		if self._warmStart:
+			boundaries,centroids = self._fitWarm(zValues)
+		else:
+			boundaries,centroids = self._fitFromScratch(zValues)
+		#Some methods can return fewer levels than requested (e.g. when there are fewer distinct values).
+		#Repeating the largest centroid keeps the shapes fixed without changing any assignments.
+		missing = self._levels - len(centroids)
+		if missing > 0:
+			boundaries = np.append(boundaries,np.full(missing,np.inf))
+			centroids = np.append(centroids,np.full(missing,centroids[-1]))
+		if self._zPadding != None:
+			centroids = centroids + self._zPadding
+		return boundaries,centroids
+
+	def _posterizeBatch(self,batch):
+		"""
+		Posterizes every frame of a CloudBatch. The levels are fit and looked up frame by frame, so no
+		temporary is larger than one frame's z-values.
+		"""
+		points = batch.getPoints()
+		zValues = points[:,:,2]
+		posterized = np.empty(zValues.shape,dtype=np.float64)
+		for i,frameValues in enumerate(zValues):
+			boundaries,centroids = self._fit(frameValues)
+			posterized[i] = centroids[np.searchsorted(boundaries,frameValues)]
+		#Integer clouds (e.g. from depth PNGs) are promoted so the centroids and zPadding are kept.
+		batch.setPoints(_updateDepth(points,posterized))
+		return batch
+
 	def __call__(self, element):
 		"""
-		element: A DepthCloud
+		element: A DepthCloud or a CloudBatch
 		"""
+		if isinstance(element,CloudBatch):
+			return self._posterizeBatch(element)
 		points = element.getPoints()
 		zValues = points[:,2]
-		whitenedValues = whiten(zValues)
-		centroids,distortion = kmeans(whitenedValues,self._levels)
-		clusterIndices,_ = vq(whitenedValues,centroids) 
-		centroids = centroids * np.std(zValues) #unwhiten the centroids
-		if self._zPadding != None:
-			#padding = np.array([self._zPadding*(i+1) for i in range(self._levels)])
-			padding = np.array([self._zPadding for i in range(self._levels)])
-			centroids = centroids + padding
-		for i in range(self._levels):
-			clusterIndices[clusterIndices==i] = centroids[i]
-		points[:,2] = clusterIndices
-		element.setPoints(points)
+		boundaries,centroids = self._fit(zValues)
+		element.setPoints(_updateDepth(points,centroids[np.searchsorted(boundaries,zValues)]))
+		return element
+
+class DecimateClouds(CloudMoshFunction):
+	"""
+	Reduces the number of points in a point cloud, to make rendering and interpolation cheaper.
+	
+	'stride' and 'random' keep the same subset of points in every frame of the same size, so clouds that
+	were interpolatable (e.g. made from depth images of the same size) still are afterwards. 'voxel'
+	replaces all of the points in each cell of a 3-D grid by their average, so the number of points
+	changes from frame to frame and the result is meant for rendering.
+	"""
+	METHODS = ('stride','random','voxel')
+
+	def __init__(self,method='stride',stride=2,fraction=0.25,voxelSize=4.0,seed=0):
+		"""
+		method (optional): How the points are reduced. Default 'stride'.
+			'stride': keep every stride-th row and column of the pixel grid, i.e. the points whose x and y
+			are both multiples of stride.
+			'random': keep a random fraction of the points.
+			'voxel': average the points (and colors) that fall into the same cube of side voxelSize.
+		stride (optional): The step between kept rows and columns for 'stride'. Default 2.
+		fraction (optional): The fraction of the points kept by 'random'. Default 0.25.
+		voxelSize (optional): The side of the cubes used by 'voxel', in the units of the points. Default 4.0.
+		seed (optional): The seed of the random choice of points for 'random'. Default 0.
+		"""
+		if method not in DecimateClouds.METHODS:
+			raise ValueError("DecimateClouds does not support the method '{0}' (expected one of {1}).".format(method,", ".join(DecimateClouds.METHODS)))
+		self._method = method
+		self._stride = stride
+		self._fraction = fraction
+		self._voxelSize = voxelSize
+		self._seed = seed
+		#Maps a number of points to the sorted indices that 'random' keeps.
+		self._randomIndices = {}
+
+	def _indices(self,points):
+		"""
+		Returns the indices of the points kept by 'stride' or 'random', in their original order.
+		points: An array of shape (P,3). For 'stride', only x and y are looked at.
+		"""
+		if self._method == 'stride':
+			#x / stride is exact for multiples of stride, and this is much faster than % on floats.
+			quotients = points[:,:2] / self._stride
+			onGrid = quotients == np.floor(quotients)
+			return np.flatnonzero(onGrid[:,0] & onGrid[:,1])
+		count = len(points)
+		if count not in self._randomIndices:
+			random = np.random.RandomState(self._seed)
+			kept = max(1,int(round(count * self._fraction))) if count > 0 else 0
+			self._randomIndices[count] = np.sort(random.choice(count,kept,replace=False))
+		return self._randomIndices[count]
+
+	def _voxelGroups(self,points):
+		"""
+		Returns, for every point, the index of its voxel among the occupied voxels, and the number of
+		occupied voxels.
+		"""
+		cells = np.floor(points / self._voxelSize).astype(np.int64)
+		cells -= cells.min(axis=0)
+		extent = cells.max(axis=0) + 1
+		keys = (cells[:,0] * extent[1] + cells[:,1]) * extent[2] + cells[:,2]
+		cellCount = int(extent[0]) * int(extent[1]) * int(extent[2])
+		if cellCount <= 4 * len(points):
+			#Few enough cells to count them directly, which is linear rather than a sort.
+			occupied = np.bincount(keys,minlength=cellCount) > 0
+			groupOfCell = np.cumsum(occupied) - 1
+			return groupOfCell[keys],int(occupied.sum())
+		uniqueKeys,groups = np.unique(keys,return_inverse=True)
+		return groups.reshape(-1),len(uniqueKeys)
+
+	def _average(self,values,groups,counts):
+		means = np.empty((len(counts),values.shape[1]),dtype=np.float64)
+		for channel in range(values.shape[1]):
+			means[:,channel] = np.bincount(groups,weights=values[:,channel],minlength=len(counts))
+		means /= counts[:,None]
+		return means
+
+	def _voxelize(self,cloud):
+		points = cloud.getPoints()
+		if len(points) == 0:
+			return cloud
+		groups,groupCount = self._voxelGroups(points)
+		cloud.setFrameShape(None)
+		counts = np.bincount(groups,minlength=groupCount).astype(np.float64)
+		colors = cloud.getColors()
+		cloud.setPoints(self._average(points,groups,counts))
+		if colors is not None:
+			averageColors = self._average(colors,groups,counts)
+			if np.issubdtype(colors.dtype,np.integer):
+				averageColors = np.rint(averageColors)
+			cloud.setColors(averageColors.astype(colors.dtype))
+		return cloud
+
+	def __call__(self,element):
+		"""
+		element: A DepthCloud or a CloudBatch. A CloudBatch keeps the same points in every frame, so it cannot
+		be decimated with 'voxel'.
+		"""
+		if self._method == 'voxel':
+			if isinstance(element,CloudBatch):
+				raise ValueError("DecimateClouds cannot decimate a CloudBatch with the method 'voxel', because its frames would have different numbers of points.")
+			return self._voxelize(element)
+		points = element.getPoints()
+		if isinstance(element,CloudBatch):
+			#The points are chosen from the first frame; the frames of a batch share their x and y.
+			indices = self._indices(points[0])
+			element.setPoints(points[:,indices])
+			element.setFrameShape(None)
+			if element.hasColors():
+				element.setColors(element.getColors()[:,indices])
+			return element
+		indices = self._indices(points)
+		element.setPoints(points[indices])
+		element.setFrameShape(None)
+		if element.hasColors():
+			element.setColors(element.getColors()[indices])
 		return element
-		
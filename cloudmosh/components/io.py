@@ -1,17 +1,33 @@
 import os
+import mmap
+from abc import ABC,abstractmethod
+import queue
+import threading
+import functools
+import itertools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import imageio
 import numpy as np
-from nutsflow.base import NutSink, NutSource
+from nutsflow.base import Nut, NutSink, NutSource
 import nutsflow
-from cloudmosh.components.base import CloudMoshSource
+from cloudmosh.components.base import CloudMoshNut,CloudMoshSink,CloudMoshSource
+from cloudmosh.components.resize import Resizer
 
-class ReadImageAsBinary(NutSource):
+class ReadImageAsBinary(CloudMoshSource):
 	"""
 		Reads (non-animated) image(s) from file(s) as bytes.
 	"""
-	def __init__(self,*paths):
+	def __init__(self,*paths,mmap=True):
+		"""
+		paths: One or more path strings to image files in formats like JPG or PNG.
+		mmap (optional): If True, each file is memory-mapped and produced as a read-only memoryview, so its
+		pages are only read from disk when they are used. If False, each file is read into a bytes object in
+		one call. Either way nothing is decoded; see DecodeImage. Default True.
+		"""
 		self._paths = paths
-		
+		self._mmap = mmap
+
 	def __rrshift__(self, iterable):
 		"""
 		Like the base implementation of NutSource, ReadImage will raise an exception
@@ -19,24 +35,56 @@ class ReadImageAsBinary(NutSource):
 		is generated within the cloudmosh codebase and not the dependency (nutsflow).
 		"""
 		raise SyntaxError("ReadImageAsBinary is a data source, '__ >> source' is an invalid operation.")
-		
+
 	def __iter__(self):
+		self._index = 0
 		return self
-		
+
 	def __next__(self):
-		pass #TODO
-		#for imagePath in self._paths:
+		if self._index >= len(self._paths):
+			self._index = 0
+			raise StopIteration
+		imagePath = self._paths[self._index]
+		with open(imagePath,'rb') as f:
+			if self._mmap and os.fstat(f.fileno()).st_size > 0:
+				#The mapping stays valid after the file is closed, and lives as long as the memoryview.
+				output = memoryview(mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ))
+			else:
+				output = f.read()
+		self._index += 1
+		return output
 
 
-class ReadImage(NutSource):
+def _readImage(imagePath):
+	"""
+	Decodes one (non-animated) image into an array of shape (1,width,height,color). The image may be
+	given as a path or as the encoded bytes of the file (see ReadImageAsBinary).
+	"""
+	img = imageio.imread(imagePath)
+	arr = imageio.core.asarray(img)
+	if len(arr.shape) == 3:
+		output = arr.reshape((1, arr.shape[0], arr.shape[1], arr.shape[2]))
+	else: #arr == 2, this is a depth image
+		output = arr.reshape((1, arr.shape[0], arr.shape[1], 1))
+	return output
+
+class ReadImage(CloudMoshSource):
 	"""
 	Reads (non-animated) image(s) from file(s) as arrays of RGB values.
 	"""
-	def __init__(self,*paths):
+	def __init__(self,*paths,workers=0,prefetch=None,processes=False):
 		"""
 		paths: One or more path strings to image files in formats like JPG or PNG.
+		workers (optional): Decode images on this many worker threads (or processes), ahead of when they are
+		needed. The images are still produced in the order of the paths, and a failed decode (e.g. a
+		FileNotFoundError) is raised when its image is reached. Default 0 (decode on the calling thread).
+		prefetch (optional): The most decodes that may be in flight at once. Default 2*workers.
+		processes (optional): Use a pool of processes instead of threads. Default False.
 		"""
 		self._paths = paths
+		self._workers = workers
+		self._prefetch = prefetch if prefetch is not None else 2 * workers
+		self._processes = processes
 		
 	def __rrshift__(self, iterable):
 		"""
@@ -47,32 +95,189 @@ class ReadImage(NutSource):
 		raise SyntaxError("ReadImage is a data source, '__ >> source' is an invalid operation.")
 	
 	def __iter__(self):
+		if self._workers > 0:
+			return self._prefetched()
 		self._index = 0
 		return self
+		
+	def _prefetched(self):
+		"""
+		Yields the decoded images while up to prefetch decodes run ahead on the workers. A failed decode is
+		raised as it is, and the workers are shut down when the images run out, a decode fails, or the
+		generator is closed (e.g. by a consumer that stops early).
+		"""
+		Executor = ProcessPoolExecutor if self._processes else ThreadPoolExecutor
+		executor = Executor(max_workers=self._workers)
+		pending = deque()
+		submitted = 0
+		try:
+			for _ in range(len(self._paths)):
+				while submitted < len(self._paths) and len(pending) < max(self._prefetch,1):
+					pending.append(executor.submit(_readImage,self._paths[submitted]))
+					submitted += 1
+				yield pending.popleft().result()
+		finally:
+			executor.shutdown(wait=True,cancel_futures=True)
 	
 	def __next__(self):
 		if self._index >= len(self._paths):
 			self._index = 0
 			raise StopIteration
-		imagePath = self._paths[self._index]
-		img = imageio.imread(imagePath)
-		arr = imageio.core.asarray(img)
-		if len(arr.shape) == 3:
-			output = arr.reshape((1, arr.shape[0], arr.shape[1], arr.shape[2]))
-		else: #arr == 2, this is a depth image
-			output = arr.reshape((1, arr.shape[0], arr.shape[1], 1))
+		output = _readImage(self._paths[self._index])
 		self._index += 1
 		return output
 
-class SaveImage(NutSink):
+class DecodeImage(CloudMoshNut):
+	"""
+	Decodes encoded image files (e.g. from ReadImageAsBinary) into arrays of RGB values, in the same format as
+	ReadImage. Keeping reading and decoding in separate stages lets them overlap and be scaled separately.
+	"""
+	def __init__(self,workers=0,prefetch=None,processes=False):
+		"""
+		workers (optional): Decode on this many worker threads (or processes), ahead of when the images are
+		needed. The images are still produced in their input order, and a failed decode is raised when its
+		image is reached. Default 0 (decode on the calling thread).
+		prefetch (optional): The most decodes that may be in flight at once. Default 2*workers.
+		processes (optional): Use a pool of processes instead of threads. The data is copied into bytes to send it
+		to the workers. Default False.
+		"""
+		super().__init__()
+		self._workers = workers
+		self._prefetch = prefetch if prefetch is not None else 2 * workers
+		self._processes = processes
+		
+	def __rrshift__(self,iterable):
+		if self._workers == 0:
+			for data in iterable:
+				yield _readImage(data)
+			return
+		Executor = ProcessPoolExecutor if self._processes else ThreadPoolExecutor
+		executor = Executor(max_workers=self._workers)
+		pending = deque()
+		try:
+			for data in iterable:
+				if self._processes:
+					data = bytes(data) #memoryviews cannot be pickled.
+				pending.append(executor.submit(_readImage,data))
+				if len(pending) >= max(self._prefetch,1):
+					yield pending.popleft().result()
+			while len(pending) > 0:
+				yield pending.popleft().result()
+		finally:
+			executor.shutdown(wait=True,cancel_futures=True)
+
+class _OutputPaths:
+	"""
+	The paths that a sink writes to. These are either a fixed list of literal paths, or (with template=True)
+	a single template like 'out_{:05d}.png' that is formatted with the index of each output, in which case
+	there is no limit.
+	"""
+	def __init__(self,sinkName,kind,paths,template=False):
+		self._sinkName = sinkName
+		self._kind = kind
+		self._paths = paths >> nutsflow.Collect()
+		self._template = None
+		if template:
+			if len(self._paths) != 1:
+				raise ValueError("{0} takes a single path template when template=True ({1} paths given).".format(sinkName,len(self._paths)))
+			self._template = self._paths[0]
+		
+	def __getitem__(self,index):
+		if self._template is not None:
+			return self._template.format(index)
+		if index >= len(self._paths):
+			raise IOError("{0} received more {1} than paths to which to save them ({2} paths).".format(self._sinkName,self._kind,len(self._paths)))
+		return self._paths[index]
+		
+	def checkCount(self,count):
+		if self._template is None and count != len(self._paths):
+			raise IOError("{0} received an unequal number of {1} and paths to which to save them ({2} {1}, {3} paths).".format(self._sinkName,self._kind,count,len(self._paths)))
+
+class _Writer:
+	"""
+	Runs write jobs in the order they are submitted, either right away or on a background thread that is
+	fed through a bounded queue (so a slow disk slows the pipeline down instead of filling up memory).
+	An error in a background job is raised from the next call to submit() or close(). The jobs after it are
+	skipped, except those submitted with always=True (e.g. closing a file), which run regardless.
+	"""
+	def __init__(self,background=True,maxPending=8):
+		self._error = None
+		self._errorRaised = False
+		self._thread = None
+		if background:
+			self._queue = queue.Queue(maxsize=maxPending)
+			self._thread = threading.Thread(target=self._run,daemon=True)
+			self._thread.start()
+			
+	def _run(self):
+		while True:
+			item = self._queue.get()
+			if item is None:
+				return
+			job,always = item
+			if self._error is not None and not always:
+				continue #Skip whatever is left after a failure, apart from clean-up.
+			try:
+				job()
+			except BaseException as error:
+				if self._error is None:
+					self._error = error
+				
+	def _raiseError(self):
+		if self._error is not None and not self._errorRaised:
+			self._errorRaised = True
+			raise self._error
+			
+	def submit(self,job,always=False):
+		"""
+		always (optional): Run the job even after an earlier job has failed. Default False.
+		"""
+		if self._thread is None:
+			job()
+			return
+		if not always:
+			self._raiseError()
+		self._queue.put((job,always))
+		
+	def close(self):
+		"""
+		Waits for every submitted job to finish.
+		"""
+		if self._thread is not None:
+			self._queue.put(None)
+			self._thread.join()
+			self._thread = None
+		self._raiseError()
+
+def _iterateFrames(sequence):
+	"""
+	Yields the (width,height,color) frames of a sequence whose elements may be single frames, or
+	(N,width,height,color) arrays holding one frame or a batch of frames.
+	"""
+	for frames in sequence:
+		if len(frames.shape) == 4:
+			yield from frames
+		else:
+			yield frames
+
+class SaveImage(CloudMoshSink):
 	"""
 	Saves an image as a file.
 	"""
-	def __init__(self,*paths):
+	def __init__(self,*paths,template=False,background=True):
 		"""
-		paths: One or more path strings to image files in formats like JPG or PNG.
+		paths: One or more path strings to image files in formats like JPG or PNG, or a single template
+		like 'out_{:05d}.png' that is formatted with the index of each image (see template).
+		template (optional): Treat the path as a template for str.format. Otherwise every path is used as it
+		is, braces included. Default False.
+		background (optional): Encode and write the images on a background thread. Default True.
+		
+		Each image is written as soon as it arrives. With a fixed list of paths, an IOError is raised
+		as soon as there are more images than paths, or at the end if there are fewer.
 		"""
 		self._paths = paths
+		self._template = template
+		self._background = background
 	
 	def __iter__(self):
 		"""
@@ -83,23 +288,42 @@ class SaveImage(NutSink):
 		raise SyntaxError("SaveImage is a data sink and does not produce outputs to iterate over.")
 		
 	def __rrshift__(self,iterable):
-		images = iterable >> nutsflow.Collect()
-		paths = self._paths >> nutsflow.Collect()
-		if len(images) != len(paths):
-			raise IOError("SaveImage received an unequal number of images and paths to which to save them ({0} images, {1} paths).".format(len(images),len(paths)))
-		for i in range(len(paths)):
-			img = images[i]
-			path = paths[i]
-			if len(img.shape) == 4:
-				img = img.reshape((img.shape[1], img.shape[2], img.shape[3]))
-			imageio.imsave(path, img)
-
-class ReadVideoOrGIF(NutSource):
-	def __init__(self,*paths):
+		paths = _OutputPaths("SaveImage","images",self._paths,self._template)
+		writer = _Writer(self._background)
+		count = 0
+		try:
+			for img in iterable:
+				path = paths[count]
+				if len(img.shape) == 4:
+					img = img.reshape((img.shape[1], img.shape[2], img.shape[3]))
+				writer.submit(functools.partial(imageio.imsave, path, img))
+				count += 1
+		finally:
+			writer.close()
+		paths.checkCount(count)
+
+class ReadVideoOrGIF(CloudMoshSource):
+	def __init__(self,*paths,stream=False,batchSize=None,stride=1,start=0,stop=None,frameShape=None):
 		"""
 		paths: One or more paths to video or GIF files.
+		stream (optional): If True, each file is produced as a generator that decodes its frames one at a time
+		instead of as a list of every frame, so downstream stages can start before decoding has finished and
+		memory does not grow with the length of the video. Default False.
+		batchSize (optional): Group this many consecutive frames into each (batchSize,width,height,color) array
+		instead of producing (1,width,height,color) arrays. The last batch may be smaller. Default None.
+		stride (optional): Keep every stride-th frame. Default 1.
+		start (optional): The index of the first frame to keep. Default 0.
+		stop (optional): The index of the frame to stop before. Default None (read to the end).
+		frameShape (optional): Resize every frame to this (width,height). Default None (keep the original size).
 		"""
 		self._paths = paths
+		self._stream = stream
+		self._batchSize = batchSize
+		self._stride = stride
+		self._start = start
+		self._stop = stop
+		self._frameShape = frameShape
+		self._resizer = Resizer() if frameShape is not None else None
 		
 	def __rrshift__(self, iterable):
 		"""
@@ -113,50 +337,139 @@ class ReadVideoOrGIF(NutSource):
 		self._index = 0
 		return self
 		
+	def _frames(self,fPath):
+		"""
+		Decodes the selected frames of one file, one at a time.
+		"""
+		with imageio.get_reader(fPath) as reader:
+			for img in itertools.islice(reader,self._start,self._stop,self._stride):
+				arr = imageio.core.asarray(img)
+				if len(arr.shape) == 3:
+					arr = arr.reshape((1, arr.shape[0], arr.shape[1], arr.shape[2]))
+				else: #arr == 2, this is a depth image
+					arr = arr.reshape((1, arr.shape[0], arr.shape[1], 1))
+				if self._resizer is not None:
+					resized = self._resizer(arr,self._frameShape)
+					if arr.dtype == np.uint8:
+						resized = np.clip(np.rint(resized),0,255)
+					arr = resized.astype(arr.dtype)
+				yield arr
+				
+	def _batches(self,frames):
+		batch = []
+		for frame in frames:
+			batch.append(frame)
+			if len(batch) == self._batchSize:
+				yield np.concatenate(batch)
+				batch = []
+		if len(batch) > 0:
+			yield np.concatenate(batch)
+		
 	def __next__(self):
 		if self._index >= len(self._paths):
 			self._index = 0
 			raise StopIteration
 		fPath = self._paths[self._index]
-		reader = imageio.get_reader(fPath)
-		output = []
-		for num, img in enumerate(reader):
-			arr = imageio.core.asarray(img)
-			if len(arr.shape) == 3:
-				arr = arr.reshape((1, arr.shape[0], arr.shape[1], arr.shape[2]))
-			else: #arr == 2, this is a depth image
-				arr = arr.reshape((1, arr.shape[0], arr.shape[1], 1))
-			output.append(arr)
+		output = self._frames(fPath)
+		if self._batchSize is not None:
+			output = self._batches(output)
+		if not self._stream:
+			output = list(output)
 		self._index += 1
 		return output
 
-class SaveGIF(NutSink):
+class _SaveSequences(CloudMoshSink,ABC):
 	"""
-	Saves one or more iterables of images as GIFs.
+	The shared implementation of SaveGIF and SaveVideo. Subclasses say how to open a writer for a path.
 	"""
-	def __init__(self,*paths):
-		"""
-		paths: One or more path strings to image files in formats like JPG or PNG.
-		"""
+	def __init__(self,*paths,template=False,singleSequence=False,background=True):
 		self._paths = paths
-	
+		self._template = template
+		self._singleSequence = singleSequence
+		self._background = background
+		
 	def __iter__(self):
 		"""
-		Like the base implementation of NutSink, SaveGIF will raise an exception
+		Like the base implementation of NutSink, this sink will raise an exception
 		if the user tries to read output from it. We're overriding this method so that the exception
 		is generated within the cloudmosh codebase and not the dependency (nutsflow).
 		"""
-		raise SyntaxError("SaveGIF is a data sink and does not produce outputs to iterate over.")
+		raise SyntaxError("{0} is a data sink and does not produce outputs to iterate over.".format(type(self).__name__))
+		
+	@abstractmethod
+	def _openWriter(self,path):
+		"""
+		Returns an imageio writer that appends frames to the file at path.
+		"""
+		pass
+		
+	def _saveSequence(self,writer,path,sequence):
+		"""
+		Appends the frames of the sequence to the file at path as they arrive.
+		"""
+		handle = []
+		writer.submit(lambda: handle.append(self._openWriter(path)))
+		try:
+			for frame in _iterateFrames(sequence):
+				writer.submit(lambda frame=frame: handle[0].append_data(frame))
+		finally:
+			writer.submit(lambda: handle[0].close() if len(handle) > 0 else None,always=True)
 		
 	def __rrshift__(self,iterable):
-		sequences = iterable >> nutsflow.Collect()
-		paths = self._paths >> nutsflow.Collect()
-		if len(sequences) != len(paths):
-			raise IOError("SaveGIF received an unequal number of sequences and paths to which to save them ({0} sequences, {1} paths).".format(len(sequences),len(paths)))
-		for i in range(len(paths)):
-			sequence = sequences[i]
-			path = paths[i]
-			for i in range(len(sequence)):
-				if len(sequence[i].shape) == 4:
-					sequence[i] = sequence[i].reshape((sequence[i].shape[1], sequence[i].shape[2], sequence[i].shape[3]))
-			imageio.mimsave(path, sequence)
\ No newline at end of file
+		paths = _OutputPaths(type(self).__name__,"sequences",self._paths,self._template)
+		writer = _Writer(self._background)
+		count = 0
+		try:
+			sequences = [iterable] if self._singleSequence else iterable
+			for sequence in sequences:
+				self._saveSequence(writer,paths[count],sequence)
+				count += 1
+		finally:
+			writer.close()
+		paths.checkCount(count)
+
+class SaveGIF(_SaveSequences):
+	"""
+	Saves one or more iterables of images as GIFs.
+	"""
+	def __init__(self,*paths,template=False,singleSequence=False,background=True,**writerOptions):
+		"""
+		paths: One or more path strings to GIF files, or a single template like 'clip_{:03d}.gif' that is
+		formatted with the index of each sequence (see template).
+		template (optional): Treat the path as a template for str.format. Otherwise every path is used as it
+		is, braces included. Default False.
+		singleSequence (optional): If True, the input is the frames of a single GIF (e.g. the output of
+		OffscreenCloudRender) rather than an iterable of sequences. Default False.
+		background (optional): Encode and write the frames on a background thread. Default True.
+		writerOptions (optional): Passed on to imageio.get_writer (e.g. duration).
+		
+		Each frame is appended to its GIF as soon as it arrives, so sequences can be generators.
+		"""
+		super().__init__(*paths,template=template,singleSequence=singleSequence,background=background)
+		self._writerOptions = writerOptions
+		
+	def _openWriter(self,path):
+		return imageio.get_writer(path, mode='I', **self._writerOptions)
+
+class SaveVideo(_SaveSequences):
+	"""
+	Saves one or more iterables of images as video files (e.g. MP4, through imageio-ffmpeg).
+	"""
+	def __init__(self,*paths,fps=24,template=False,singleSequence=False,background=True,**writerOptions):
+		"""
+		paths: One or more path strings to video files, or a single template like 'clip_{:03d}.mp4' that is
+		formatted with the index of each sequence (see template).
+		template (optional): Treat the path as a template for str.format. Otherwise every path is used as it
+		is, braces included. Default False.
+		fps (optional): Frames per second. Default 24.
+		singleSequence (optional): If True, the input is the frames of a single video (e.g. the output of
+		OffscreenCloudRender) rather than an iterable of sequences. Default False.
+		background (optional): Encode and write the frames on a background thread. Default True.
+		writerOptions (optional): Passed on to imageio.get_writer (e.g. codec, quality).
+		"""
+		super().__init__(*paths,template=template,singleSequence=singleSequence,background=background)
+		self._fps = fps
+		self._writerOptions = writerOptions
+		
+	def _openWriter(self,path):
+		return imageio.get_writer(path, fps=self._fps, **self._writerOptions)
@@ -1,17 +1,27 @@
-from cloudmosh.components.base import CloudMoshComponent
-import pyrender
+from cloudmosh.components.base import CloudMoshComponent,CloudMoshSink
+from cloudmosh.components.cloud import iterateFrames
+import os
+import logging
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 import numpy as np
 from nutsflow.base import NutSink
 
+logger = logging.getLogger(__name__)
+
+#pyrender needs a working OpenGL context, which headless servers often lack, so it is only imported
+#by the components that use it. SoftwareCloudRender renders with NumPy alone.
+
 #TODO: Temporary fix so I can get the pose information I need
 def cm_on_mouse_press(self, x, y, buttons, modifiers):
 	self.original_mouse_press(x, y, buttons, modifiers)
-	print(np.array2string(self._trackball.pose,separator=','))
+	logger.info("Camera pose: %s",np.array2string(self._trackball.pose,separator=','))
 
 #pyrender.Viewer.original_mouse_press = pyrender.Viewer.on_mouse_press
 #pyrender.Viewer.on_mouse_press = cm_on_mouse_press
 
-class SimpleCloudView(NutSink):
+class SimpleCloudView(CloudMoshSink):
 	"""
 	Renders a cloud in a Pyrender-generated window.
 	"""
@@ -24,13 +34,13 @@ class SimpleCloudView(NutSink):
 		raise SyntaxError("SimpleCloudView is a data sink and does not produce outputs to iterate over.")
 		
 	def __rrshift__(self,iterable):
+		import pyrender
 		scene = pyrender.Scene(ambient_light=[1.0, 1.0, 1.0, 1.0],bg_color=[0.0, 0.0, 0.0])
 		for cloud in iterable:
 			points = cloud.getPoints()
 			colors = cloud.getColors()
-			print("SimpleCloudView: points.shape == ", points.shape)
-			print("SimpleCloudView: colors.shape == ", colors.shape)
-			print(points[:,2])
+			logger.debug("SimpleCloudView: points.shape == %s, colors.shape == %s",points.shape,colors.shape)
+			logger.debug("SimpleCloudView: depths == %s",points[:,2])
 		
 			mesh = pyrender.Mesh.from_points(points,colors=colors)
 			scene.add(mesh)
@@ -39,9 +49,47 @@ class SimpleCloudView(NutSink):
 
 			
 class OffscreenCloudRender(CloudMoshComponent):
-	def __init__(self):
+	"""
+	Renders each cloud into an RGB image without opening a window. The renderer, scene and camera are
+	created once per stream; when the next cloud has as many points as the last one, its positions and
+	colors are written into the existing vertex buffer instead of building a new mesh.
+	With backend='software', the clouds are rendered by SoftwareCloudRender instead, which needs no OpenGL.
+	"""
+	BACKENDS = ('opengl','software')
+	#The pose used before the camera pose could be configured.
+	DEFAULT_CAMERA_POSE = np.array([
+		[  -0.67965718,  -0.67467772,   0.28788207, 218.90296805],
+		[  -0.5763984 ,   0.24848092,  -0.77847422,-201.12334648],
+		[   0.45368601,  -0.69503036,  -0.557765  , -31.37713392],
+		[   0.        ,   0.        ,   0.        ,   1.        ]])
+
+	def __init__(self,viewportWidth=640,viewportHeight=480,pointSize=9.0,cameraPose=None,yfov=np.pi / 3.0,aspectRatio=1.0,backend='opengl'):
+		"""
+		viewportWidth (optional): The width of the rendered images in pixels. Default 640.
+		viewportHeight (optional): The height of the rendered images in pixels. Default 480.
+		pointSize (optional): The size of each point in pixels. Default 9.0.
+		cameraPose (optional): A 4x4 camera-to-world matrix. Default None (DEFAULT_CAMERA_POSE).
+		yfov (optional): The vertical field of view of the camera in radians. Default pi/3.
+		aspectRatio (optional): The aspect ratio of the camera. Default 1.0.
+		backend (optional): 'opengl' (pyrender) or 'software' (SoftwareCloudRender). Default 'opengl'.
+		"""
 		super().__init__()
-		
+		if backend not in OffscreenCloudRender.BACKENDS:
+			raise ValueError("OffscreenCloudRender does not support the backend '{0}' (expected one of {1}).".format(backend,", ".join(OffscreenCloudRender.BACKENDS)))
+		self._backend = backend
+		self._viewportWidth = viewportWidth
+		self._viewportHeight = viewportHeight
+		self._pointSize = pointSize
+		self._cameraPose = np.array(OffscreenCloudRender.DEFAULT_CAMERA_POSE if cameraPose is None else cameraPose,dtype=np.float64)
+		self._yfov = yfov
+		self._aspectRatio = aspectRatio
+
+	def getCameraPose(self):
+		return self._cameraPose
+
+	def setCameraPose(self,cameraPose):
+		self._cameraPose = np.array(cameraPose,dtype=np.float64)
+
 	def _getDefaultCameraPose(self,scene):
 		centroid = scene.centroid
 		scale = 0.5 #The default is two
@@ -57,33 +105,339 @@ class OffscreenCloudRender(CloudMoshComponent):
 		cp[:3,3] = dist * np.array([1.0, 0.0, 1.0]) + centroid
 		return cp
 
-		
+	def _openRenderer(self):
+		"""
+		Returns an object whose render(points,colors) method renders one cloud into an image, with this
+		component's settings and backend.
+		"""
+		if self._backend == 'software':
+			return SoftwareCloudRender(self._viewportWidth,self._viewportHeight,self._pointSize,self._cameraPose,self._yfov,self._aspectRatio)
+		return _OpenGLRenderer(self._viewportWidth,self._viewportHeight,self._pointSize,self._cameraPose,self._yfov,self._aspectRatio)
+
 	def __rrshift__(self,iterable):
-		renderer = pyrender.OffscreenRenderer(viewport_width=640,viewport_height=480,point_size=9.0)
-		camera = pyrender.PerspectiveCamera(yfov=np.pi / 3.0, aspectRatio=1.0)
-		
-		#TMP TMP TMP
-		#fixed_pose = np.array([[ 3.48994967e-02,-9.96319684e-01,-7.82886503e-02,1.90910565e+02],
-		#	[-9.99390827e-01,-3.47922500e-02,-2.73389991e-03,3.57034963e+02],
-		#	[ 0.00000000e+00,7.83363707e-02,-9.96926985e-01,-3.85617716e+02],
-		#	[ 0.00000000e+00,0.00000000e+00,0.00000000e+00,1.00000000e+00]])
-		fixed_pose=[[  -0.67965718,  -0.67467772,   0.28788207, 218.90296805],
-		[  -0.5763984 ,   0.24848092,  -0.77847422,-201.12334648],
-		[   0.45368601,  -0.69503036,  -0.557765  , -31.37713392],
-		[   0.        ,   0.        ,   0.        ,   1.        ]]
-		#light = pyrender.SpotLight(color=np.ones(3), intensity=3.0, innerConeAngle=np.pi/16.0,outerConeAngle=np.pi/6.0)
-		for cloud in iterable:
-			points = cloud.getPoints()
-			colors = cloud.getColors()
-			mesh = pyrender.Mesh.from_points(points,colors=colors)
-			scene = pyrender.Scene(ambient_light=[1.0, 1.0, 1.0, 1.0],bg_color=[0.0, 0.0, 0.0])
-			scene.add(mesh)
-			camera_pose = fixed_pose#self._getDefaultCameraPose(scene)
-			scene.add(camera,pose=camera_pose)
-			#scene.add(light,pose=camera_pose)
-			colorImage, _ = renderer.render(scene)
-			yield colorImage
+		if self._backend == 'software':
+			return iterable >> self._openRenderer()
+		return self._renderOpenGL(iterable)
 
-		
-		
-	
\ No newline at end of file
+	def _renderOpenGL(self,iterable):
+		renderer = self._openRenderer()
+		try:
+			for cloud in iterateFrames(iterable):
+				yield renderer.render(cloud.getPoints(),cloud.getColors())
+		finally:
+			renderer.delete()
+
+class _OpenGLRenderer:
+	"""
+	The pyrender renderer, scene and camera behind OffscreenCloudRender, which are kept from one cloud to
+	the next.
+	"""
+	def __init__(self,viewportWidth,viewportHeight,pointSize,cameraPose,yfov,aspectRatio):
+		import pyrender
+		self._pyrender = pyrender
+		self._renderer = pyrender.OffscreenRenderer(viewport_width=viewportWidth,viewport_height=viewportHeight,point_size=pointSize)
+		self._scene = pyrender.Scene(ambient_light=[1.0, 1.0, 1.0, 1.0],bg_color=[0.0, 0.0, 0.0])
+		camera = pyrender.PerspectiveCamera(yfov=yfov, aspectRatio=aspectRatio)
+		self._scene.add(camera,pose=cameraPose)
+		self._meshNode = None
+
+	def _supportsInPlaceUpdates(self,mesh):
+		"""
+		Updating a mesh in place relies on pyrender internals (Mesh._bounds, Primitive._in_context and
+		Primitive._buffers, and the renderer's _platform), not its API. Returns whether they are all still
+		there, so that another pyrender version falls back to building a new mesh for every cloud.
+		"""
+		primitive = mesh.primitives[0]
+		if not hasattr(mesh,'_bounds') or not callable(getattr(primitive,'_in_context',None)):
+			return False
+		if not callable(getattr(getattr(self._renderer,'_platform',None),'make_current',None)):
+			return False
+		try:
+			return not primitive._in_context() or len(primitive._buffers) > 0
+		except (AttributeError,TypeError):
+			return False
+
+	def _updateMesh(self,mesh,points,colors):
+		"""
+		Writes new positions and colors into the vertex buffer of a point mesh with the same number of
+		points. Returns False if the mesh cannot be updated in place.
+		"""
+		primitive = mesh.primitives[0]
+		if len(primitive.positions) != len(points) or (primitive.color_0 is None) != (colors is None):
+			return False
+		if not self._supportsInPlaceUpdates(mesh):
+			return False
+		primitive.positions = points
+		if colors is not None:
+			primitive.color_0 = colors
+		mesh._bounds = None
+		if primitive._in_context():
+			from OpenGL.GL import glBindBuffer, glBufferSubData, GL_ARRAY_BUFFER
+			#Same layout as Primitive._add_to_context: interleaved positions and RGBA colors.
+			vertexData = primitive.positions if colors is None else np.hstack((primitive.positions,primitive.color_0))
+			vertexData = np.ascontiguousarray(vertexData,dtype=np.float32)
+			self._renderer._platform.make_current()
+			glBindBuffer(GL_ARRAY_BUFFER,primitive._buffers[0])
+			glBufferSubData(GL_ARRAY_BUFFER,0,vertexData.nbytes,vertexData)
+			glBindBuffer(GL_ARRAY_BUFFER,0)
+		return True
+
+	def render(self,points,colors=None):
+		if self._meshNode is None or not self._updateMesh(self._meshNode.mesh,points,colors):
+			if self._meshNode is not None:
+				self._scene.remove_node(self._meshNode)
+			self._meshNode = self._scene.add(self._pyrender.Mesh.from_points(points,colors=colors))
+		colorImage, _ = self._renderer.render(self._scene)
+		return colorImage
+
+	def delete(self):
+		self._renderer.delete()
+
+class SoftwareCloudRender(CloudMoshComponent):
+	"""
+	Renders each cloud into an RGB image on the CPU, for machines without a working OpenGL. Points are
+	projected through the same camera model as OffscreenCloudRender, drawn as squares of pointSize
+	pixels, and the nearest point wins each pixel. Colors are shaded like pyrender's ambient-only
+	rendering, so the images match OffscreenCloudRender's up to antialiasing at the edges of points.
+	"""
+	#pyrender's PerspectiveCamera default.
+	ZNEAR = 0.05
+
+	def __init__(self,viewportWidth=640,viewportHeight=480,pointSize=9.0,cameraPose=None,yfov=np.pi / 3.0,aspectRatio=1.0):
+		"""
+		viewportWidth (optional): The width of the rendered images in pixels. Default 640.
+		viewportHeight (optional): The height of the rendered images in pixels. Default 480.
+		pointSize (optional): The width of the square drawn for each point in pixels. It is rounded to a whole
+		number of pixels, as OpenGL does. Default 9.0.
+		cameraPose (optional): A 4x4 camera-to-world matrix. Default None (OffscreenCloudRender.DEFAULT_CAMERA_POSE).
+		yfov (optional): The vertical field of view of the camera in radians. Default pi/3.
+		aspectRatio (optional): The aspect ratio of the camera, or None to use the viewport's. Default 1.0.
+		"""
+		super().__init__()
+		self._viewportWidth = viewportWidth
+		self._viewportHeight = viewportHeight
+		self._splatSize = max(1,int(round(pointSize)))
+		self.setCameraPose(OffscreenCloudRender.DEFAULT_CAMERA_POSE if cameraPose is None else cameraPose)
+		self._yfov = yfov
+		self._aspectRatio = aspectRatio
+		#The depth buffer has a margin of one splat on every side, so that squares which stick out of the
+		#image can be drawn without clipping them first.
+		margin = self._splatSize
+		self._bufferWidth = viewportWidth + 2 * margin
+		self._depthBuffer = np.empty((viewportHeight + 2 * margin) * self._bufferWidth,dtype=np.int64)
+		#uint8 colors are shaded by lookup.
+		self._shading = self._shade(np.arange(256) / 255.0)
+
+	def getCameraPose(self):
+		return self._cameraPose
+
+	def setCameraPose(self,cameraPose):
+		self._cameraPose = np.array(cameraPose,dtype=np.float64)
+		self._view = np.linalg.inv(self._cameraPose)
+
+	def _shade(self,colors):
+		#pyrender multiplies the (linear) vertex colors by the ambient light, which is white, then
+		#gamma-encodes the result.
+		return np.round(np.clip(colors,0.0,1.0) ** (1.0 / 2.2) * 255.0).astype(np.uint8)
+
+	def _project(self,points):
+		"""
+		Returns the window coordinates (x to the right, y up, in pixels) and the depths of the points in front
+		of the camera whose centers fall inside the view, and the indices of those points.
+		"""
+		eye = points @ self._view[:3,:3].T
+		eye += self._view[:3,3]
+		depth = -eye[:,2]
+		tanHalfFov = np.tan(self._yfov / 2.0)
+		aspectRatio = self._aspectRatio if self._aspectRatio is not None else self._viewportWidth / self._viewportHeight
+		with np.errstate(divide='ignore',invalid='ignore'):
+			x = eye[:,0] / (depth * aspectRatio * tanHalfFov)
+			y = eye[:,1] / (depth * tanHalfFov)
+		#OpenGL drops points whose centers are clipped.
+		visible = (depth > SoftwareCloudRender.ZNEAR) & (np.abs(x) <= 1.0) & (np.abs(y) <= 1.0)
+		indices = np.flatnonzero(visible)
+		x = (x[indices] + 1.0) * (self._viewportWidth / 2.0)
+		y = (y[indices] + 1.0) * (self._viewportHeight / 2.0)
+		return x,y,depth[indices],indices
+
+	def render(self,points,colors=None):
+		"""
+		points: An (N,3) array of points.
+		colors (optional): An (N,3) or (N,4) array of colors, either integers from 0 to 255 or floats from 0 to 1.
+		Default None (white).
+		Returns the image as an (viewportHeight,viewportWidth,3) uint8 array.
+		"""
+		image = np.zeros((self._viewportHeight,self._viewportWidth,3),dtype=np.uint8)
+		x,y,depth,indices = self._project(np.asarray(points,dtype=np.float64))
+		if len(indices) == 0:
+			return image
+		size = self._splatSize
+		#A pixel is covered if its center lies inside the point's square, as for aliased OpenGL points.
+		left = np.floor(x - size / 2.0 + 0.5).astype(np.int64)
+		bottom = np.floor(y - size / 2.0 + 0.5).astype(np.int64)
+		top = (self._viewportHeight - 1) - (bottom + size - 1)
+		pixels = (top + size) * self._bufferWidth + (left + size)
+		#Positive float32s sort like their bit patterns, so the depth goes in the high 32 bits and the point's
+		#index in the low 32 bits. The minimum key at each pixel is then the nearest point, and the first
+		#one drawn among equally near points, as with OpenGL's GL_LESS depth test.
+		keys = depth.astype(np.float32).view(np.uint32).astype(np.int64) << 32
+		keys |= np.arange(len(indices),dtype=np.int64)
+		empty = np.iinfo(np.int64).max
+		self._depthBuffer.fill(empty)
+		for row in range(size):
+			for column in range(size):
+				np.minimum.at(self._depthBuffer,pixels + (row * self._bufferWidth + column),keys)
+		depthBuffer = self._depthBuffer.reshape(-1,self._bufferWidth)[size:size+self._viewportHeight,size:size+self._viewportWidth]
+		covered = depthBuffer != empty
+		winners = indices[depthBuffer[covered] & 0xFFFFFFFF]
+		if colors is None:
+			image[covered] = 255
+			return image
+		colors = np.asarray(colors)[winners,:3]
+		if colors.dtype == np.uint8:
+			image[covered] = self._shading[colors]
+		elif np.issubdtype(colors.dtype,np.integer):
+			image[covered] = self._shade(colors / 255.0)
+		else:
+			image[covered] = self._shade(colors)
+		return image
+
+	def __rrshift__(self,iterable):
+		for cloud in iterateFrames(iterable):
+			yield self.render(cloud.getPoints(),cloud.getColors())
+
+#The renderer of a ParallelCloudRender worker process, created once when the process starts.
+_workerRenderer = None
+
+def _initRenderWorker(render):
+	global _workerRenderer
+	_workerRenderer = render._openRenderer()
+
+def _attachSharedMemory(name):
+	try:
+		return shared_memory.SharedMemory(name=name,track=False)
+	except TypeError:
+		#Before Python 3.13 attaching also registers the block with the resource tracker, which the workers
+		#share with the parent, so the parent's unlink still unregisters it.
+		return shared_memory.SharedMemory(name=name)
+
+def _renderSharedFrame(frame):
+	"""
+	Renders the cloud in one shared memory block into the image in another.
+	"""
+	inputName,pointsShape,pointsType,colorsShape,colorsType,outputName,outputShape = frame
+	inputBlock = _attachSharedMemory(inputName)
+	outputBlock = _attachSharedMemory(outputName)
+	try:
+		points = np.ndarray(pointsShape,dtype=pointsType,buffer=inputBlock.buf)
+		colors = None
+		if colorsShape is not None:
+			colors = np.ndarray(colorsShape,dtype=colorsType,buffer=inputBlock.buf,offset=points.nbytes)
+		image = np.ndarray(outputShape,dtype=np.uint8,buffer=outputBlock.buf)
+		image[...] = _workerRenderer.render(points,colors)
+		del points,colors,image #The blocks cannot be closed while arrays still use them.
+	finally:
+		inputBlock.close()
+		outputBlock.close()
+
+class _FrameSlot:
+	"""
+	A pair of shared memory blocks that carry one cloud to a worker process and its image back. The
+	cloud's block grows as needed and is otherwise reused.
+	"""
+	def __init__(self,outputShape):
+		self._input = None
+		self._outputShape = outputShape
+		self._output = shared_memory.SharedMemory(create=True,size=int(np.prod(outputShape)))
+		self._image = np.ndarray(outputShape,dtype=np.uint8,buffer=self._output.buf)
+
+	def write(self,points,colors):
+		"""
+		Copies a cloud into the slot and returns the description of it that _renderSharedFrame expects.
+		The points are sent as float32 and the colors as uint8, like the renderers use them, which keeps
+		the blocks at 15 bytes per point.
+		"""
+		points = np.asarray(points,dtype=np.float32)
+		if colors is not None:
+			colors = np.asarray(colors)
+			if np.issubdtype(colors.dtype,np.floating):
+				#Float colors are 0-1, integer colors 0-255.
+				colors = np.rint(np.clip(colors,0.0,1.0) * 255.0)
+			if colors.dtype != np.uint8:
+				colors = np.clip(colors,0,255).astype(np.uint8)
+		size = points.nbytes + (0 if colors is None else colors.nbytes)
+		if self._input is None or self._input.size < size:
+			self._closeInput()
+			self._input = shared_memory.SharedMemory(create=True,size=max(size,1))
+		np.ndarray(points.shape,dtype=points.dtype,buffer=self._input.buf)[...] = points
+		if colors is not None:
+			np.ndarray(colors.shape,dtype=colors.dtype,buffer=self._input.buf,offset=points.nbytes)[...] = colors
+			return (self._input.name,points.shape,points.dtype.str,colors.shape,colors.dtype.str,self._output.name,self._outputShape)
+		return (self._input.name,points.shape,points.dtype.str,None,None,self._output.name,self._outputShape)
+
+	def read(self):
+		return self._image.copy()
+
+	def _closeInput(self):
+		if self._input is not None:
+			self._input.close()
+			self._input.unlink()
+			self._input = None
+
+	def close(self):
+		self._closeInput()
+		del self._image
+		self._output.close()
+		self._output.unlink()
+
+class ParallelCloudRender(CloudMoshComponent):
+	"""
+	Renders clouds like OffscreenCloudRender, but spreads the frames over a pool of worker processes, each
+	with its own renderer. Clouds and images are passed through shared memory instead of being pickled,
+	and the images are produced in the order of the clouds.
+	"""
+	def __init__(self,workers=None,prefetch=None,**renderOptions):
+		"""
+		workers (optional): The number of worker processes. Default None (one per CPU). With 0, the frames are
+		rendered in this process.
+		prefetch (optional): The most frames that may be in flight at once, each with its own shared memory
+		blocks. Default workers+1 (one per worker, plus the next one being copied in).
+		renderOptions (optional): Passed on to OffscreenCloudRender, e.g. viewportWidth, pointSize, cameraPose
+		or backend.
+		"""
+		super().__init__()
+		self._render = OffscreenCloudRender(**renderOptions)
+		self._workers = workers if workers is not None else os.cpu_count()
+		self._prefetch = prefetch if prefetch is not None else self._workers + 1
+
+	def __rrshift__(self,iterable):
+		if self._workers == 0:
+			return iterable >> self._render
+		return self._renderParallel(iterable)
+
+	def _renderParallel(self,iterable):
+		outputShape = (self._render._viewportHeight,self._render._viewportWidth,3)
+		executor = ProcessPoolExecutor(max_workers=self._workers,initializer=_initRenderWorker,initargs=(self._render,))
+		slots = [_FrameSlot(outputShape) for _ in range(max(self._prefetch,1))]
+		free = deque(slots)
+		pending = deque()
+		def collect():
+			future,slot = pending.popleft()
+			future.result()
+			free.append(slot)
+			return slot.read()
+		try:
+			for cloud in iterateFrames(iterable):
+				if len(free) == 0:
+					yield collect()
+				slot = free.popleft()
+				pending.append((executor.submit(_renderSharedFrame,slot.write(cloud.getPoints(),cloud.getColors())),slot))
+			while len(pending) > 0:
+				yield collect()
+		finally:
+			for future,_ in pending:
+				future.cancel()
+			#The workers must be done with the blocks before they are unlinked.
+			executor.shutdown(wait=True)
+			for slot in slots:
+				slot.close()
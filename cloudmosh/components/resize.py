@@ -0,0 +1,104 @@
+import numpy as np
+
+class Resizer:
+	"""
+	Resizes stacks of images in float32 using only NumPy. The interpolation tables and the scratch
+	space needed for each combination of shapes are computed once and then reused, and the result
+	can be written into a caller-provided buffer.
+	"""
+	METHODS = ('bilinear','area')
+
+	def __init__(self,method='bilinear'):
+		"""
+		method (optional): 'bilinear' (like skimage's order=1) or 'area' (each output pixel is the
+		average of the input pixels it covers, which is better for large reductions). Default 'bilinear'.
+		"""
+		if method not in Resizer.METHODS:
+			raise ValueError("Resizer does not support the method '{0}' (expected one of {1}).".format(method,", ".join(Resizer.METHODS)))
+		self._method = method
+		self._tables = {}
+		self._scratch = {}
+
+	def _bilinearTable(self,inSize,outSize):
+		key = ('bilinear',inSize,outSize)
+		if key not in self._tables:
+			#Pixel centers are aligned, as in skimage and OpenCV.
+			source = (np.arange(outSize) + 0.5) * (inSize / outSize) - 0.5
+			source = np.clip(source,0,inSize-1)
+			lower = np.floor(source).astype(np.intp)
+			upper = np.minimum(lower + 1,inSize-1)
+			weights = (source - lower).astype(np.float32)
+			self._tables[key] = (lower,upper,weights)
+		return self._tables[key]
+
+	def _areaTable(self,inSize,outSize):
+		key = ('area',inSize,outSize)
+		if key not in self._tables:
+			#The edges of the output pixels, in input pixel units.
+			edges = np.arange(outSize + 1) * (inSize / outSize)
+			lower = np.minimum(np.floor(edges).astype(np.intp),inSize-1)
+			fractions = edges - lower
+			self._tables[key] = (lower,fractions,outSize / inSize)
+		return self._tables[key]
+
+	def _getScratch(self,name,shape):
+		key = (name,shape)
+		if key not in self._scratch:
+			self._scratch[key] = np.empty(shape,dtype=np.float32)
+		return self._scratch[key]
+
+	def _take(self,images,indices,axis,out):
+		if images.dtype == out.dtype:
+			return np.take(images,indices,axis=axis,out=out)
+		#np.take can only write into a buffer of the same dtype.
+		np.copyto(out,np.take(images,indices,axis=axis),casting='unsafe')
+		return out
+
+	def _bilinearAxis(self,images,outSize,axis,out):
+		lower,upper,weights = self._bilinearTable(images.shape[axis],outSize)
+		weightShape = [1] * images.ndim
+		weightShape[axis] = outSize
+		self._take(images,lower,axis,out)
+		difference = self._getScratch('difference',out.shape)
+		self._take(images,upper,axis,difference)
+		difference -= out
+		difference *= weights.reshape(weightShape)
+		out += difference
+		return out
+
+	def _areaAxis(self,images,outSize,axis,out):
+		lower,fractions,scale = self._areaTable(images.shape[axis],outSize)
+		fractionShape = [1] * images.ndim
+		fractionShape[axis] = outSize + 1
+		#Integrate along the axis, then sample the integral at the output pixel edges. The integral
+		#is kept in float64 so that long rows of large values (e.g. depths) keep their precision.
+		integralShape = list(images.shape)
+		integralShape[axis] += 1
+		integral = np.zeros(integralShape,dtype=np.float64)
+		inner = [slice(None)] * images.ndim
+		inner[axis] = slice(1,None)
+		np.cumsum(images,axis=axis,out=integral[tuple(inner)])
+		atLower = np.take(integral,lower,axis=axis)
+		atUpper = np.take(integral,np.minimum(lower + 1,images.shape[axis]),axis=axis)
+		atEdges = atLower + (atUpper - atLower) * fractions.reshape(fractionShape)
+		np.multiply(np.diff(atEdges,axis=axis),scale,out=out,casting='unsafe')
+		return out
+
+	def __call__(self,images,shape,out=None):
+		"""
+		images: An array of shape (N,rows,columns,channels).
+		shape: The (rows,columns) of the result.
+		out (optional): A float32 array of shape (N,rows,columns,channels) to write the result into.
+		Returns the resized images as float32. If the images already have the requested shape, they are
+		only converted (and copied into out, if it was given).
+		"""
+		resultShape = (images.shape[0],shape[0],shape[1],images.shape[3])
+		if out is None:
+			out = np.empty(resultShape,dtype=np.float32)
+		if images.shape == resultShape:
+			np.copyto(out,images,casting='unsafe')
+			return out
+		resizeAxis = self._bilinearAxis if self._method == 'bilinear' else self._areaAxis
+		intermediate = self._getScratch('intermediate',(images.shape[0],shape[0],images.shape[2],images.shape[3]))
+		resizeAxis(images,shape[0],1,intermediate)
+		return resizeAxis(intermediate,shape[1],2,out)
@@ -0,0 +1,87 @@
+import json
+import numpy as np
+from nutsflow import Collect
+from cloudmosh.components.base import CloudMoshNut,CloudMoshFunction,CloudMoshSink,CloudMoshSource,CloudMoshComponent
+from cloudmosh.components.base import enableProfiling,disableProfiling,getProfile,profiling
+
+class _Numbers(CloudMoshSource):
+	def __init__(self,count):
+		super().__init__()
+		self._count = count
+	def __iter__(self):
+		return iter(range(self._count))
+
+class _Double(CloudMoshFunction):
+	def __call__(self,x):
+		return 2 * x
+
+class _Pairs(CloudMoshNut):
+	def __rrshift__(self,iterable):
+		iterator = iter(iterable)
+		for a in iterator:
+			yield a + next(iterator,0)
+
+class _SubPairs(_Pairs):
+	def __rrshift__(self,iterable):
+		return super().__rrshift__(iterable)
+
+class _Sum(CloudMoshSink):
+	def __rrshift__(self,iterable):
+		return sum(iterable)
+
+class _Allocate(CloudMoshComponent):
+	def __rrshift__(self,iterable):
+		return [np.ones(100000) for _ in iterable]
+
+def test_profilingIsOffByDefault():
+	assert(getProfile() is None)
+	assert(_Numbers(4) >> _Double() >> Collect() == [0,2,4,6])
+	assert(getProfile() is None)
+
+def test_profilingCountsItems():
+	with profiling() as profile:
+		total = _Numbers(10) >> _Double() >> _Pairs() >> _Sum()
+	assert(total == 90)
+	assert(getProfile() is None)
+	stages = {statistics.name: statistics for statistics in profile.getStages()}
+	assert(set(stages) == {'_Numbers','_Double','_Pairs','_Sum'})
+	assert(stages['_Numbers'].itemsOut == 10)
+	assert(stages['_Double'].itemsIn == 10 and stages['_Double'].itemsOut == 10)
+	assert(stages['_Pairs'].itemsIn == 10 and stages['_Pairs'].itemsOut == 5)
+	assert(stages['_Sum'].itemsIn == 5 and stages['_Sum'].runs == 1)
+	for statistics in stages.values():
+		assert(statistics.wallTime >= 0.0 and statistics.inputWait >= 0.0)
+
+def test_profilingSubclassCallingSuper():
+	with profiling() as profile:
+		assert(list(_Numbers(4) >> _SubPairs()) == [1,5])
+	names = [statistics.name for statistics in profile.getStages()]
+	assert(names == ['_SubPairs','_Numbers'])
+
+def test_profilingNamesRepeatedStages():
+	with profiling() as profile:
+		_Numbers(3) >> _Double() >> _Double() >> Collect()
+	names = sorted(statistics.name for statistics in profile.getStages())
+	assert(names == ['_Double','_Double#2','_Numbers'])
+
+def test_profilingMemory():
+	with profiling(traceMemory=True) as profile:
+		arrays = _Numbers(5) >> _Allocate()
+	statistics = profile.getStages()[0]
+	assert(statistics.name == '_Allocate')
+	assert(statistics.bytesAllocated > 0.9 * 5 * 100000 * 8)
+	del arrays
+
+def test_profileExport(tmp_path):
+	enableProfiling()
+	_Numbers(3) >> _Double() >> _Sum()
+	profile = disableProfiling()
+	summary = profile.summary()
+	assert(summary.splitlines()[0].startswith("Stage"))
+	assert(len(summary.splitlines()) == 2 + 3)
+	path = str(tmp_path / "profile.json")
+	profile.saveJSON(path)
+	with open(path) as f:
+		data = json.load(f)
+	assert([stage['name'] for stage in data['stages']] == [statistics.name for statistics in profile.getStages()])
+	assert(data['stages'][0]['itemsIn'] >= 0)
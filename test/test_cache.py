@@ -0,0 +1,62 @@
+from cloudmosh.components.cache import PredictionCache,arrayDigest,fileDigest
+import os
+import pytest
+import numpy as np
+
+def test_ArrayDigest():
+	array = np.arange(12,dtype=np.float32).reshape((3,4))
+	assert(arrayDigest(array) == arrayDigest(array.copy()))
+	assert(arrayDigest(array) != arrayDigest(array.reshape((4,3))))
+	assert(arrayDigest(array) != arrayDigest(array.astype(np.float64)))
+	assert(arrayDigest(array,10,1000) != arrayDigest(array,10,999))
+	assert(arrayDigest(array[:,::2]) == arrayDigest(array[:,::2].copy()))
+
+def test_FileDigest(tmpdir):
+	path = str(tmpdir.join("model.h5"))
+	with open(path,'wb') as f:
+		f.write(b"weights")
+	digest = fileDigest(path)
+	assert(digest == fileDigest(path))
+	with open(path,'wb') as f:
+		f.write(b"other weights")
+	assert(digest != fileDigest(path))
+
+@pytest.mark.parametrize("compress",[False,True])
+def test_PredictionCache_RoundTrip(tmpdir,compress):
+	cache = PredictionCache(str(tmpdir),compress=compress)
+	array = np.random.RandomState(0).rand(1,20,30,1).astype(np.float32)
+	assert(cache.get("key") is None)
+	cache.put("key",array)
+	result = cache.get("key")
+	assert(np.array_equal(result,array))
+	assert(cache.getHits() == 1 and cache.getMisses() == 1)
+	result[0,0,0,0] = -1
+	assert(np.array_equal(cache.get("key"),array))
+
+def test_PredictionCache_SharedDirectory(tmpdir):
+	PredictionCache(str(tmpdir)).put("key",np.zeros(4))
+	cache = PredictionCache(str(tmpdir))
+	assert(cache.getSizeOnDisk() > 0)
+	assert(cache.get("key") is not None)
+
+def test_PredictionCache_EvictsLeastRecentlyUsed(tmpdir):
+	array = np.zeros(1000)
+	entrySize = array.nbytes + 128 #The .npy header takes up 128 bytes.
+	cache = PredictionCache(str(tmpdir),maxBytes=int(3.5 * entrySize))
+	for i,key in enumerate(["a","b","c"]):
+		cache.put(key,array)
+		#Make the order of use unambiguous regardless of the file system's timestamp resolution.
+		os.utime(os.path.join(str(tmpdir),key + ".npy"),(i,i))
+	cache.get("a")
+	cache.put("d",array)
+	assert(cache.get("b") is None)
+	assert(cache.get("a") is not None)
+	assert(cache.get("d") is not None)
+	assert(cache.getSizeOnDisk() <= 3.5 * entrySize)
+
+def test_PredictionCache_Clear(tmpdir):
+	cache = PredictionCache(str(tmpdir))
+	cache.put("key",np.zeros(4))
+	cache.clear()
+	assert(cache.get("key") is None)
+	assert(cache.getSizeOnDisk() == 0)
@@ -0,0 +1,107 @@
+import os
+import shutil
+import pytest
+import numpy as np
+import imageio
+from cloudmosh import cli
+from cloudmosh.components.depth import registerModel,clearModelRegistry
+
+class ConstantDepthModel:
+	def predict(self,images,batch_size=None):
+		return np.full((images.shape[0],images.shape[1] // 2,images.shape[2] // 2,1),5.0,dtype=np.float32)
+
+@pytest.fixture
+def model(tmpdir):
+	path = str(tmpdir.join("model.h5"))
+	with open(path,'wb') as f:
+		f.write(b"weights")
+	registerModel(path,ConstantDepthModel())
+	yield path
+	clearModelRegistry()
+
+@pytest.fixture
+def inputs(tmpdir):
+	directory = tmpdir.mkdir("inputs")
+	shutil.copy("test/testdata/colorbars.png",str(directory.join("a.png")))
+	shutil.copy("test/testdata/colorbars.jpg",str(directory.join("b.jpg")))
+	shutil.copy("test/testdata/shore.gif",str(directory.join("c.gif")))
+	directory.join("notes.txt").write("not an input")
+	return str(directory)
+
+def _run(model,output,*arguments):
+	return cli.main(["-m",model,"-o",output,"--backend","software","--width","32","--height","24","--point-size","1","-q"] + list(arguments))
+
+def test_findInputs(inputs):
+	found = cli.findInputs([inputs,os.path.join(inputs,"*.png")])
+	assert([relativePath for _,relativePath in found] == ["a.png","b.jpg","c.gif"])
+	assert(cli.outputPathOf("b.jpg","out") == os.path.join("out","b.png"))
+	assert(cli.outputPathOf("clip.MOV","out") == os.path.join("out","clip.mp4"))
+
+def test_findInputs_Glob(inputs):
+	for directory in ("first","second"):
+		os.makedirs(os.path.join(inputs,"clips",directory))
+		shutil.copy(os.path.join(inputs,"a.png"),os.path.join(inputs,"clips",directory,"x.png"))
+	found = cli.findInputs([os.path.join(inputs,"clips","**","*.png")])
+	assert([relativePath for _,relativePath in found] == [os.path.join("first","x.png"),os.path.join("second","x.png")])
+
+def test_cliSameOutputs(model,inputs,tmpdir):
+	output = str(tmpdir.join("output"))
+	for directory in ("first","second"):
+		os.makedirs(os.path.join(inputs,directory))
+		shutil.copy(os.path.join(inputs,"a.png"),os.path.join(inputs,directory,"x.png"))
+	assert(_run(model,output,os.path.join(inputs,"first","x.png"),os.path.join(inputs,"second","x.png")) == 1)
+	assert(not os.path.exists(os.path.join(output,"x.png")))
+	assert(_run(model,output,os.path.join(inputs,"*","x.png")) == 0)
+	assert(os.path.exists(os.path.join(output,"first","x.png")) and os.path.exists(os.path.join(output,"second","x.png")))
+
+def test_cliRendersAndSkips(model,inputs,tmpdir):
+	output = str(tmpdir.join("output"))
+	assert(_run(model,output,inputs,"--posterize","3","--decimate","stride") == 0)
+	assert(sorted(name for name in os.listdir(output) if not name.startswith('.')) == ["a.png","b.png","c.gif"])
+	assert(imageio.imread(os.path.join(output,"a.png")).shape[:2] == (24,32))
+	assert(len(imageio.mimread(os.path.join(output,"c.gif"))) == len(imageio.mimread(os.path.join(inputs,"c.gif"))))
+	modified = os.path.getmtime(os.path.join(output,"a.png"))
+	os.remove(os.path.join(output,"b.png"))
+	assert(_run(model,output,inputs) == 0)
+	assert(os.path.exists(os.path.join(output,"b.png")))
+	assert(os.path.getmtime(os.path.join(output,"a.png")) == modified)
+
+def test_cliResume(model,inputs,tmpdir):
+	output = str(tmpdir.join("output"))
+	checkpoint = str(tmpdir.join("done.txt"))
+	assert(_run(model,output,os.path.join(inputs,"a.png"),"--checkpoint",checkpoint) == 0)
+	os.remove(os.path.join(output,"a.png"))
+	assert(_run(model,output,os.path.join(inputs,"*.png"),"--checkpoint",checkpoint,"--resume") == 0)
+	assert(not os.path.exists(os.path.join(output,"a.png")))
+	with open(checkpoint) as f:
+		assert(len(f.read().split()) == 1)
+
+def test_cliFailures(model,inputs,tmpdir):
+	output = str(tmpdir.join("output"))
+	with open(os.path.join(inputs,"broken.png"),'wb') as f:
+		f.write(b"not a png")
+	assert(_run(model,output,inputs,"-w","2","--cache-dir",str(tmpdir.join("cache"))) == 1)
+	assert(os.path.exists(os.path.join(output,"a.png")))
+	assert(not any(name.startswith(".broken") or name == "broken.png" for name in os.listdir(output)))
+
+def test_cliKeepsCheckpoint(model,inputs,tmpdir):
+	output = str(tmpdir.join("output"))
+	checkpoint = str(tmpdir.join("done.txt"))
+	assert(_run(model,output,os.path.join(inputs,"a.png"),"--checkpoint",checkpoint) == 0)
+	assert(_run(model,output,os.path.join(inputs,"b.jpg"),"--checkpoint",checkpoint) == 0)
+	with open(checkpoint) as f:
+		assert(len(f.read().split()) == 2)
+	os.remove(os.path.join(output,"a.png"))
+	assert(_run(model,output,os.path.join(inputs,"*.png"),"--checkpoint",checkpoint,"--resume") == 0)
+	assert(not os.path.exists(os.path.join(output,"a.png")))
+	assert(_run(model,output,os.path.join(inputs,"*.png"),"--checkpoint",checkpoint,"--restart") == 0)
+	assert(os.path.exists(os.path.join(output,"a.png")))
+	with open(checkpoint) as f:
+		assert(len(f.read().split()) == 1)
+
+def test_cliBracedFileName(model,inputs,tmpdir):
+	output = str(tmpdir.join("output"))
+	shutil.copy(os.path.join(inputs,"a.png"),os.path.join(inputs,"photo{1}.png"))
+	shutil.copy(os.path.join(inputs,"c.gif"),os.path.join(inputs,"clip{}.gif"))
+	assert(_run(model,output,os.path.join(inputs,"photo{1}.png"),os.path.join(inputs,"clip{}.gif")) == 0)
+	assert(sorted(os.listdir(output)) == sorted([".cloudmosh-checkpoint","clip{}.gif","photo{1}.png"]))
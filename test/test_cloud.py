@@ -0,0 +1,212 @@
+from cloudmosh.components.cloud import DepthCloud,CloudBatch,DepthToClouds,PaintClouds,InterpolateClouds,ChangeDepthOfClouds,iterateFrames,getIndexGrid,pointsFromDepthImage
+import nutsflow
+import pytest
+import numpy as np
+
+def _loopPoints(depth):
+	#The original per-pixel construction, kept here as a reference.
+	return np.array([ (row,column,depth[row][column][0]) for row in range(depth.shape[0]) for column in range(depth.shape[1])])
+
+@pytest.mark.parametrize("dtype",[np.float32,np.float64,np.uint8])
+def test_DepthCloud_MatchesLoop(dtype):
+	depth = (np.random.RandomState(0).rand(7,5,1)*255).astype(dtype)
+	cloud = DepthCloud(depth)
+	expected = _loopPoints(depth)
+	assert(cloud.getPoints().dtype == expected.dtype)
+	assert(np.array_equal(cloud.getPoints(),expected))
+
+def test_DepthCloud_SetDepthByImage():
+	depthA = np.random.RandomState(0).rand(4,6,1)
+	depthB = np.random.RandomState(1).rand(4,6,1)
+	cloud = DepthCloud(depthA)
+	cloud.setDepthByImage(depthB)
+	assert(np.array_equal(cloud.getPoints(),_loopPoints(depthB)))
+
+def test_DepthCloud_PointForm():
+	points = np.zeros((10,3))
+	cloud = DepthCloud(points)
+	assert(cloud.getPoints() is points)
+
+def test_IndexGrid_Cached():
+	gridA = getIndexGrid(3,4)
+	gridB = getIndexGrid(3,4)
+	assert(gridA is gridB)
+	assert(not gridA.flags.writeable)
+	assert(getIndexGrid(3,4,cache=False) is not gridA)
+
+def test_PointsFromDepthImage_Uncached():
+	depth = np.random.RandomState(0).rand(3,3,1)
+	assert(np.array_equal(pointsFromDepthImage(depth,cache=False),_loopPoints(depth)))
+
+def test_DepthCloud_SetColorsByImage_View():
+	image = np.random.RandomState(0).randint(0,256,size=(4,6,3),dtype=np.uint8)
+	cloud = DepthCloud(np.zeros((4,6,1)))
+	cloud.setColorsByImage(image)
+	colors = cloud.getColors()
+	assert(colors.shape == (24,3))
+	assert(colors.dtype == np.uint8)
+	assert(np.shares_memory(colors,image))
+	assert(np.array_equal(colors[7],image[1][1]))
+	assert(cloud.hasColors())
+
+def test_DepthCloud_SetColorsByImage_DropsAlpha():
+	image = np.random.RandomState(0).randint(0,256,size=(4,6,4),dtype=np.uint8)
+	cloud = DepthCloud(np.zeros((4,6,1)))
+	cloud.setColorsByImage(image)
+	assert(np.array_equal(cloud.getColors(),image[:,:,:3].reshape((24,3))))
+
+def test_PaintClouds_Lazy():
+	def images():
+		for i in range(3):
+			yield np.full((1,2,2,3),i,dtype=np.uint8)
+	clouds = (DepthCloud(np.zeros((2,2,1))) for i in range(3))
+	painted = clouds >> PaintClouds(images())
+	first = next(painted)
+	assert(np.all(first.getColors() == 0))
+	assert([int(c.getColors()[0][0]) for c in painted] == [1,2])
+
+def test_CloudBatch_MatchesDepthCloud():
+	depthData = np.random.RandomState(0).rand(3,4,5,1)
+	batch = CloudBatch(depthData)
+	assert(batch.getPoints().shape == (3,20,3))
+	assert(len(batch) == 3)
+	for i,cloud in enumerate(batch):
+		assert(np.array_equal(cloud.getPoints(),DepthCloud(depthData[i]).getPoints()))
+		assert(np.shares_memory(cloud.getPoints(),batch.getPoints()))
+
+def test_CloudBatch_FromClouds():
+	clouds = [DepthCloud(np.full((2,2,1),i)) for i in range(3)]
+	for cloud in clouds:
+		cloud.setColors(np.zeros((4,3),dtype=np.uint8))
+	batch = CloudBatch.fromClouds(clouds)
+	assert(batch.getPoints().shape == (3,4,3))
+	assert(batch.getColors().shape == (3,4,3))
+
+def test_DepthToClouds_Batched():
+	depthData = np.random.RandomState(0).rand(3,4,5,1)
+	batches = [depthData] >> DepthToClouds(batched=True) >> nutsflow.Collect()
+	clouds = [depthData] >> DepthToClouds() >> nutsflow.Collect()
+	assert(len(batches) == 1 and len(clouds) == 3)
+	assert(np.array_equal(batches[0].getPoints(),np.stack([c.getPoints() for c in clouds])))
+
+def test_PaintClouds_Batched():
+	depthData = np.zeros((2,4,5,1))
+	images = np.random.RandomState(0).randint(0,256,size=(2,4,5,3),dtype=np.uint8)
+	batch = next([depthData] >> DepthToClouds(batched=True) >> PaintClouds([images]))
+	assert(batch.getColors().shape == (2,20,3))
+	assert(np.shares_memory(batch.getColors(),images))
+
+def test_InterpolateClouds_Batched():
+	depthData = np.random.RandomState(0).rand(3,4,5,1)
+	images = np.random.RandomState(1).randint(0,256,size=(3,4,5,3),dtype=np.uint8)
+	batch = next([depthData] >> DepthToClouds(batched=True) >> PaintClouds([images]))
+	clouds = list(batch)
+	interpolator = InterpolateClouds(lambda t: t,0.0,1.0,0.25)
+	perFrame = list(clouds >> interpolator)
+	batched = list([batch] >> interpolator)
+	assert(len(batched) == 2)
+	assert(len(batched[0]) == 5)
+	frames = list(iterateFrames(batched))
+	assert(len(frames) == len(perFrame))
+	for a,b in zip(frames,perFrame):
+		assert(np.allclose(a.getPoints(),b.getPoints()))
+		assert(np.array_equal(a.getColors(),b.getColors()))
+
+def _legacyInterpolation(clouds,stepFunction,tStart,tStop,tStepSize):
+	#The original per-step loop, kept here as a reference.
+	frames = []
+	for i in range(len(clouds)-1):
+		tCurrent = tStart
+		while tCurrent <= tStop:
+			ft = stepFunction(tCurrent)
+			frames.append(((1 - ft) * clouds[i].getPoints() + ft * clouds[i+1].getPoints(),((1 - ft) * clouds[i].getColors() + ft * clouds[i+1].getColors()).astype(int)))
+			tCurrent += tStepSize
+	return frames
+
+def _paintedClouds(count,width=4,height=5):
+	random = np.random.RandomState(0)
+	clouds = []
+	for _ in range(count):
+		cloud = DepthCloud(random.rand(width,height,1) * 100)
+		cloud.setColorsByImage(random.randint(0,256,size=(width,height,3),dtype=np.uint8))
+		clouds.append(cloud)
+	return clouds
+
+@pytest.mark.parametrize("stepFunction",[lambda t: t*t,lambda t: 1.0 if t > 0.5 else 0.0])
+@pytest.mark.parametrize("options",[{},{'batched':True},{'reuseBuffers':True},{'zOnly':True},{'batched':True,'zOnly':True},{'reuseBuffers':True,'zOnly':True}])
+def test_InterpolateClouds_MatchesLoop(stepFunction,options):
+	clouds = _paintedClouds(3)
+	expected = _legacyInterpolation(clouds,stepFunction,0.0,1.0,0.1)
+	frames = []
+	for cloud in clouds >> InterpolateClouds(stepFunction,0.0,1.0,0.1,**options):
+		#Buffers may be reused, so copy each frame before the next is produced.
+		for frame in iterateFrames([cloud]):
+			frames.append((frame.getPoints().copy(),frame.getColors().copy()))
+	assert(len(frames) == len(expected) == 22)
+	for (points,colors),(expectedPoints,expectedColors) in zip(frames,expected):
+		assert(np.allclose(points,expectedPoints))
+		#The colors are truncated to integers, and (1-f)*a + f*b can fall just below a when a == b.
+		assert(np.abs(colors.astype(int) - expectedColors).max() <= 1)
+
+def test_InterpolateClouds_ReusesBuffers():
+	frames = list(_paintedClouds(2) >> InterpolateClouds(lambda t: t,0.0,1.0,0.5,reuseBuffers=True))
+	assert(len(frames) == 3)
+	assert(frames[0].getPoints() is frames[2].getPoints())
+	assert(frames[0].getColors() is frames[2].getColors())
+	assert(frames[0].getColors().dtype == np.uint8)
+	batches = list(_paintedClouds(2) >> InterpolateClouds(lambda t: t,0.0,1.0,0.5,batched=True))
+	assert(len(batches) == 1 and batches[0].getPoints().shape == (3,20,3))
+	assert(np.array_equal(batches[0].getPoints()[2],frames[2].getPoints()))
+
+def test_InterpolateClouds_WithoutColors():
+	clouds = [DepthCloud(np.zeros((2,2,1))),DepthCloud(np.ones((2,2,1)))]
+	frames = list(iter(clouds) >> InterpolateClouds(lambda t: t,0.0,1.0,0.5))
+	assert(len(frames) == 3 and not frames[1].hasColors())
+	assert(np.allclose(frames[1].getPoints()[:,2],0.5))
+
+def test_InterpolateClouds_Streams():
+	produced = []
+	def keyframes():
+		for cloud in _paintedClouds(4):
+			produced.append(cloud)
+			yield cloud
+	stream = keyframes() >> InterpolateClouds(lambda t: t,0.0,1.0,0.5)
+	first = next(stream)
+	#Only the first two keyframes were needed for the first in-between frame.
+	assert(len(produced) == 2)
+	assert(np.array_equal(first.getPoints(),produced[0].getPoints()))
+	assert(len([first] + list(stream)) == 9)
+	assert(list(iter([]) >> InterpolateClouds(lambda t: t,0.0,1.0,0.5)) == [])
+	assert(list(iter(_paintedClouds(1)) >> InterpolateClouds(lambda t: t,0.0,1.0,0.5)) == [])
+	batches = list(iter([CloudBatch.fromClouds(_paintedClouds(2)),CloudBatch.fromClouds(_paintedClouds(2))]) >> InterpolateClouds(lambda t: t,0.0,1.0,0.5))
+	assert(len(batches) == 3 and all(isinstance(batch,CloudBatch) for batch in batches))
+
+def test_ChangeDepthOfClouds_InPlace():
+	clouds = [DepthCloud(np.random.RandomState(i).rand(4,5,1)) for i in range(2)]
+	buffers = [cloud.getPoints() for cloud in clouds]
+	depthData = np.random.RandomState(2).rand(2,4,5,1)
+	result = list(clouds >> ChangeDepthOfClouds(iter(depthData[:,None])))
+	assert(len(result) == 2)
+	for i,cloud in enumerate(result):
+		assert(cloud.getPoints() is buffers[i])
+		assert(np.array_equal(cloud.getPoints(),pointsFromDepthImage(depthData[i])))
+	#The original [ clouds, depthData ] form.
+	result = list([clouds,depthData[::-1]] >> ChangeDepthOfClouds())
+	assert(np.array_equal(result[0].getPoints(),pointsFromDepthImage(depthData[1])))
+
+def test_ChangeDepthOfClouds_Batch():
+	batch = CloudBatch(np.zeros((2,4,5,1)))
+	buffer = batch.getPoints()
+	depthData = np.random.RandomState(0).rand(2,4,5,1)
+	result = next([batch] >> ChangeDepthOfClouds([depthData]))
+	assert(result.getPoints() is buffer)
+	assert(np.array_equal(result.getPoints(),CloudBatch(depthData).getPoints()))
+
+def test_ChangeDepthOfClouds_PromotesIntegerPoints():
+	cloud = DepthCloud(np.zeros((4,5,1),dtype=np.uint8))
+	assert(cloud.getPoints().dtype == np.int64)
+	depth = np.full((4,5,1),2.5)
+	cloud.updateDepthByImage(depth)
+	assert(np.all(cloud.getPoints()[:,2] == 2.5))
+	with pytest.raises(ValueError):
+		cloud.updateDepthByImage(np.zeros((5,5,1)))
@@ -0,0 +1,119 @@
+from cloudmosh.components.cloud import DepthCloud,CloudBatch
+from cloudmosh.components.cloudfile import CloudFile,CloudFileWriter,SaveClouds,LoadClouds,SavePLY,SavePCD
+import nutsflow
+import pytest
+import numpy as np
+
+def _clouds(count,width=6,height=4,colors=True):
+	random = np.random.RandomState(0)
+	clouds = []
+	for _ in range(count):
+		cloud = DepthCloud(random.rand(width,height,1) * 100)
+		if colors:
+			cloud.setColorsByImage(random.randint(0,256,size=(width,height,3),dtype=np.uint8))
+		clouds.append(cloud)
+	return clouds
+
+@pytest.mark.parametrize("compression",[None,'zlib','zstd','lz4'])
+def test_SaveClouds_RoundTrip(tmp_path,compression):
+	if compression == 'zstd':
+		pytest.importorskip('zstandard')
+	if compression == 'lz4':
+		pytest.importorskip('lz4.frame')
+	clouds = _clouds(3)
+	path = str(tmp_path / "clouds.cmc")
+	clouds >> SaveClouds(path,compression=compression)
+	loaded = LoadClouds(path) >> nutsflow.Collect()
+	assert(len(loaded) == 3)
+	for cloud,original in zip(loaded,clouds):
+		assert(cloud.getPoints().dtype == np.float32)
+		assert(np.allclose(cloud.getPoints(),original.getPoints(),rtol=1e-6))
+		assert(np.array_equal(cloud.getColors(),original.getColors()))
+		assert(cloud.getFrameShape() == (6,4))
+
+def test_CloudFile_RandomAccessAndMemoryMap(tmp_path):
+	clouds = _clouds(4)
+	clouds[2] = DepthCloud(np.arange(30,dtype=np.float64).reshape((10,3))) #Different size, no colors or frame shape.
+	path = str(tmp_path / "clouds.cmc")
+	[CloudBatch.fromClouds(clouds[:2])] + clouds[2:] >> SaveClouds(path)
+	with CloudFile(path) as cloudFile:
+		assert(len(cloudFile) == 4)
+		cloud = cloudFile[2]
+		assert(np.array_equal(cloud.getPoints(),clouds[2].getPoints()))
+		assert(not cloud.hasColors() and cloud.getFrameShape() is None)
+		assert(np.allclose(cloudFile[-1].getPoints(),clouds[3].getPoints()))
+		assert(cloudFile.getFrameShape(0) == (6,4))
+		#The arrays are views of the file, and changing them does not change it.
+		points = cloudFile[0].getPoints()
+		assert(not points.flags.owndata)
+		points[:] = 0
+	assert(np.allclose(CloudFile(path)[0].getPoints(),clouds[0].getPoints()))
+	assert(np.all(points == 0))
+	selected = LoadClouds(path,frames=[3,1]) >> nutsflow.Collect()
+	assert(np.allclose(selected[0].getPoints(),clouds[3].getPoints()))
+	assert(len(LoadClouds(path,frames=slice(1,None)) >> nutsflow.Collect()) == 3)
+
+def test_SaveClouds_Float16(tmp_path):
+	clouds = _clouds(1)
+	path = str(tmp_path / "clouds.cmc")
+	clouds >> SaveClouds(path,positionType='float16')
+	cloud = CloudFile(path)[0]
+	assert(cloud.getPoints().dtype == np.float16)
+	assert(np.array_equal(cloud.getPoints()[:,:2],clouds[0].getPoints()[:,:2]))
+	assert(np.allclose(cloud.getPoints()[:,2],clouds[0].getPoints()[:,2],rtol=1e-3))
+	with pytest.raises(ValueError):
+		CloudFileWriter(str(tmp_path / "other.cmc"),positionType='int8')
+
+def test_SaveClouds_ColorScaleFollowsDtype(tmp_path):
+	clouds = _clouds(3)
+	#A dark frame between two bright ones: floats are always 0-1 and integers always 0-255.
+	clouds[0].setColors(np.full((24,3),0.5))
+	clouds[1].setColors(np.full((24,3),1.0))
+	clouds[2].setColors(np.full((24,3),2.0))
+	path = str(tmp_path / "colors.cmc")
+	clouds >> SaveClouds(path)
+	with CloudFile(path) as cloudFile:
+		assert([int(cloudFile[i].getColors()[0,0]) for i in range(3)] == [128,255,255])
+	darkIntegers = _clouds(1)
+	darkIntegers[0].setColors(np.full((24,3),1,dtype=np.int64))
+	darkIntegers >> SaveClouds(path)
+	with CloudFile(path) as cloudFile:
+		assert(int(cloudFile[0].getColors()[0,0]) == 1)
+
+def test_SaveClouds_IncompleteFiles(tmp_path):
+	path = str(tmp_path / "clouds.cmc")
+	def failing():
+		yield _clouds(1)[0]
+		raise RuntimeError("upstream failure")
+	with pytest.raises(RuntimeError):
+		failing() >> SaveClouds(path)
+	#Nothing is left behind under the path or as a temporary file.
+	assert(list(tmp_path.iterdir()) == [])
+	(tmp_path / "bad.cmc").write_bytes(b"not a cloud file at all, just some bytes that are long enough")
+	with pytest.raises(IOError):
+		CloudFile(str(tmp_path / "bad.cmc"))
+
+def test_SavePLY(tmp_path):
+	clouds = _clouds(2)
+	clouds >> SavePLY(str(tmp_path / "cloud_{}.ply"),template=True)
+	data = (tmp_path / "cloud_1.ply").read_bytes()
+	header,body = data.split(b"end_header\n")
+	assert(b"element vertex 24" in header and b"property uchar red" in header)
+	records = np.frombuffer(body,dtype=[('x','<f4'),('y','<f4'),('z','<f4'),('red','u1'),('green','u1'),('blue','u1')])
+	assert(np.allclose(records['z'],clouds[1].getPoints()[:,2]))
+	assert(np.array_equal(records['green'],clouds[1].getColors()[:,1]))
+	with pytest.raises(IOError):
+		clouds >> SavePLY(str(tmp_path / "only.ply"))
+	clouds[:1] >> SavePLY(str(tmp_path / "cloud_{x}.ply"))
+	assert((tmp_path / "cloud_{x}.ply").exists())
+
+def test_SavePCD(tmp_path):
+	clouds = _clouds(1)
+	clouds >> SavePCD(str(tmp_path / "cloud.pcd"))
+	header,body = (tmp_path / "cloud.pcd").read_bytes().split(b"DATA binary\n")
+	assert(b"FIELDS x y z rgb" in header and b"WIDTH 4" in header and b"HEIGHT 6" in header)
+	records = np.frombuffer(body,dtype=[('x','<f4'),('y','<f4'),('z','<f4'),('rgb','<u4')])
+	colors = clouds[0].getColors().astype(np.uint32)
+	assert(np.array_equal(records['rgb'],(colors[:,0] << 16) | (colors[:,1] << 8) | colors[:,2]))
+	_clouds(1,colors=False) >> SavePCD(str(tmp_path / "plain.pcd"))
+	assert(b"FIELDS x y z\n" in (tmp_path / "plain.pcd").read_bytes())
@@ -0,0 +1,95 @@
+import time
+import threading
+import pytest
+import numpy as np
+import nutsflow
+from nutsflow.base import Nut,NutSink,NutSource,NutFunction
+from cloudmosh.components.concurrency import Concurrent
+from cloudmosh.components.cloud import DepthToClouds
+from cloudmosh.components.io import ReadVideoOrGIF
+
+class _Square(NutFunction):
+	def __call__(self,x):
+		return x * x
+
+class _Fail(Nut):
+	def __init__(self,after):
+		self._after = after
+	def __rrshift__(self,iterable):
+		for i,x in enumerate(iterable):
+			if i == self._after:
+				raise ValueError("stage failed")
+			yield x
+
+class _Count(NutSource):
+	def __init__(self,count):
+		self._count = count
+	def __iter__(self):
+		return iter(range(self._count))
+
+class _Sum(NutSink):
+	def __rrshift__(self,iterable):
+		return sum(iterable)
+
+def _failingInput():
+	yield 1
+	raise KeyError("input failed")
+
+@pytest.mark.parametrize("processes",[False,True])
+def test_concurrentStage(processes):
+	assert(list(range(20)) >> Concurrent(_Square(),processes=processes) >> nutsflow.Collect() == [x * x for x in range(20)])
+
+@pytest.mark.parametrize("processes",[False,True])
+def test_concurrentSourceAndSink(processes):
+	assert(Concurrent(_Count(10),processes=processes) >> Concurrent(_Sum(),processes=processes) == 45)
+
+@pytest.mark.parametrize("processes",[False,True])
+def test_concurrentStageError(processes):
+	with pytest.raises(ValueError):
+		range(10) >> Concurrent(_Fail(3),processes=processes) >> nutsflow.Consume()
+
+def test_concurrentInputError():
+	with pytest.raises(KeyError):
+		_failingInput() >> Concurrent(_Square()) >> nutsflow.Consume()
+
+def test_concurrentBackpressure():
+	produced = []
+	def produce():
+		for i in range(100):
+			produced.append(i)
+			yield i
+	output = produce() >> Concurrent(_Square(),queueSize=2)
+	assert(next(output) == 0)
+	time.sleep(0.3)
+	#The input queue, the output queue, the item in the stage and the one being fed.
+	assert(len(produced) <= 2 + 2 + 3)
+	output.close()
+
+def test_concurrentEarlyClose():
+	threads = threading.active_count()
+	closed = []
+	def produce():
+		try:
+			for i in range(1000):
+				yield i
+		finally:
+			closed.append(True)
+	output = produce() >> Concurrent(_Square())
+	assert([next(output) for _ in range(3)] == [0,1,4])
+	output.close()
+	assert(closed == [True])
+	assert(threading.active_count() == threads)
+
+def test_concurrentWithComponents():
+	frames = Concurrent(ReadVideoOrGIF("test/testdata/shore.gif",batchSize=4)) >> nutsflow.Collect()
+	depths = [np.ones((2,8,6,1)) * i for i in range(3)]
+	clouds = depths >> Concurrent(DepthToClouds()) >> nutsflow.Collect()
+	assert(len(frames) > 0)
+	assert(len(clouds) == 6)
+	assert(clouds[5].getPoints()[0,2] == 2)
+
+def test_concurrentUsage():
+	with pytest.raises(SyntaxError):
+		iter(Concurrent(_Square()))
+	with pytest.raises(SyntaxError):
+		[1] >> Concurrent(_Count(1))
@@ -0,0 +1,141 @@
+from cloudmosh.components.depth import AWDepthEstimator,registerModel,clearModelRegistry
+from cloudmosh.components.cache import PredictionCache
+import sys
+import subprocess
+import pytest
+import numpy as np
+
+class HalfScaleModel:
+	"""
+	Stands in for the network: like it, it returns one half-resolution depth map per image.
+	"""
+	def __init__(self):
+		self.batchSizes = []
+		
+	def predict(self,images,batch_size=None):
+		self.batchSizes.append(images.shape[0])
+		return images[:,::2,::2,:1] + 1
+
+@pytest.fixture
+def model(tmpdir):
+	path = str(tmpdir.join("model.h5"))
+	with open(path,'wb') as f:
+		f.write(b"weights")
+	model = HalfScaleModel()
+	registerModel(path,model)
+	yield path,model
+	clearModelRegistry()
+
+def _images(*counts):
+	return [np.random.RandomState(i).randint(0,256,size=(count,24,32,3),dtype=np.uint8) for i,count in enumerate(counts)]
+
+def test_AWDepthEstimator_ImportIsLazy():
+	#Run in a fresh interpreter, since other tests may already have imported anything.
+	code = "import sys; import cloudmosh.components.depth as d; d.AWDepthEstimator('does/not/exist.h5'); print(sorted(m for m in ('tensorflow','keras','skimage') if m in sys.modules))"
+	output = subprocess.check_output([sys.executable,"-c",code])
+	assert(output.strip() == b"[]")
+
+def test_AWDepthEstimator_SharedModel(model):
+	path,fake = model
+	assert(AWDepthEstimator(path).getModel() is fake)
+	assert(AWDepthEstimator(path).getModel() is AWDepthEstimator(path).getModel())
+
+def test_AWDepthEstimator_OneOutputPerInput(model):
+	path,fake = model
+	results = list(_images(1,3,2) >> AWDepthEstimator(path,resizeBackend='numpy'))
+	assert([r.shape for r in results] == [(1,24,32,1),(3,24,32,1),(2,24,32,1)])
+	assert(fake.batchSizes == [1,3,2])
+
+def test_AWDepthEstimator_Pipelined(model):
+	path,fake = model
+	images = _images(1,3,1,2,4)
+	expected = list(images >> AWDepthEstimator(path,resizeBackend='numpy'))
+	fake.batchSizes = []
+	results = list(images >> AWDepthEstimator(path,batchSize=3,pipelined=True,resizeBackend='numpy'))
+	assert(fake.batchSizes == [3,3,3,2])
+	assert(len(results) == len(expected))
+	for result,original in zip(results,expected):
+		assert(np.allclose(result,original))
+
+def test_AWDepthEstimator_Cache(model,tmpdir):
+	path,fake = model
+	cache = PredictionCache(str(tmpdir.join("cache")))
+	images = _images(1,2)
+	first = list(images >> AWDepthEstimator(path,resizeBackend='numpy',cache=cache))
+	fake.batchSizes = []
+	second = list(images >> AWDepthEstimator(path,resizeBackend='numpy',pipelined=True,cache=cache))
+	assert(fake.batchSizes == [])
+	assert(cache.getHits() == 2)
+	for a,b in zip(first,second):
+		assert(np.array_equal(a,b))
+	list(images >> AWDepthEstimator(path,maxDepth=500,resizeBackend='numpy',cache=cache))
+	assert(fake.batchSizes == [1,2])
+
+@pytest.mark.parametrize("processes",[False,True])
+def test_AWDepthEstimator_Concurrent(model,tmpdir,processes):
+	from cloudmosh.components.concurrency import Concurrent
+	path,fake = model
+	images = _images(1,3,2)
+	estimator = AWDepthEstimator(path,resizeBackend='numpy',cache=PredictionCache(str(tmpdir.join("cache"))))
+	expected = list(images >> estimator)
+	assert(estimator.getModel() is fake)
+	results = list(images >> Concurrent(estimator,processes=processes))
+	for result,original in zip(results,expected):
+		assert(np.array_equal(result,original))
+
+class RecordingGraph:
+	"""
+	Stands in for a TensorFlow graph and counts the predictions made inside it.
+	"""
+	def __init__(self,model):
+		self._model = model
+		self.entered = 0
+		self.predictionsInside = 0
+		self._inside = False
+		original = model.predict
+		def predict(images,batch_size=None):
+			self.predictionsInside += self._inside
+			return original(images,batch_size)
+		model.predict = predict
+		
+	def as_default(self):
+		graph = self
+		class Default:
+			def __enter__(self):
+				graph.entered += 1
+				graph._inside = True
+			def __exit__(self,*exception):
+				graph._inside = False
+		return Default()
+
+@pytest.mark.parametrize("pipelined",[False,True])
+def test_AWDepthEstimator_PredictsInsideGraph(tmpdir,pipelined):
+	path = str(tmpdir.join("graph.h5"))
+	model = HalfScaleModel()
+	graph = RecordingGraph(model)
+	registerModel(path,model,graph)
+	try:
+		list(_images(1,2,1) >> AWDepthEstimator(path,batchSize=2,pipelined=pipelined,resizeBackend='numpy'))
+	finally:
+		clearModelRegistry()
+	assert(graph.entered > 0)
+	assert(graph.predictionsInside == graph.entered)
+
+def test_AWDepthEstimator_PipelinedOrder(model):
+	path,fake = model
+	#Every frame is a constant image, so each output can be traced back to its input frame.
+	inputs = []
+	value = 0
+	for count in (2,1,4,1,3):
+		frames = np.zeros((count,24,32,3),dtype=np.uint8)
+		for i in range(count):
+			value += 10
+			frames[i] = value
+		inputs.append(frames)
+	results = list(inputs >> AWDepthEstimator(path,batchSize=3,pipelined=True,resizeBackend='numpy',maxDepth=1e6,minDepth=0))
+	#Batches cross input boundaries: 11 frames in batches of 3.
+	assert(fake.batchSizes == [3,3,3,2])
+	assert([r.shape[0] for r in results] == [2,1,4,1,3])
+	#The fake model adds 1 to the normalized image, and the estimator divides maxDepth by the prediction.
+	depths = [1e6 / (frame / 255.0 + 1) for frames in inputs for frame in frames[:,0,0,0]]
+	assert(np.allclose([frame[0,0,0] for r in results for frame in r],depths,rtol=1e-3))
@@ -0,0 +1,150 @@
+from cloudmosh.components.cloud import DepthCloud,CloudBatch
+from cloudmosh.components.effect import PosterizeDepth,DecimateClouds
+import nutsflow
+import pytest
+import numpy as np
+
+def _layeredDepth(frames,seed=0):
+	#Depth images made of three flat layers plus a little noise.
+	random = np.random.RandomState(seed)
+	layers = random.choice([100.0,400.0,900.0],size=(frames,30,40,1))
+	return layers + random.rand(frames,30,40,1)
+
+def test_PosterizeDepth_Batch_Levels():
+	batch = CloudBatch(_layeredDepth(2))
+	result = PosterizeDepth(levels=3)(batch)
+	for frame in result.getPoints():
+		assert(len(np.unique(frame[:,2])) <= 3)
+
+def test_PosterizeDepth_Batch_NearestLevel():
+	depthData = _layeredDepth(2)
+	batch = PosterizeDepth(levels=3)(CloudBatch(depthData))
+	zValues = batch.getPoints()[:,:,2]
+	original = depthData.reshape((2,-1))
+	assert(np.all(np.abs(zValues - original) < 1.0))
+
+@pytest.mark.parametrize("method",PosterizeDepth.METHODS)
+def test_PosterizeDepth_Methods_Levels(method):
+	cloud = DepthCloud(_layeredDepth(1)[0])
+	result = PosterizeDepth(levels=3,method=method)(cloud)
+	assert(len(np.unique(result.getPoints()[:,2])) <= 3)
+
+@pytest.mark.parametrize("method",["kmeans","kmeans1d","jenks","uniform"])
+def test_PosterizeDepth_Methods_NearestLevel(method):
+	depth = _layeredDepth(1)[0]
+	result = PosterizeDepth(levels=3,method=method)(DepthCloud(depth))
+	assert(np.all(np.abs(result.getPoints()[:,2] - depth.reshape(-1)) < 1.0))
+
+def test_PosterizeDepth_KeepsCentroidValues():
+	#The levels used to be written into an integer array of cluster indices.
+	depth = _layeredDepth(1)[0]
+	result = PosterizeDepth(levels=3)(DepthCloud(depth))
+	zValues = result.getPoints()[:,2]
+	assert(not np.array_equal(zValues,np.round(zValues)))
+
+def test_PosterizeDepth_Padding():
+	depth = _layeredDepth(1)[0]
+	plain = PosterizeDepth(levels=3,method='kmeans1d')(DepthCloud(depth.copy())).getPoints()[:,2]
+	padded = PosterizeDepth(levels=3,method='kmeans1d',zPadding=5)(DepthCloud(depth.copy())).getPoints()[:,2]
+	assert(np.allclose(padded,plain + 5))
+
+def test_PosterizeDepth_IntegerClouds():
+	#Clouds of integer depth images (e.g. depth PNGs) used to truncate the centroids and drop zPadding.
+	depth = _layeredDepth(2).astype(np.uint8)
+	floatCloud = PosterizeDepth(levels=3,method='kmeans1d',zPadding=0.5)(DepthCloud(depth[0].astype(np.float64)))
+	intCloud = PosterizeDepth(levels=3,method='kmeans1d',zPadding=0.5)(DepthCloud(depth[0]))
+	assert(np.issubdtype(intCloud.getPoints().dtype,np.floating))
+	assert(np.allclose(intCloud.getPoints()[:,2],floatCloud.getPoints()[:,2]))
+	floatBatch = PosterizeDepth(levels=3,method='kmeans1d',zPadding=0.5)(CloudBatch(depth.astype(np.float64)))
+	intBatch = PosterizeDepth(levels=3,method='kmeans1d',zPadding=0.5)(CloudBatch(depth))
+	assert(np.issubdtype(intBatch.getPoints().dtype,np.floating))
+	assert(np.allclose(intBatch.getPoints()[:,:,2],floatBatch.getPoints()[:,:,2]))
+
+def test_PosterizeDepth_FewerValuesThanLevels():
+	cloud = DepthCloud(np.full((4,4,1),3.0))
+	result = PosterizeDepth(levels=5,method='kmeans1d')(cloud)
+	assert(np.all(result.getPoints()[:,2] == 3.0))
+
+def test_PosterizeDepth_UnknownMethod():
+	with pytest.raises(ValueError):
+		PosterizeDepth(method='garbage')
+
+def test_PosterizeDepth_WarmStart_Stable():
+	#Slowly drifting layers should be tracked without refitting from scratch.
+	posterize = PosterizeDepth(levels=3,method='kmeans1d',warmStart=True)
+	depth = _layeredDepth(1)[0]
+	levels = []
+	for i in range(5):
+		result = posterize(DepthCloud(depth + i))
+		levels.append(np.unique(result.getPoints()[:,2]))
+	assert(posterize.getFullFitCount() == 1)
+	for i in range(1,5):
+		assert(np.allclose(levels[i],levels[0] + i))
+
+def test_PosterizeDepth_WarmStart_RefitsOnDrift():
+	posterize = PosterizeDepth(levels=3,method='kmeans1d',warmStart=True)
+	posterize(DepthCloud(_layeredDepth(1)[0]))
+	posterize(DepthCloud(_layeredDepth(1)[0] * 10))
+	assert(posterize.getFullFitCount() == 2)
+	posterize.reset()
+	posterize(DepthCloud(_layeredDepth(1)[0]))
+	assert(posterize.getFullFitCount() == 1)
+
+def test_PosterizeDepth_WarmStart_Batch():
+	posterize = PosterizeDepth(levels=3,method='kmeans1d',warmStart=True)
+	batch = posterize(CloudBatch(_layeredDepth(4)))
+	assert(posterize.getFullFitCount() == 1)
+	for frame in batch.getPoints():
+		assert(len(np.unique(frame[:,2])) <= 3)
+
+def test_PosterizeDepth_WarmStart_UnsupportedMethod():
+	for method in ('uniform','quantile','jenks'):
+		with pytest.raises(ValueError):
+			PosterizeDepth(method=method,warmStart=True)
+
+def _paintedCloud(depth,seed=0):
+	cloud = DepthCloud(depth)
+	cloud.setColorsByImage(np.random.RandomState(seed).randint(0,256,size=depth.shape[:2] + (3,),dtype=np.uint8))
+	return cloud
+
+def test_DecimateClouds_Stride():
+	depth = _layeredDepth(1)[0]
+	cloud = DecimateClouds(stride=3)(_paintedCloud(depth))
+	assert(len(cloud.getPoints()) == 10 * 14 and len(cloud.getColors()) == 10 * 14)
+	assert(np.array_equal(cloud.getPoints()[:,2],depth[::3,::3,0].reshape(-1)))
+
+def test_DecimateClouds_RandomIsConsistent():
+	decimate = DecimateClouds(method='random',fraction=0.1,seed=1)
+	first = decimate(DepthCloud(_layeredDepth(1,seed=0)[0]))
+	second = decimate(DepthCloud(_layeredDepth(1,seed=1)[0]))
+	assert(len(first.getPoints()) == 120)
+	#The same pixels are kept in every frame, so the frames can still be interpolated.
+	assert(np.array_equal(first.getPoints()[:,:2],second.getPoints()[:,:2]))
+
+def test_DecimateClouds_Batch():
+	depthData = _layeredDepth(2)
+	batch = DecimateClouds(stride=2)(CloudBatch(depthData.copy()))
+	assert(batch.getPoints().shape == (2,15 * 20,3))
+	assert(np.array_equal(batch.getPoints()[1],DecimateClouds(stride=2)(DepthCloud(depthData[1])).getPoints()))
+	with pytest.raises(ValueError):
+		DecimateClouds(method='voxel')(CloudBatch(depthData))
+
+@pytest.mark.parametrize("voxelSize",[2.0,1000.0,0.01])
+def test_DecimateClouds_VoxelMatchesLoop(voxelSize):
+	cloud = _paintedCloud(_layeredDepth(1)[0])
+	points = cloud.getPoints().astype(np.float64)
+	colors = cloud.getColors().astype(np.float64)
+	expected = {}
+	for point,color in zip(points,colors):
+		expected.setdefault(tuple(np.floor(point / voxelSize)),[]).append((point,color))
+	result = DecimateClouds(method='voxel',voxelSize=voxelSize)(cloud)
+	assert(len(result.getPoints()) == len(expected))
+	assert(result.getColors().dtype == np.uint8)
+	for point,color in zip(result.getPoints(),result.getColors()):
+		members = expected[tuple(np.floor(point / voxelSize))]
+		assert(np.allclose(point,np.mean([member[0] for member in members],axis=0)))
+		assert(np.all(np.abs(color - np.mean([member[1] for member in members],axis=0)) <= 0.5))
+
+def test_DecimateClouds_UnknownMethod():
+	with pytest.raises(ValueError):
+		DecimateClouds(method='garbage')
@@ -1,10 +1,9 @@
-from cloudmosh.components.io import ReadImage,SaveImage,ReadVideoOrGIF,SaveGIF
+from cloudmosh.components.io import ReadImage,SaveImage,ReadVideoOrGIF,SaveGIF,SaveVideo,ReadImageAsBinary,DecodeImage
 import nutsflow
 import pytest
 import numpy as np
 
 #TODO: Test transparent PNGs
-#TODO: Test load image-as-binary and conversion to RGB.
 
 def test_ReadImage_PNG():
 	result = ReadImage("test/testdata/colorbars.png") >> nutsflow.Collect()
@@ -127,3 +126,206 @@ def test_SaveGIF_MultipleFiles_MultiRead(tmpdir_factory):
 	
 	
 	
+
+def test_ReadVideoOrGIF_Stream():
+	result = ReadVideoOrGIF("test/testdata/shore.gif",stream=True) >> nutsflow.Collect()
+	assert(len(result) == 1)
+	frames = result[0]
+	assert(not isinstance(frames,list))
+	frames = list(frames)
+	assert(len(frames) == 21)
+	assert(frames[0].shape[0] == 1)
+
+def test_ReadVideoOrGIF_Stream_MatchesList():
+	listed = (ReadVideoOrGIF("test/testdata/shore.gif") >> nutsflow.Collect())[0]
+	streamed = list((ReadVideoOrGIF("test/testdata/shore.gif",stream=True) >> nutsflow.Collect())[0])
+	assert(all(np.array_equal(a,b) for a,b in zip(listed,streamed)))
+
+def test_ReadVideoOrGIF_StrideStartStop():
+	gif = (ReadVideoOrGIF("test/testdata/shore.gif",start=2,stop=12,stride=3) >> nutsflow.Collect())[0]
+	full = (ReadVideoOrGIF("test/testdata/shore.gif") >> nutsflow.Collect())[0]
+	assert(len(gif) == 4)
+	assert(np.array_equal(gif[1],full[5]))
+
+def test_ReadVideoOrGIF_Batches():
+	gif = (ReadVideoOrGIF("test/testdata/shore.gif",batchSize=4,stream=True) >> nutsflow.Collect())[0]
+	shapes = [batch.shape[0] for batch in gif]
+	assert(shapes == [4,4,4,4,4,1])
+
+def test_ReadVideoOrGIF_FrameShape():
+	gif = (ReadVideoOrGIF("test/testdata/shore.gif",frameShape=(32,48),stop=2) >> nutsflow.Collect())[0]
+	assert(gif[0].shape[1:3] == (32,48))
+	assert(gif[0].dtype == np.uint8)
+
+def test_ReadVideoOrGIF_Stream_then_SaveGIF(tmpdir_factory):
+	fn = tmpdir_factory.mktemp("temporaryfiles").join("tmp.gif")
+	ReadVideoOrGIF("test/testdata/shore.gif",stream=True,batchSize=5) >> SaveGIF(str(fn))
+	result = (ReadVideoOrGIF(str(fn)) >> nutsflow.Collect())[0]
+	assert(len(result) == 21)
+
+@pytest.mark.parametrize("processes",[False,True])
+def test_ReadImage_Workers_MatchesSerial(processes):
+	paths = ["test/testdata/colorbars.png","test/testdata/colorbars.jpg"] * 3
+	serial = ReadImage(*paths) >> nutsflow.Collect()
+	parallel = ReadImage(*paths,workers=2,processes=processes) >> nutsflow.Collect()
+	assert(len(parallel) == len(serial))
+	assert(all(np.array_equal(a,b) for a,b in zip(serial,parallel)))
+
+def test_ReadImage_Workers_FileNotFoundError_InOrder():
+	reader = iter(ReadImage("test/testdata/colorbars.png","garbage","test/testdata/colorbars.jpg",workers=2))
+	assert(next(reader).shape == (1,48,64,3))
+	with pytest.raises(FileNotFoundError):
+		next(reader)
+
+def test_ReadImage_Workers_FailedDecodeIsNotRetried(monkeypatch):
+	import cloudmosh.components.io as io
+	decoded = []
+	original = io._readImage
+	def readImage(path):
+		decoded.append(path)
+		return original(path)
+	monkeypatch.setattr(io,"_readImage",readImage)
+	reader = iter(ReadImage("garbage","test/testdata/colorbars.png",workers=1,prefetch=1))
+	with pytest.raises(FileNotFoundError):
+		next(reader)
+	with pytest.raises(StopIteration):
+		next(reader)
+	assert(decoded == ["garbage"])
+
+@pytest.mark.parametrize("processes",[False,True])
+def test_ReadImage_Workers_AbandonedReadStopsWorkers(processes):
+	import threading
+	import multiprocessing
+	threads = threading.active_count()
+	reader = iter(ReadImage(*["test/testdata/colorbars.png"] * 20,workers=2,processes=processes))
+	assert(next(reader).shape == (1,48,64,3))
+	reader.close()
+	assert(threading.active_count() == threads)
+	assert(multiprocessing.active_children() == [])
+
+def test_ReadImage_Workers_RepeatLoad():
+	reader = ReadImage("test/testdata/colorbars.png","test/testdata/colorbars.jpg",workers=1,prefetch=1)
+	assert(len(reader >> nutsflow.Collect()) == 2)
+	assert(len(reader >> nutsflow.Collect()) == 2)
+
+@pytest.mark.parametrize("background",[False,True])
+def test_SaveImage_Template(tmpdir_factory,background):
+	directory = tmpdir_factory.mktemp("temporaryfiles")
+	ReadImage("test/testdata/colorbars.png","test/testdata/colorbars.png","test/testdata/colorbars.png") >> SaveImage(str(directory.join("out_{:05d}.png")),template=True,background=background)
+	assert(sorted(p.basename for p in directory.listdir()) == ["out_00000.png","out_00001.png","out_00002.png"])
+
+@pytest.mark.parametrize("name",["photo{1}.png","a{b}.png","x{}.png"])
+def test_SaveImage_LiteralBraces(tmpdir_factory,name):
+	directory = tmpdir_factory.mktemp("temporaryfiles")
+	ReadImage("test/testdata/colorbars.png") >> SaveImage(str(directory.join(name)))
+	assert([p.basename for p in directory.listdir()] == [name])
+
+def test_SaveImage_TemplateTakesOnePath(tmpdir_factory):
+	directory = tmpdir_factory.mktemp("temporaryfiles")
+	with pytest.raises(ValueError):
+		ReadImage("test/testdata/colorbars.png") >> SaveImage(str(directory.join("a_{}.png")),str(directory.join("b_{}.png")),template=True)
+
+def test_SaveImage_Streams(tmpdir_factory):
+	#The first image must be on disk before the second one has been produced.
+	directory = tmpdir_factory.mktemp("temporaryfiles")
+	fnA = directory.join("tmpA.png")
+	fnB = directory.join("tmpB.png")
+	def images():
+		yield (ReadImage("test/testdata/colorbars.png") >> nutsflow.Collect())[0]
+		assert(fnA.exists())
+		yield (ReadImage("test/testdata/colorbars.png") >> nutsflow.Collect())[0]
+	images() >> SaveImage(str(fnA),str(fnB),background=False)
+	assert(fnB.exists())
+
+def test_SaveImage_TooFewImages(tmpdir_factory):
+	directory = tmpdir_factory.mktemp("temporaryfiles")
+	with pytest.raises(OSError):
+		ReadImage("test/testdata/colorbars.png") >> SaveImage(str(directory.join("a.png")),str(directory.join("b.png")))
+
+def test_SaveImage_BackgroundError(tmpdir_factory):
+	directory = tmpdir_factory.mktemp("temporaryfiles")
+	with pytest.raises(Exception):
+		ReadImage("test/testdata/colorbars.png") >> SaveImage(str(directory.join("missing").join("a.png")))
+
+def test_SaveGIF_SingleSequence_Template(tmpdir_factory):
+	directory = tmpdir_factory.mktemp("temporaryfiles")
+	frames = (ReadVideoOrGIF("test/testdata/shore.gif") >> nutsflow.Collect())[0]
+	iter(frames) >> SaveGIF(str(directory.join("clip_{:03d}.gif")),template=True,singleSequence=True)
+	result = (ReadVideoOrGIF(str(directory.join("clip_000.gif"))) >> nutsflow.Collect())[0]
+	assert(len(result) == 21)
+
+def test_SaveGIF_LiteralBraces(tmpdir_factory):
+	directory = tmpdir_factory.mktemp("temporaryfiles")
+	frames = (ReadVideoOrGIF("test/testdata/shore.gif") >> nutsflow.Collect())[0]
+	iter(frames) >> SaveGIF(str(directory.join("clip{0}.gif")),singleSequence=True)
+	assert([p.basename for p in directory.listdir()] == ["clip{0}.gif"])
+
+def test_SaveSequences_IsAbstract():
+	from cloudmosh.components.io import _SaveSequences
+	with pytest.raises(TypeError):
+		_SaveSequences("clip.gif")
+
+class FailingWriter:
+	def __init__(self):
+		self.closed = False
+	def append_data(self,frame):
+		raise IOError("disk full")
+	def close(self):
+		self.closed = True
+
+@pytest.mark.parametrize("background",[False,True])
+def test_SaveSequences_ClosesWriterAfterError(background):
+	writers = []
+	class FailingGIF(SaveGIF):
+		def _openWriter(self,path):
+			writers.append(FailingWriter())
+			return writers[-1]
+	frames = [np.zeros((1,48,64,3),dtype=np.uint8)] * 20
+	with pytest.raises(IOError):
+		iter(frames) >> FailingGIF("clip.gif",singleSequence=True,background=background)
+	assert(len(writers) == 1 and writers[0].closed)
+
+def test_SaveVideo_MP4(tmpdir_factory):
+	fn = tmpdir_factory.mktemp("temporaryfiles").join("tmp.mp4")
+	frames = [np.full((1,48,64,3),i*10,dtype=np.uint8) for i in range(10)]
+	[frames] >> SaveVideo(str(fn),fps=10)
+	result = (ReadVideoOrGIF(str(fn)) >> nutsflow.Collect())[0]
+	assert(len(result) == 10)
+
+@pytest.mark.parametrize("useMmap",[True,False])
+def test_ReadImageAsBinary(useMmap):
+	result = ReadImageAsBinary("test/testdata/colorbars.png","test/testdata/colorbars.jpg",mmap=useMmap) >> nutsflow.Collect()
+	assert(len(result) == 2)
+	with open("test/testdata/colorbars.png",'rb') as f:
+		assert(bytes(result[0]) == f.read())
+
+def test_ReadImageAsBinary_FileNotFoundError():
+	with pytest.raises(FileNotFoundError):
+		ReadImageAsBinary("garbage") >> nutsflow.Collect()
+
+def test_ReadImageAsBinary_RRShiftUnsupported():
+	with pytest.raises(SyntaxError):
+		[1,2,3] >> ReadImageAsBinary("test/testdata/colorbars.jpg")
+
+@pytest.mark.parametrize("workers,processes",[(0,False),(2,False),(2,True)])
+def test_ReadImageAsBinary_then_DecodeImage(workers,processes):
+	paths = ["test/testdata/colorbars.png","test/testdata/colorbars.jpg"] * 2
+	decoded = ReadImageAsBinary(*paths) >> DecodeImage(workers=workers,processes=processes) >> nutsflow.Collect()
+	expected = ReadImage(*paths) >> nutsflow.Collect()
+	assert(len(decoded) == len(expected))
+	assert(all(np.array_equal(a,b) for a,b in zip(decoded,expected)))
+
+def test_DecodeImage_Error():
+	with pytest.raises(Exception):
+		[b"not an image"] >> DecodeImage(workers=1) >> nutsflow.Collect()
+
+@pytest.mark.parametrize("processes",[False,True])
+def test_DecodeImage_AbandonedDecodeStopsWorkers(processes):
+	import threading
+	import multiprocessing
+	threads = threading.active_count()
+	decoder = ReadImageAsBinary(*["test/testdata/colorbars.png"] * 20) >> DecodeImage(workers=2,processes=processes)
+	assert(next(decoder).shape == (1,48,64,3))
+	decoder.close()
+	assert(threading.active_count() == threads)
+	assert(multiprocessing.active_children() == [])
@@ -0,0 +1,182 @@
+import os
+os.environ.setdefault('PYOPENGL_PLATFORM','egl')
+from cloudmosh.components.cloud import DepthCloud,CloudBatch
+from cloudmosh.components.render import OffscreenCloudRender,SoftwareCloudRender,ParallelCloudRender
+import nutsflow
+import pytest
+import numpy as np
+
+def _canRender():
+	try:
+		import pyrender
+		pyrender.OffscreenRenderer(8,8).delete()
+		return True
+	except Exception:
+		return False
+
+needsOpenGL = pytest.mark.skipif(not _canRender(),reason="No offscreen OpenGL context is available.")
+
+CAMERA_POSE = np.array([[1.0,0,0,8],[0,1.0,0,6],[0,0,1.0,40],[0,0,0,1.0]])
+
+def _clouds(count,width=16,height=12):
+	random = np.random.RandomState(0)
+	clouds = []
+	for _ in range(count):
+		cloud = DepthCloud(random.rand(width,height,1) * 10)
+		cloud.setColorsByImage((random.rand(width,height,3) * 255).astype(np.uint8))
+		clouds.append(cloud)
+	return clouds
+
+def _renderSeparately(clouds,**kwargs):
+	return [([cloud] >> OffscreenCloudRender(**kwargs) >> nutsflow.Collect())[0] for cloud in clouds]
+
+@needsOpenGL
+def test_OffscreenCloudRender_ReusedSceneMatchesFreshScenes():
+	clouds = _clouds(4)
+	kwargs = dict(viewportWidth=64,viewportHeight=48,pointSize=3.0,cameraPose=CAMERA_POSE)
+	images = clouds >> OffscreenCloudRender(**kwargs) >> nutsflow.Collect()
+	expected = _renderSeparately(clouds,**kwargs)
+	assert(len(images) == 4)
+	assert(images[0].shape == (48,64,3))
+	assert(images[0].any())
+	for image,expectedImage in zip(images,expected):
+		assert(np.array_equal(image,expectedImage))
+
+@needsOpenGL
+def test_OffscreenCloudRender_FallsBackWithoutPyrenderInternals(monkeypatch):
+	from cloudmosh.components import render
+	clouds = _clouds(3)
+	kwargs = dict(viewportWidth=64,viewportHeight=48,pointSize=3.0,cameraPose=CAMERA_POSE)
+	expected = clouds >> OffscreenCloudRender(**kwargs) >> nutsflow.Collect()
+	meshes = []
+	original = render._OpenGLRenderer.render
+	def recordingRender(self,points,colors=None):
+		image = original(self,points,colors)
+		meshes.append(self._meshNode.mesh)
+		return image
+	monkeypatch.setattr(render._OpenGLRenderer,"render",recordingRender)
+	monkeypatch.setattr(render._OpenGLRenderer,"_supportsInPlaceUpdates",lambda self,mesh: False)
+	images = clouds >> OffscreenCloudRender(**kwargs) >> nutsflow.Collect()
+	#Every cloud got a new mesh, and the images are the same as with in-place updates.
+	assert(len(set(id(mesh) for mesh in meshes)) == 3)
+	for image,reference in zip(images,expected):
+		assert(np.array_equal(image,reference))
+
+@needsOpenGL
+def test_OffscreenCloudRender_ChangingPointCounts():
+	clouds = _clouds(2) + _clouds(1,width=8,height=6) + _clouds(1)
+	kwargs = dict(viewportWidth=32,viewportHeight=32,pointSize=2.0,cameraPose=CAMERA_POSE)
+	images = clouds >> OffscreenCloudRender(**kwargs) >> nutsflow.Collect()
+	expected = _renderSeparately(clouds,**kwargs)
+	for image,expectedImage in zip(images,expected):
+		assert(np.array_equal(image,expectedImage))
+
+@needsOpenGL
+def test_OffscreenCloudRender_Batches():
+	clouds = _clouds(3)
+	kwargs = dict(viewportWidth=32,viewportHeight=32,cameraPose=CAMERA_POSE)
+	images = [CloudBatch.fromClouds(clouds)] >> OffscreenCloudRender(**kwargs) >> nutsflow.Collect()
+	expected = clouds >> OffscreenCloudRender(**kwargs) >> nutsflow.Collect()
+	assert(len(images) == 3)
+	for image,expectedImage in zip(images,expected):
+		assert(np.array_equal(image,expectedImage))
+
+def _smoothCloud(width=64,height=48):
+	rows,columns = np.meshgrid(np.arange(width),np.arange(height),indexing='ij')
+	cloud = DepthCloud((5*np.sin(rows/9.0) + 3*np.cos(columns/7.0))[:,:,None])
+	cloud.setColorsByImage(np.stack([rows*4,columns*5,np.full_like(rows,128)],2).astype(np.uint8))
+	return cloud
+
+@needsOpenGL
+@pytest.mark.parametrize("pointSize",[3,5,9])
+def test_SoftwareCloudRender_MatchesOpenGL(pointSize):
+	#pyrender antialiases the edges of points, so only most pixels have to match.
+	kwargs = dict(viewportWidth=160,viewportHeight=120,pointSize=pointSize,cameraPose=np.array([[1.0,0,0,32],[0,1.0,0,24],[0,0,1.0,60],[0,0,0,1.0]]))
+	expected = ([_smoothCloud()] >> OffscreenCloudRender(**kwargs) >> nutsflow.Collect())[0]
+	image = ([_smoothCloud()] >> SoftwareCloudRender(**kwargs) >> nutsflow.Collect())[0]
+	assert(image.shape == expected.shape and image.dtype == expected.dtype)
+	difference = np.abs(image.astype(int) - expected).max(2)
+	assert((difference > 16).mean() < 0.05)
+
+def test_SoftwareCloudRender_NearestPointWins():
+	pose = np.array([[1.0,0,0,0],[0,1.0,0,0],[0,0,1.0,3],[0,0,0,1.0]])
+	points = np.array([[0.0,0.0,-1.0],[0.0,0.0,0.0],[0.0,0.0,-2.0]])
+	colors = np.array([[255,0,0],[0,255,0],[0,0,255]],dtype=np.uint8)
+	image = SoftwareCloudRender(16,16,pointSize=3,cameraPose=pose).render(points,colors)
+	assert(image.any(2).sum() == 9)
+	assert(np.array_equal(image[image.any(2)],np.tile([0,255,0],(9,1))))
+	#Equally near points: the first one is kept, as with OpenGL's depth test.
+	image = SoftwareCloudRender(16,16,pointSize=1,cameraPose=pose).render(points[[0,0]],colors[[2,0]])
+	assert(np.array_equal(image[image.any(2)],[[0,0,255]]))
+
+def test_SoftwareCloudRender_ClipsAndShades():
+	pose = np.array([[1.0,0,0,0],[0,1.0,0,0],[0,0,1.0,3],[0,0,0,1.0]])
+	render = SoftwareCloudRender(16,16,pointSize=1,cameraPose=pose)
+	#Behind the camera and outside the view.
+	assert(not render.render(np.array([[0.0,0.0,5.0],[100.0,0.0,0.0]])).any())
+	whiteImage = render.render(np.zeros((1,3)))
+	assert(np.array_equal(whiteImage[whiteImage.any(2)],[[255,255,255]]))
+	integerImage = render.render(np.zeros((1,3)),np.array([[200,100,50]],dtype=np.uint8))
+	floatImage = render.render(np.zeros((1,3)),np.array([[200,100,50,255]]) / 255.0)
+	assert(np.array_equal(integerImage,floatImage))
+	assert(np.array_equal(integerImage[integerImage.any(2)],[[228,167,122]]))
+
+def test_OffscreenCloudRender_SoftwareBackend():
+	clouds = _clouds(2)
+	kwargs = dict(viewportWidth=32,viewportHeight=24,pointSize=2.0,cameraPose=CAMERA_POSE)
+	images = clouds >> OffscreenCloudRender(backend='software',**kwargs) >> nutsflow.Collect()
+	expected = clouds >> SoftwareCloudRender(**kwargs) >> nutsflow.Collect()
+	assert(len(images) == 2 and images[0].shape == (24,32,3))
+	for image,expectedImage in zip(images,expected):
+		assert(np.array_equal(image,expectedImage))
+	with pytest.raises(ValueError):
+		OffscreenCloudRender(backend='vulkan')
+
+def test_ParallelCloudRender_MatchesSerial():
+	clouds = _clouds(5) + _clouds(2,width=8,height=6)
+	clouds[1].setColors(None)
+	kwargs = dict(viewportWidth=32,viewportHeight=24,pointSize=2.0,cameraPose=CAMERA_POSE,backend='software')
+	expected = clouds >> OffscreenCloudRender(**kwargs) >> nutsflow.Collect()
+	images = clouds >> ParallelCloudRender(workers=2,prefetch=3,**kwargs) >> nutsflow.Collect()
+	assert(len(images) == len(expected))
+	for image,expectedImage in zip(images,expected):
+		assert(np.array_equal(image,expectedImage))
+	batch = CloudBatch.fromClouds(clouds[2:5])
+	images = [batch] >> ParallelCloudRender(workers=2,**kwargs) >> nutsflow.Collect()
+	assert(len(images) == 3)
+	for image,expectedImage in zip(images,expected[2:5]):
+		assert(np.array_equal(image,expectedImage))
+	assert(len(clouds >> ParallelCloudRender(workers=0,**kwargs) >> nutsflow.Collect()) == 7)
+
+def test_ParallelCloudRender_RaisesWorkerErrors():
+	clouds = _clouds(3)
+	clouds[1].setPoints(np.zeros((4,2))) #Not 3-D points.
+	images = clouds >> ParallelCloudRender(workers=2,backend='software',viewportWidth=16,viewportHeight=16) >> nutsflow.Take(1) >> nutsflow.Collect()
+	assert(len(images) == 1)
+	with pytest.raises(Exception):
+		clouds >> ParallelCloudRender(workers=2,backend='software',viewportWidth=16,viewportHeight=16) >> nutsflow.Consume()
+
+@needsOpenGL
+def test_ParallelCloudRender_OpenGL():
+	clouds = _clouds(4)
+	kwargs = dict(viewportWidth=32,viewportHeight=24,pointSize=2.0,cameraPose=CAMERA_POSE)
+	expected = clouds >> OffscreenCloudRender(**kwargs) >> nutsflow.Collect()
+	images = clouds >> ParallelCloudRender(workers=2,**kwargs) >> nutsflow.Collect()
+	for image,expectedImage in zip(images,expected):
+		assert(np.array_equal(image,expectedImage))
+
+def test_FrameSlot_SendsCompactClouds():
+	from cloudmosh.components.render import _FrameSlot
+	slot = _FrameSlot((4,4,3))
+	try:
+		points = np.random.RandomState(0).rand(100,3)
+		colors = np.array([[0.0,0.5,1.0]] * 100)
+		frame = slot.write(points,colors)
+		assert(frame[2] == np.dtype(np.float32).str and frame[4] == np.dtype(np.uint8).str)
+		assert(slot._input.size == 100 * 15)
+		sentColors = np.ndarray(frame[3],dtype=frame[4],buffer=slot._input.buf,offset=100 * 12)
+		assert(np.array_equal(sentColors[0],[0,128,255]))
+		del sentColors
+	finally:
+		slot.close()
+	assert(ParallelCloudRender(workers=3)._prefetch == 4)
@@ -0,0 +1,42 @@
+from cloudmosh.components.resize import Resizer
+import pytest
+import numpy as np
+
+def _images(shape,seed=0):
+	return np.random.RandomState(seed).rand(*shape).astype(np.float32)
+
+@pytest.mark.parametrize("method",Resizer.METHODS)
+def test_Resizer_HalvingIsBlockMean(method):
+	#Halving each axis averages 2x2 blocks for both bilinear (aligned pixel centers) and area.
+	images = _images((2,48,64,3))
+	expected = images.reshape((2,24,2,32,2,3)).mean(axis=(2,4))
+	result = Resizer(method)(images,(24,32))
+	assert(result.dtype == np.float32)
+	assert(np.allclose(result,expected,atol=1e-6))
+
+@pytest.mark.parametrize("method",Resizer.METHODS)
+def test_Resizer_ConstantImage(method):
+	images = np.full((1,10,10,1),7,dtype=np.uint8)
+	for shape in [(3,17),(25,4),(10,10)]:
+		assert(np.allclose(Resizer(method)(images,shape),7))
+
+def test_Resizer_Area_PreservesMean():
+	images = _images((1,90,70,1)) * 1000
+	result = Resizer('area')(images,(30,35))
+	assert(np.isclose(result.mean(),images.mean(),rtol=1e-5))
+
+def test_Resizer_Out():
+	resizer = Resizer()
+	out = np.empty((2,24,32,3),dtype=np.float32)
+	result = resizer(_images((2,48,64,3)),(24,32),out=out)
+	assert(result is out)
+
+def test_Resizer_SameShapeIsCopy():
+	images = _images((1,8,8,3))
+	result = Resizer()(images,(8,8))
+	assert(np.array_equal(result,images))
+	assert(not np.shares_memory(result,images))
+
+def test_Resizer_UnknownMethod():
+	with pytest.raises(ValueError):
+		Resizer('garbage')